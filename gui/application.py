@@ -46,6 +46,7 @@ from gettext import gettext as _
 
 import lib.observable
 import lib.document
+import lib.command
 from lib import brush
 from lib import helpers
 from lib import mypaintlib
@@ -84,6 +85,9 @@ from .overlays import ScaleOverlay  # noqa: F401
 from .buttonmap import ButtonMapping
 import lib.config
 import lib.glib
+import lib.idletask
+import lib.tiledsurface
+import lib.surface
 import gui.cursor
 import lib.fileutils
 import gui.picker
@@ -399,6 +403,11 @@ class Application (object):
         self._transient_msg_context_id = context_id
         self._transient_msg_remove_timeout_id = None
 
+        # Compression of tiles which haven't been used for a while
+        self._cold_tile_compressor = lib.tiledsurface.ColdTileCompressor()
+        self._cold_tile_processor = lib.idletask.Processor()
+        self._cold_tile_timer_id = None
+
         # Profiling & debug stuff
         self.profiler = gui.profiling.Profiler()
 
@@ -476,6 +485,9 @@ class Application (object):
         self._apply_pressure_mapping_settings()
         self._apply_button_mapping_settings()
         self._apply_autosave_settings()
+        self._apply_load_save_settings()
+        self._apply_tile_compression_settings()
+        self._apply_undo_settings()
         self.preferences_window.update_ui()
 
     def load_settings(self):
@@ -536,14 +548,51 @@ class Application (object):
             'ui.toolbar_icon_size': 'large',
             'ui.dark_theme_variant': True,
             'ui.rendered_tile_cache_size': 16384,
+            # Memory budget for the rendered tiles. 0 means no limit.
+            'ui.rendered_tile_cache_mib': 256,
+            # Memory for the flattened layers below and above the current
+            # one, used to speed up redraws while painting. 0 disables.
+            'ui.render_backdrop_cache_mib': 128,
+            # Threads used for compositing the canvas. 0 means one per CPU.
+            'ui.render_worker_threads': 0,
             'saving.default_format': 'openraster',
+            # When resaving an .ora file, copy the unchanged layers
+            # from the old file rather than encoding them again.
+            'saving.incremental_openraster': True,
+            # Also store layers in .ora files as MyPaint tile archives,
+            # which make the files bigger, but much faster to reopen.
+            'saving.native_tiles': False,
+            # PNG compression for saved and exported files, a profile
+            # name from lib.surface.PNG_COMPRESSION_PROFILES: "fast",
+            # "default", or "small" (slow, but best for archiving).
+            'saving.png_compression': 'default',
             'brushmanager.selected_brush': None,
             'brushmanager.selected_groups': [],
             'frame.color_rgba': (0.12, 0.12, 0.12, 0.92),
             'misc.context_restores_color': True,
 
             'document.autosave_backups': True,
+            # Decode the layers of .ora files in the background, or
+            # when they're first needed, so big files open sooner.
+            'document.lazy_ora_loading': True,
+            # Autosave layers as MyPaint tile archives instead of PNGs.
+            'document.autosave_native_tiles': True,
+            # Autosaves favour speed over file size.
+            'document.autosave_png_compression': 'fast',
             'document.autosave_interval': 10,
+            # Undo history limits. A memory budget of 0 means that only
+            # the number of steps is limited.
+            'document.undo_max_steps': lib.command.CommandStack.MAXLEN,
+            'document.undo_memory_mib': 1024,
+            # Compress tiles not used for this many seconds, as long as
+            # the uncompressed tiles use more memory than the target.
+            'document.compress_cold_tiles': True,
+            'document.cold_tile_seconds': 60,
+            'document.tile_memory_target_mib': 1024,
+            # Write cold tiles to a file in the working document's cache
+            # rather than compressing them. The target then limits the
+            # memory used by tiles, for documents bigger than the RAM.
+            'document.spill_cold_tiles': False,
 
             # configurable EOTF.  Set to 1.0 for legacy non-linear behaviour
             'display.colorspace_EOTF': 2.2,
@@ -675,6 +724,97 @@ class Application (object):
         model.autosave_backups = active
         model.autosave_interval = interval
 
+    def _apply_load_save_settings(self):
+        incremental = self.preferences["saving.incremental_openraster"]
+        lazy = self.preferences["document.lazy_ora_loading"]
+        ora_tiles = self.preferences["saving.native_tiles"]
+        autosave_tiles = self.preferences["document.autosave_native_tiles"]
+        png = self.preferences["saving.png_compression"]
+        autosave_png = self.preferences["document.autosave_png_compression"]
+        logger.debug(
+            "Applying load/save settings: incremental_openraster=%r, "
+            "lazy_ora_loading=%r, native_tiles=%r, "
+            "autosave_native_tiles=%r, png_compression=%r, "
+            "autosave_png_compression=%r",
+            incremental, lazy, ora_tiles, autosave_tiles,
+            png, autosave_png,
+        )
+        model = self.doc.model
+        model.incremental_ora_saves = bool(incremental)
+        model.lazy_ora_loading = bool(lazy)
+        model.ora_native_tiles = bool(ora_tiles)
+        model.autosave_native_tiles = bool(autosave_tiles)
+        model.png_compression = self._get_png_compression_setting(png)
+        model.autosave_png_compression = \
+            self._get_png_compression_setting(autosave_png, "fast")
+
+    @staticmethod
+    def _get_png_compression_setting(value, fallback="default"):
+        """Validate a PNG compression pref, falling back if it's bad."""
+        if isinstance(value, list):
+            value = tuple(value)  # JSON has no tuples
+        try:
+            lib.surface.get_png_compression(value)
+        except ValueError:
+            logger.warning(
+                "Unknown PNG compression setting %r, using %r",
+                value, fallback,
+            )
+            value = fallback
+        return value
+
+    def _apply_undo_settings(self):
+        max_steps = self.preferences["document.undo_max_steps"]
+        budget_mib = self.preferences["document.undo_memory_mib"]
+        logger.debug(
+            "Applying undo settings: max_steps=%r, budget=%rMiB",
+            max_steps, budget_mib,
+        )
+        stack = self.doc.model.command_stack
+        stack.max_steps = max(1, int(max_steps))
+        stack.memory_budget = None
+        if budget_mib:
+            stack.memory_budget = int(budget_mib * 1024 * 1024)
+        stack.reduce_undo_history()
+
+    ## Compression of unused tiles
+
+    def _apply_tile_compression_settings(self):
+        active = self.preferences["document.compress_cold_tiles"]
+        seconds = self.preferences["document.cold_tile_seconds"]
+        target_mib = self.preferences["document.tile_memory_target_mib"]
+        logger.debug(
+            "Applying tile compression settings: active=%r, "
+            "seconds=%r, target=%rMiB, spill=%r",
+            active, seconds, target_mib,
+            self.preferences["document.spill_cold_tiles"],
+        )
+        self._cold_tile_spill = self.preferences["document.spill_cold_tiles"]
+        comp = self._cold_tile_compressor
+        comp.idle_seconds = max(1, int(seconds))
+        comp.memory_target = int(target_mib * 1024 * 1024)
+        if self._cold_tile_timer_id is not None:
+            GLib.source_remove(self._cold_tile_timer_id)
+            self._cold_tile_timer_id = None
+        self._cold_tile_processor.stop()
+        if active:
+            self._cold_tile_timer_id = GLib.timeout_add_seconds(
+                interval=comp.idle_seconds,
+                function=self._cold_tile_timer_cb,
+            )
+
+    def _cold_tile_timer_cb(self):
+        """Start a sweep for cold tiles, unless one is running"""
+        if not self._cold_tile_processor.has_work():
+            comp = self._cold_tile_compressor
+            comp.spill = None
+            if self._cold_tile_spill:
+                # The working doc's cache dir changes when it's cleared.
+                comp.spill = self.doc.model.tile_spill
+            comp.start_sweep()
+            self._cold_tile_processor.add_work(comp.process)
+        return True
+
     def save_gui_config(self):
         Gtk.AccelMap.save(join(self.user_confpath, 'accelmap.conf'))
         wkspace = self.workspace
@@ -826,7 +966,8 @@ class Application (object):
         :type strokeinfo: lib.strokemap.StrokeShape
         """
         mb = brushmanager.ManagedBrush(self.brushmanager)
-        mb.brushinfo.load_from_string(strokeinfo.brush_string)
+        brushinfo = brush.get_parsed_brushinfo(strokeinfo.brush_string)
+        mb.brushinfo.load_from_brushinfo(brushinfo)
         self.brushmanager.select_brush(mb)
         self.brushmodifier.restore_context_of_selected_brush()
 
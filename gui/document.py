@@ -48,6 +48,7 @@ from gui.widgets import with_wait_cursor
 from lib.gettext import gettext as _
 from lib.gettext import C_
 from lib.modes import PASS_THROUGH_MODE
+from lib.pycompat import unicode
 
 logger = logging.getLogger(__name__)
 
@@ -300,6 +301,7 @@ class Document (CanvasController):  # TODO: rename to "DocumentController"
         self.modes.changed += self._modestack_changed_cb
 
         self.model.frame_enabled_changed += self._frame_enabled_changed_cb
+        self.model.layer_load_failed += self._layer_load_failed_cb
         layerstack = self.model.layer_stack
         layerstack.symmetry_state_changed += self._symmetry_state_changed_cb
 
@@ -1029,6 +1031,23 @@ class Document (CanvasController):  # TODO: rename to "DocumentController"
         if bool(action.get_active()) != bool(enabled):
             action.set_active(enabled)
 
+    def _layer_load_failed_cb(self, model, layer, error):
+        """Tell the user about a layer left empty by a failed load"""
+        self.app.message_dialog(
+            title=C_(
+                "Document IO: layer decode failed: dialog title",
+                u"Layer Not Loaded",
+            ),
+            text=C_(
+                "Document IO: layer decode failed: dialog text",
+                u"The layer “{layer_name}” could not be loaded. It has "
+                u"been left empty and locked, and the file can only be "
+                u"saved under a different name.",
+            ).format(layer_name=layer.name),
+            secondary_text=unicode(error),
+            type=Gtk.MessageType.ERROR,
+        )
+
     ## Layer and stroke picking
 
     def pick_context(self, x, y, action=None):
@@ -2035,6 +2054,36 @@ class Document (CanvasController):  # TODO: rename to "DocumentController"
             total=t,
         ))
 
+    def print_render_cache_stats_cb(self, action):
+        """Logs the rendered tile cache's memory and hit rate stats."""
+        stats = self.model.layer_stack.get_render_cache_stats()
+        budget = "unlimited"
+        if stats["capacity_bytes"] is not None:
+            budget = "%.1f" % (stats["capacity_bytes"] / (1024 * 1024),)
+        logger.info(
+            "Render cache: %d/%d tiles, %.1f/%s MiB, "
+            "%d hits, %d misses, %d evictions",
+            stats["items"], stats["capacity"],
+            stats["bytes"] / (1024 * 1024), budget,
+            stats["hits"], stats["misses"], stats["evictions"],
+        )
+        for level, counts in sorted(stats.get("groups", {}).items()):
+            logger.info(
+                "Render cache: mipmap level %d: %d hits, %d misses",
+                level, counts["hits"], counts["misses"],
+            )
+        self.app.show_transient_message(C_(
+            "Statusbar message: render cache statistics",
+            u"Render cache: {mib:.1f} MiB in {items} tiles, "
+            u"{hits} hits, {misses} misses, {evictions} evictions.",
+        ).format(
+            mib=stats["bytes"] / (1024 * 1024),
+            items=stats["items"],
+            hits=stats["hits"],
+            misses=stats["misses"],
+            evictions=stats["evictions"],
+        ))
+
     ## Model state reflection
 
     def _input_stroke_ended_cb(self, self_again, event):
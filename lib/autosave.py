@@ -70,7 +70,7 @@ class Autosaveable:
         be skipped.
 
         :param unicode oradir: Root of OpenRaster-like structure
-        :param lib.idletask.Processor taskproc: Output: queue of tasks
+        :param lib.workers.ThreadedProcessor taskproc: Output: task queue
         :param set manifest: Output: files in data/ to retain afterward
         :param tuple bbox: frame bounding box, (x,y,w,h)
         :param \*\*kwargs: To be passed to underlying save routines.
@@ -90,13 +90,12 @@ class Autosaveable:
            and includes the XML elements from its children.
 
         Auto-recovery saving needs to be split into small tasks so that
-        it doesn't interfere too much with foreground processing.
-        Individual PNG tile strips or small file copies have about the
-        right granularity.
+        it can be stopped promptly. Individual PNG tile strips or small
+        file copies have about the right granularity.
 
-        It follows that snapshots should be used for auto-saving,
-        because the user can make changes between the queued tasks
-        as the queue is run.
+        The tasks run in a background thread, so they must only use
+        snapshots taken when they're queued: the user can make changes
+        while the queue is run.
 
         The returned element should contain sub-elements for any
         sub-layers, and the queue operation should recursively call this
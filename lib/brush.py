@@ -16,6 +16,7 @@ import json
 from lib import mypaintlib
 from lib import helpers
 from lib import brushsettings
+from lib.cache import LRUCache
 from lib.pycompat import unicode
 from lib.pycompat import PY3
 
@@ -48,6 +49,12 @@ _BRUSHINFO_MATCH_IGNORES = [
     "parent_brush_name",
 ]
 
+#: Number of distinct parsed brush settings strings to keep.
+PARSED_BRUSHINFO_CACHE_SIZE = 64
+
+# Shared parsed BrushInfos, by settings string.
+_parsed_brushinfos = LRUCache(capacity=PARSED_BRUSHINFO_CACHE_SIZE)
+
 
 # Helper funcs for quoting and unquoting:
 
@@ -86,6 +93,30 @@ def brushinfo_unquote(quoted):
     return unicode(u8bytes.decode("utf-8"))
 
 
+# Shared parsed brush settings:
+
+def get_parsed_brushinfo(settings_str):
+    """Get a shared, parsed BrushInfo for a brush settings string.
+
+    :param settings_str: Serialized settings, as from save_to_string().
+    :rtype: BrushInfo
+
+    Strokes and strokemap entries store their brush settings only as
+    strings. Replaying or picking lots of them would parse the same
+    few strings over and over again, so recently parsed ones are kept
+    in an LRU cache keyed by the string.
+
+    The returned object is shared, and must not be modified. Use its
+    clone() method, or load_from_brushinfo(), to get an editable copy.
+
+    """
+    brushinfo = _parsed_brushinfos.get(settings_str)
+    if brushinfo is None:
+        brushinfo = BrushInfo(settings_str)
+        _parsed_brushinfos[settings_str] = brushinfo
+    return brushinfo
+
+
 # Exceptions raised during brush parsing:
 
 class ParseError (Exception):
@@ -592,10 +623,21 @@ class Brush (mypaintlib.PythonBrush):
 
     """
 
-    def __init__(self, brushinfo):
+    def __init__(self, brushinfo, observe=True):
+        """Initialize, configured from a BrushInfo.
+
+        :param BrushInfo brushinfo: The settings to use.
+        :param bool observe: Follow later changes to brushinfo.
+
+        Brushes which don't observe their BrushInfo can be made from
+        shared, unchanging ones like those from get_parsed_brushinfo(),
+        without piling up observers on them.
+
+        """
         super(Brush, self).__init__()
         self.brushinfo = brushinfo
-        brushinfo.observers.append(self._update_from_brushinfo)
+        if observe:
+            brushinfo.observers.append(self._update_from_brushinfo)
         self._update_from_brushinfo(ALL_SETTINGS)
 
     def _update_from_brushinfo(self, settings):
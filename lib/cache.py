@@ -9,20 +9,66 @@
 from __future__ import division, print_function
 
 from collections import OrderedDict
+from collections import defaultdict
 
 
 class LRUCache (object):
-    """Least-recently-used cache with dict-like usage"""
+    """Least-recently-used cache with dict-like usage
+
+    The cache is always limited to a number of items. Pass a "sizeof"
+    function and a "capacity_bytes" limit to make it account for the
+    memory its items use, and evict by size as well:
+
+    >>> c = LRUCache(capacity=100, capacity_bytes=10, sizeof=len)
+    >>> c["a"] = "xxxx"
+    >>> c["b"] = "yyyy"
+    >>> c["c"] = "zzzz"
+    >>> sorted(c.keys())
+    ['b', 'c']
+    >>> c.nbytes
+    8
+
+    Items are re-measured when they are stored again, so mutable items
+    can be re-accounted by assigning them back after modifying them.
+
+    The "stats_key" function maps a cache key to a group for reporting
+    hit and miss counts. If "on_evict" is set, it's called with the key
+    and item of each item evicted to make space for others.
+
+    >>> c = LRUCache(capacity=2, stats_key=lambda k: k[0])
+    >>> c[(0, 1)] = 1
+    >>> c[(1, 1)] = 2
+    >>> c[(1, 2)] = 3
+    >>> c.get((0, 1)) is None
+    True
+    >>> c.get((1, 2))
+    3
+    >>> stats = c.get_stats()
+    >>> stats["evictions"], stats["hits"], stats["misses"]
+    (1, 1, 1)
+    >>> sorted(stats["groups"].items())
+    [(0, {'hits': 0, 'misses': 1}), (1, {'hits': 1, 'misses': 0})]
+
+    """
     # The idea for using an OrderedDict comes from Kun Xi -
     # http://www.kunxi.org/blog/2014/05/lru-cache-in-python/
 
     _SENTINEL = object()
 
-    def __init__(self, capacity=16384):
+    def __init__(self, capacity=16384, capacity_bytes=None, sizeof=None,
+                 stats_key=None, on_evict=None):
         self._capacity = capacity
+        self._on_evict = on_evict
+        self._capacity_bytes = capacity_bytes
+        self._sizeof = sizeof
+        self._stats_key = stats_key
         self._cache = OrderedDict()
+        self._sizes = {}
+        self._nbytes = 0
         self._hits = 0
         self._misses = 0
+        self._evictions = 0
+        self._group_stats = defaultdict(lambda: [0, 0])
 
     def __repr__(self):
         hitrate = 1.0
@@ -31,17 +77,78 @@ class LRUCache (object):
         if accesses > 0:
             hitrate = self._hits / accesses
             missrate = self._misses / accesses
-        return "<LRUCache c: %d/%d h: %.0f%% m: %.0f%%>" % (
+        if self._sizeof is None:
+            return "<LRUCache c: %d/%d h: %.0f%% m: %.0f%%>" % (
+                len(self._cache),
+                self._capacity,
+                hitrate * 100,
+                missrate * 100,
+            )
+        return "<LRUCache c: %d/%d b: %d/%s h: %.0f%% m: %.0f%%>" % (
             len(self._cache),
             self._capacity,
+            self._nbytes,
+            self._capacity_bytes,
             hitrate * 100,
             missrate * 100,
         )
 
-    def clear(self):
+    @property
+    def nbytes(self):
+        """Accounted size of all items (always zero without sizeof)."""
+        return self._nbytes
+
+    @property
+    def capacity_bytes(self):
+        """Byte budget for the items, or None for no limit."""
+        return self._capacity_bytes
+
+    @capacity_bytes.setter
+    def capacity_bytes(self, n):
+        self._capacity_bytes = n
+        self._evict(0)
+
+    def clear(self, reset_stats=True):
         self._cache.clear()
+        self._sizes.clear()
+        self._nbytes = 0
+        if reset_stats:
+            self.reset_stats()
+
+    def reset_stats(self):
+        """Zero the hit, miss and eviction counters."""
         self._hits = 0
         self._misses = 0
+        self._evictions = 0
+        self._group_stats.clear()
+
+    def get_stats(self):
+        """Get a dict of usage statistics.
+
+        :rtype: dict
+
+        Keys are "items", "capacity", "bytes", "capacity_bytes",
+        "hits", "misses", and "evictions". Eviction counts cover only
+        items removed to make space, not explicit pops or clears.
+        If the cache has a stats_key function, the "groups" key holds
+        a dict of per-group {"hits": n, "misses": n} dicts.
+
+        """
+        stats = {
+            "items": len(self._cache),
+            "capacity": self._capacity,
+            "bytes": self._nbytes,
+            "capacity_bytes": self._capacity_bytes,
+            "hits": self._hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+        }
+        if self._stats_key is not None:
+            stats["groups"] = {
+                group: {"hits": h, "misses": m}
+                for (group, (h, m)) in self._group_stats.items()
+            }
+        return stats
 
     def __len__(self):
         return len(self._cache)
@@ -49,37 +156,109 @@ class LRUCache (object):
     def __contains__(self, key):
         return key in self._cache
 
+    def keys(self):
+        return self._cache.keys()
+
     def __getitem__(self, key):
         item = self.get(key, self._SENTINEL)
         if item is self._SENTINEL:
             raise KeyError
         return item
 
+    def _record(self, key, hit):
+        if hit:
+            self._hits += 1
+        else:
+            self._misses += 1
+        if self._stats_key is not None:
+            self._group_stats[self._stats_key(key)][0 if hit else 1] += 1
+
     def get(self, key, default=None):
         try:
             item = self._cache.pop(key)
             self._cache[key] = item
-            self._hits += 1
+            self._record(key, True)
             return item
         except KeyError:
-            self._misses += 1
+            self._record(key, False)
             return default
 
+    def peek(self, key, default=None):
+        """Look up an item without affecting the stats or its recency.
+
+        >>> c = LRUCache(capacity=2)
+        >>> c["a"] = 1
+        >>> c.peek("a"), c.peek("b")
+        (1, None)
+        >>> c.get_stats()["hits"], c.get_stats()["misses"]
+        (0, 0)
+
+        """
+        return self._cache.get(key, default)
+
+    def record_access(self, key, hit):
+        """Count a lookup made with peek() as a hit or a miss.
+
+        For lookups whose success depends on more than whether the key
+        is in the cache. Hits also make the item the most recently used,
+        like get() does.
+
+        >>> c = LRUCache(capacity=2)
+        >>> c["a"] = {}
+        >>> "x" in c.peek("a")
+        False
+        >>> c.record_access("a", False)
+        >>> c.get_stats()["hits"], c.get_stats()["misses"]
+        (0, 1)
+
+        """
+        if hit:
+            item = self._cache.pop(key, self._SENTINEL)
+            if item is not self._SENTINEL:
+                self._cache[key] = item
+        self._record(key, hit)
+
     def pop(self, key, default=_SENTINEL):
         try:
             item = self._cache.pop(key)
-            self._hits += 1
+            self._nbytes -= self._sizes.pop(key, 0)
+            self._record(key, True)
             return item
         except KeyError:
-            self._misses += 1
+            self._record(key, False)
             if default is LRUCache._SENTINEL:
                 raise
             return default
 
+    def discard(self, key):
+        """Remove an item if it exists, without affecting the stats."""
+        if self._cache.pop(key, self._SENTINEL) is not self._SENTINEL:
+            self._nbytes -= self._sizes.pop(key, 0)
+
     def __setitem__(self, key, item):
+        size = 0
+        if self._sizeof is not None:
+            size = self._sizeof(item)
         try:
             self._cache.pop(key)
+            self._nbytes -= self._sizes.pop(key, 0)
         except KeyError:
-            while len(self._cache) >= self._capacity:
-                self._cache.popitem(last=False)
+            pass
+        self._evict(size, extra_items=1)
         self._cache[key] = item
+        if self._sizeof is not None:
+            self._sizes[key] = size
+            self._nbytes += size
+
+    def _evict(self, size, extra_items=0):
+        """Evict old items to make space for a new one."""
+        limit = self._capacity_bytes
+        while self._cache:
+            if (len(self._cache) + extra_items <= self._capacity and
+                    (limit is None or self._nbytes + size <= limit)):
+                break
+            key, item = self._cache.popitem(last=False)
+            self._nbytes -= self._sizes.pop(key, 0)
+            self._evictions += 1
+            if self._on_evict is not None:
+                self._on_evict(key, item)
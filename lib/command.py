@@ -18,6 +18,7 @@ from gettext import gettext as _
 from logging import getLogger
 
 import lib.layer
+import lib.tiledsurface
 from . import helpers
 from lib.observable import event
 import lib.stroke
@@ -31,14 +32,32 @@ logger = getLogger(__name__)
 
 
 class CommandStack (object):
-    """Undo/redo stack"""
+    """Undo/redo stack
 
-    MAXLEN = 30   # FIXME: dynamic size (psutil)?
+    The undo history is limited to a number of steps, and optionally
+    by the memory its commands retain. See reduce_undo_history() and
+    get_retained_bytes().
 
-    def __init__(self, **kwargs):
+    """
+
+    MAXLEN = 30
+
+    def __init__(self, max_steps=MAXLEN, memory_budget=None, **kwargs):
+        """Initialize, with limits.
+
+        :param int max_steps: Max number of undo steps.
+        :param int memory_budget: Max bytes retained by the undo stack.
+
+        The most recent undo step is always kept, whatever its size.
+        A memory_budget of None means no memory limit.
+
+        """
         super(CommandStack, self).__init__()
         self.undo_stack = []
         self.redo_stack = []
+        self._undo_retained_bytes = 0
+        self.max_steps = max_steps
+        self.memory_budget = memory_budget
         self.stack_updated()
 
     def __repr__(self):
@@ -52,6 +71,7 @@ class CommandStack (object):
 
     def _discard_undo(self):
         self.undo_stack = []
+        self._undo_retained_bytes = 0
 
     def _discard_redo(self):
         self.redo_stack = []
@@ -67,7 +87,7 @@ class CommandStack (object):
         """
         self._discard_redo()
         command.redo()
-        self.undo_stack.append(command)
+        self._push_undo(command)
         self.reduce_undo_history()
         self.stack_updated()
 
@@ -80,6 +100,7 @@ class CommandStack (object):
         if not self.undo_stack:
             return
         command = self.undo_stack.pop()
+        self._undo_retained_bytes -= command.retained_bytes
         command.undo()
         self.redo_stack.append(command)
         self.stack_updated()
@@ -96,21 +117,60 @@ class CommandStack (object):
             return
         command = self.redo_stack.pop()
         command.redo()
-        self.undo_stack.append(command)
+        self._push_undo(command)
         self.stack_updated()
         return command
 
+    def _push_undo(self, command):
+        """Push a just-performed command, accounting its memory."""
+        command.retained_bytes = _get_retained_bytes(command)
+        self.undo_stack.append(command)
+        self._undo_retained_bytes += command.retained_bytes
+
     def reduce_undo_history(self):
-        """Trims the undo stack"""
-        stack = self.undo_stack
-        self.undo_stack = []
+        """Trims the undo stack
+
+        The stack is trimmed to max_steps, and if a memory_budget is
+        set, its oldest commands are discarded until the memory they
+        retain fits the budget.
+
+        """
+        budget = self.memory_budget
+        within_budget = (
+            budget is None
+            or self._undo_retained_bytes <= budget
+        )
+        if within_budget and len(self.undo_stack) <= self.max_steps:
+            return
+        kept = []
         steps = 0
-        for item in reversed(stack):
-            self.undo_stack.insert(0, item)
+        nbytes = 0
+        for item in reversed(self.undo_stack):
+            if budget is not None and steps > 0:
+                if nbytes + item.retained_bytes > budget:
+                    break
+            kept.append(item)
+            nbytes += item.retained_bytes
             if not item.automatic_undo:
                 steps += 1
-            if steps == self.MAXLEN:  # and memory > ...
+            if steps == self.max_steps:
                 break
+        kept.reverse()
+        self.undo_stack = kept
+        self._undo_retained_bytes = nbytes
+
+    def get_retained_bytes(self):
+        """Get the memory retained by each command.
+
+        :returns: (command, bytes) pairs, most recent undo step first,
+            followed by the redo stack
+        :rtype: list
+
+        Each command's memory is measured when it is performed.
+
+        """
+        commands = list(reversed(self.undo_stack)) + self.redo_stack
+        return [(cmd, cmd.retained_bytes) for cmd in commands]
 
     def get_last_command(self):
         """Returns the most recently performed command"""
@@ -124,6 +184,9 @@ class CommandStack (object):
         if cmd is None:
             return None
         cmd.update(**kwargs)
+        self._undo_retained_bytes -= cmd.retained_bytes
+        cmd.retained_bytes = _get_retained_bytes(cmd)
+        self._undo_retained_bytes += cmd.retained_bytes
         self.stack_updated()  # the display_name may have changed
         return cmd
 
@@ -133,6 +196,54 @@ class CommandStack (object):
         pass
 
 
+def _get_retained_bytes(command):
+    """Memory held only by a command, and not by its document."""
+    tiles = set()
+    _add_retained_tiles(vars(command), tiles, set())
+    return sum(t.nbytes for t in tiles)
+
+
+def _add_retained_tiles(obj, tiles, visited):
+    """Add the tiles held by obj and no longer used by the document.
+
+    Snapshot tiles are compared with the tiles their surface uses now,
+    and only layers outside the document have their tiles counted.
+    This is proportional to the size of the command, not the document.
+
+    """
+    if isinstance(obj, weakref.ProxyTypes):
+        return
+    if id(obj) in visited:
+        return
+    visited.add(id(obj))
+    if isinstance(obj, dict):
+        for item in obj.values():
+            _add_retained_tiles(item, tiles, visited)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            _add_retained_tiles(item, tiles, visited)
+    elif isinstance(obj, lib.tiledsurface._SurfaceSnapshot):
+        surface = obj.surface_ref and obj.surface_ref()
+        live = {}
+        if surface is not None and not surface.lazy_load_pending:
+            live = surface.tiledict
+        tiles.update(
+            t for (pos, t) in obj.tiledict.items()
+            if live.get(pos) is not t
+        )
+    elif isinstance(obj, lib.tiledsurface.MyPaintSurface):
+        if not obj.lazy_load_pending:
+            tiles.update(obj.tiledict.values())
+    elif isinstance(obj, lib.layer.RootLayerStack):
+        return  # the live document
+    elif isinstance(obj, lib.layer.LayerBase):
+        if obj.root is not None:
+            return  # still in the document
+        _add_retained_tiles(vars(obj), tiles, visited)
+    elif isinstance(obj, lib.layer.LayerBaseSnapshot):
+        _add_retained_tiles(vars(obj), tiles, visited)
+
+
 class Command (object):
     """A reversible change to the document model
 
@@ -161,6 +272,10 @@ class Command (object):
     automatic_undo = False
     display_name = _("Unknown Command")
 
+    #: Memory retained by this command's snapshots, in bytes.
+    #: Measured by the CommandStack when the command is performed.
+    retained_bytes = 0
+
     ## Method defs
 
     def __init__(self, doc, **kwargs):
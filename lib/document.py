@@ -14,10 +14,11 @@ from __future__ import absolute_import, division, print_function
 
 import os
 import sys
+import io
+import weakref
 import zipfile
 import tempfile
 import time
-from os.path import join
 import xml.etree.ElementTree as ET
 from warnings import warn
 import shutil
@@ -42,12 +43,12 @@ from lib.observable import ObservableDict
 import lib.pixbuf
 from lib.errors import FileHandlingError
 from lib.errors import AllocationError
-import lib.idletask
 from lib.gettext import C_
 import lib.xml
 import lib.glib
 import lib.feedback
 import lib.layervis
+import lib.workers
 from lib.pycompat import unicode
 
 logger = logging.getLogger(__name__)
@@ -63,6 +64,7 @@ CACHE_APP_SUBDIR_NAME = u"mypaint"
 CACHE_DOC_SUBDIR_PREFIX = u"doc."
 CACHE_DOC_AUTOSAVE_SUBDIR = u"autosave"
 CACHE_ACTIVITY_FILE = u"active"
+CACHE_TILE_SPILL_FILE = u"tiles.spill"
 CACHE_UPDATE_INTERVAL = 10  # seconds
 
 # Logging and error reporting strings
@@ -230,6 +232,171 @@ class AutosaveInfo (namedtuple("AutosaveInfo", _AUTOSAVE_INFO_FIELDS)):
         )
 
 
+class _ORASaveRecord (namedtuple("_ORASaveRecord",
+                                  ["path", "stat", "options", "members"])):
+    """Internal: what was written by the last OpenRaster save.
+
+    :ivar unicode path: Real path of the saved file
+    :ivar tuple stat: File size and mtime just after the save
+    :ivar tuple options: Normalized save options
+    :ivar dict members: Keyed zip entries, for reusing them unchanged
+
+    """
+
+    @staticmethod
+    def options_key(kwargs):
+        """Normalize save options, for comparing them."""
+        return tuple(sorted((k, repr(v)) for (k, v) in kwargs.items()))
+
+    @staticmethod
+    def stat_key(path):
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime)
+
+
+class _LayerDecoder (object):
+    """Decodes the layers of .ora files in a worker pool
+
+    Each layer's PNG data is read from the file at load time, and a
+    worker pool decodes it into tiles. Surfaces get their tiles when
+    something first needs them, waiting for the decode if necessary,
+    or when finish() is called.
+
+    """
+
+    def __init__(self):
+        super(_LayerDecoder, self).__init__()
+        self._pool = lib.workers.WorkerPool()
+        self._pending = []  # [(weakref to surface, result)]
+
+    def queue(self, surface, data, x, y):
+        """Queue decoding PNG data into a surface.
+
+        :param lib.tiledsurface.MyPaintSurface surface: Target surface
+        :param bytes data: PNG file data
+        :param int x: X coordinate for the image
+        :param int y: Y coordinate for the image
+
+        """
+        surface_ref = weakref.ref(surface)
+        result = self._pool.submit(
+            _decode_layer_png,
+            surface_ref, data, x, y,
+        )
+        surface.set_lazy_loader(result.get)
+        self._pending.append((surface_ref, result))
+
+    def finish(self, progress=None):
+        """Wait for all queued decodes, & install their tiles in order.
+
+        :param lib.feedback.Progress progress: Counts installed layers.
+
+        If a layer couldn't be decoded, its error is raised here, so
+        that the load fails instead of leaving the layer empty.
+
+        """
+        pending = self._pending
+        self._pending = []
+        if progress is not None:
+            progress.items = len(pending)
+        for surface_ref, result in pending:
+            result.get()
+            surface = surface_ref()
+            if surface is not None:
+                surface.finish_lazy_load()
+            if progress is not None:
+                progress += 1
+        if progress is not None:
+            progress.close()
+
+    def cancel(self):
+        """Stop tracking queued decodes.
+
+        Surfaces which are still pending can still be loaded on demand.
+        Decodes for surfaces which have been deleted are skipped.
+
+        """
+        self._pending[:] = []
+
+    def close(self):
+        """Stop the worker threads once all queued decodes finish."""
+        self._pool.close()
+
+
+class _LazyLayerLoader (_LayerDecoder):
+    """Decodes the layers of lazily loaded .ora files in the background
+
+    Like its base class, but a periodic check on the main thread
+    installs the tiles of each decode as soon as it has finished.
+    Surfaces whose decode failed are left empty, and are passed to a
+    callback by the same check.
+
+    """
+
+    #: How often to check for finished decodes, in milliseconds.
+    POLL_INTERVAL = 250
+
+    def __init__(self, failed_cb):
+        """Initialize, with a callback for failed decodes.
+
+        :param callable failed_cb: Called on the main thread as
+            failed_cb(surface, error) for each surface left empty.
+
+        """
+        super(_LazyLayerLoader, self).__init__()
+        self._poll_id = None
+        self._failed_cb = failed_cb
+
+    def queue(self, surface, data, x, y):
+        super(_LazyLayerLoader, self).queue(surface, data, x, y)
+        if self._poll_id is None:
+            self._poll_id = GLib.timeout_add(
+                self.POLL_INTERVAL,
+                self._poll_cb,
+            )
+
+    def _poll_cb(self):
+        still_pending = []
+        for surface_ref, result in self._pending:
+            surface = surface_ref()
+            if surface is None:
+                continue
+            if surface.lazy_load_pending:
+                if not result.ready():
+                    still_pending.append((surface_ref, result))
+                    continue
+                surface.finish_lazy_load()
+            # Also catches loads finished on demand, maybe in a worker.
+            if surface.lazy_load_error is not None:
+                self._failed_cb(surface, surface.lazy_load_error)
+        self._pending[:] = still_pending
+        if still_pending:
+            return True
+        self._poll_id = None
+        return False
+
+    def cancel(self):
+        """Stop installing tiles in the background.
+
+        Surfaces which are still pending can still be loaded on demand.
+        Decodes for surfaces which have been deleted are skipped.
+
+        """
+        if self._poll_id is not None:
+            GLib.source_remove(self._poll_id)
+            self._poll_id = None
+        super(_LazyLayerLoader, self).cancel()
+
+
+def _decode_layer_png(surface_ref, data, x, y):
+    """Internal: decode a layer's PNG data to tiles, in a worker thread"""
+    if surface_ref() is None:
+        return {}
+    pixbuf = lib.pixbuf.load_from_stream(io.BytesIO(data))
+    arr = helpers.gdkpixbuf2numpy(pixbuf)
+    return tiledsurface.tiledict_from_numpy(arr, x, y)
+
+
 class Document (object):
     """In-memory representation of everything to be worked on & saved
 
@@ -304,13 +471,30 @@ class Document (object):
         else:
             self._owns_cache_dir = True
         self._cache_updater_id = None
+        self._tile_spill = None
         self._autosave_backups = False
         self.autosave_interval = 10
         self._autosave_processor = None
         self._autosave_countdown_id = None
         self._autosave_dirty = False
+        #: Copy unchanged layers from the previous save of an .ora file.
+        self.incremental_ora_saves = False
+        self._ora_save_record = None
+        #: Decode .ora layers in the background after loading.
+        self.lazy_ora_loading = False
+        #: Also save tile archives of layers in .ora files.
+        self.ora_native_tiles = False
+        #: Autosave layers as tile archives, not PNGs.
+        self.autosave_native_tiles = False
+        #: PNG compression for saves, see lib.surface.get_png_compression().
+        self.png_compression = "default"
+        #: PNG compression for autosaves.
+        self.autosave_png_compression = "fast"
+        self._lazy_layer_loader = None
+        self._lazy_load_source = None
+        self._lazy_load_failed = False
         if (not painting_only) and self._owns_cache_dir:
-            self._autosave_processor = lib.idletask.Processor()
+            self._autosave_processor = lib.workers.ThreadedProcessor()
             self.command_stack.stack_updated += self._command_stack_updated_cb
             self.effective_bbox_changed += self._effective_bbox_changed_cb
 
@@ -386,9 +570,12 @@ class Document (object):
             )
         self._start_cache_updater()
 
-    def _cleanup_cache_dir(self):
+    def _cleanup_cache_dir(self, discard_spill=False):
         """Internal: recursively delete the working-document cache_dir if OK.
 
+        :param bool discard_spill: Drop the spilled tiles' data instead
+            of paging it back in. See TileSpillFile.close().
+
         Also stops any background tasks which update it.
 
         """
@@ -398,6 +585,9 @@ class Document (object):
             return
         self._stop_cache_updater()
         self._stop_autosave_writes()
+        if self._tile_spill is not None:
+            self._tile_spill.close(discard=discard_spill)
+            self._tile_spill = None
         shutil.rmtree(self._cache_dir, ignore_errors=True)
         if os.path.exists(self._cache_dir):
             logger.error(
@@ -411,13 +601,37 @@ class Document (object):
             )
         self._cache_dir = None
 
+    @property
+    def tile_spill(self):
+        """File in the cache dir for spilling unused tiles to disk
+
+        :rtype: lib.tiledsurface.TileSpillFile
+
+        This is None if the document has no cache dir of its own.
+        The file is created when it's first needed.
+        See lib.tiledsurface.ColdTileCompressor.
+
+        """
+        if self._painting_only or not self._owns_cache_dir:
+            return None
+        if self._cache_dir is None:
+            return None
+        if self._tile_spill is None:
+            path = os.path.join(self._cache_dir, CACHE_TILE_SPILL_FILE)
+            self._tile_spill = tiledsurface.TileSpillFile(path)
+        return self._tile_spill
+
     def cleanup(self):
         """Cleans up any persistent state belonging to the document.
 
         This method is called by the main app's exit routine
         after confirmation.
         """
-        self._cleanup_cache_dir()
+        self._cleanup_cache_dir(discard_spill=True)
+        if self._lazy_layer_loader is not None:
+            self._lazy_layer_loader.cancel()
+            self._lazy_layer_loader.close()
+        self._layers.close()
 
     ## Document-specific settings dict.
 
@@ -572,14 +786,20 @@ class Document (object):
         self._autosave_countdown_id = None
         return False
 
-    ## Queued autosave writes: low priority & chunked
+    ## Queued autosave writes: in a background thread & chunked
 
     def _queue_autosave_writes(self):
         """Add autosaved backup tasks to the background processor
 
         These tasks consist of nicely chunked writes for all layers
         whose data has changed, plus a few extra structural and
-        bookkeeping ones.
+        bookkeeping ones. They run in a worker thread, working only
+        on snapshots taken here, so this is the only part of the
+        autosave which runs in the main thread.
+
+        The document is marked as autosave-clean as soon as the
+        snapshots have been taken, so any changes made while the
+        tasks run will be picked up by the next autosave.
 
         """
         if not self._cache_dir:
@@ -610,6 +830,8 @@ class Document (object):
         root_elem = self.layer_stack.queue_autosave(
             oradir, taskproc, manifest,
             save_srgb_chunks = True,  # internal-only, so sure.
+            native_tiles = self.autosave_native_tiles,
+            compression = self.autosave_png_compression,
             bbox = image_bbox,
         )
         # Build the image element
@@ -636,7 +858,10 @@ class Document (object):
             manifest.add(settings_file_rel)
         # Thumbnail generation.
         rootstack_sshot = self.layer_stack.save_snapshot()
-        rootstack_clone = layer.RootLayerStack(doc=None)
+        rootstack_clone = layer.RootLayerStack(
+            doc=None,
+            render_workers=self.layer_stack.render_workers,
+        )
         rootstack_clone.load_snapshot(rootstack_sshot)
         thumbdir_rel = "Thumbnails"
         thumbdir = os.path.join(oradir, thumbdir_rel)
@@ -665,6 +890,8 @@ class Document (object):
             oradir = oradir,
             manifest = manifest,
         )
+        self._autosave_dirty = False
+        logger.debug("autosave: all queued, doc marked autosave-clean")
 
     def _autosave_thumbnail_cb(self, rootstack, bbox, filename):
         """Autosaved backup task: write Thumbnails/thumbnail.png
@@ -740,13 +967,14 @@ class Document (object):
                 "autosave: missing %r (listed in the manifest)",
                 path,
             )
-        self._autosave_dirty = False
-        logger.debug("autosave: all done, doc marked autosave-clean")
+        logger.debug("autosave: all done")
         return False
 
     def _stop_autosave_writes(self):
         assert not self._painting_only
         logger.debug("autosave stopped: clearing task queue")
+        if self._autosave_processor.has_work():
+            self._autosave_dirty = True
         self._autosave_processor.stop()
 
     def _command_stack_updated_cb(self, cmdstack):
@@ -889,6 +1117,36 @@ class Document (object):
         assert not self._painting_only
         self.layer_stack.background_layer.autosave_dirty = True
 
+    ## Background loading of layers
+
+    def _lazy_load_failed_cb(self, surface, error):
+        """Internal: lock a layer which couldn't be decoded in the bg
+
+        Its surface was left empty, so the file it was loaded from
+        mustn't be overwritten by save() either.
+
+        """
+        self._lazy_load_failed = True
+        for path, lr in self.layer_stack.walk():
+            if getattr(lr, "_surface", None) is surface:
+                break
+        else:
+            return
+        lr.locked = True
+        self.layer_load_failed(lr, error)
+
+    @event
+    def layer_load_failed(self, layer, error):
+        """Event: a layer couldn't be decoded in the background
+
+        :param lib.layer.core.LayerBase layer: The layer, left empty.
+        :param Exception error: What went wrong.
+
+        The layer is locked, and saving over the file it was loaded
+        from is refused.
+
+        """
+
     ## Misc actions
 
     def clear(self, new_cache=True):
@@ -911,13 +1169,15 @@ class Document (object):
             lib.mypaintlib.SymmetryVertical, 2,
         )
         prev_area = self.get_full_redraw_bbox()
+        # Drop the old layers and undo history first, so that closing
+        # the spill file pages in only the tiles still used elsewhere.
+        self.command_stack.clear()
+        self._layers.clear()
         if self._owns_cache_dir:
             if self._cache_dir is not None:
                 self._cleanup_cache_dir()
             if new_cache:
                 self._create_cache_dir()
-        self.command_stack.clear()
-        self._layers.clear()
         if self.CREATE_PAINTING_LAYER_IF_EMPTY:
             self.add_layer((-1,))
             self._layers.current_path = (0,)
@@ -930,6 +1190,11 @@ class Document (object):
         self._xres = None
         self._yres = None
         self._settings.clear()
+        self._ora_save_record = None
+        if self._lazy_layer_loader is not None:
+            self._lazy_layer_loader.cancel()
+        self._lazy_load_source = None
+        self._lazy_load_failed = False
         self.canvas_area_modified(*prev_area)
 
     def brushsettings_changed_cb(self, settings):
@@ -1390,6 +1655,17 @@ class Document (object):
         ``save_*()`` method is chosen to perform the save.
         """
         self.sync_pending_changes(flush=True)
+        overwrites_source = (
+            self._lazy_load_failed
+            and os.path.abspath(filename) == self._lazy_load_source
+        )
+        if overwrites_source:
+            tmpl = C_(
+                "Document IO: hint templates for user-facing exceptions",
+                u'Not overwriting “{filename}”: some of its layers '
+                u'could not be loaded. Save to a different file instead.'
+            )
+            raise FileHandlingError(tmpl.format(filename=filename))
         junk, ext = os.path.splitext(filename)
         ext = ext.lower().replace('.', '')
         save = getattr(self, 'save_' + ext, self._unsupported)
@@ -1594,7 +1870,14 @@ class Document (object):
 
     def save_png(self, filename, alpha=None, multifile=None, progress=None,
                  **kwargs):
-        """Save to one or more PNG files"""
+        """Save to one or more PNG files
+
+        The "compression" keyword arg sets the PNG compression profile
+        or (level, filter) tuple, and defaults to `png_compression`.
+        See lib.surface.get_png_compression().
+
+        """
+        kwargs.setdefault("compression", self.png_compression)
         if progress is None:
             progress = lib.feedback.Progress()
 
@@ -1721,31 +2004,125 @@ class Document (object):
 
     save_jpeg = save_jpg
 
-    @fileutils.via_tempfile
     def save_ora(self, filename, options=None, **kwargs):
-        """Saves OpenRaster data to a file"""
+        """Saves OpenRaster data to a file
+
+        If `incremental_ora_saves` is true, and the file is unchanged
+        since this document last saved it, the PNGs of layers which
+        haven't changed since then are copied over from the old file
+        instead of being encoded again.
+
+        If `ora_native_tiles` is true, painting layers are also saved
+        as MyPaint tile archives, which load much faster than PNGs.
+        See lib.tiledsurface.TileArchiveWriter.
+
+        The PNGs are compressed according to the "compression" keyword
+        arg, which defaults to `png_compression`. See save_png().
+
+        """
+        kwargs.setdefault("compression", self.png_compression)
         logger.info('save_ora: %r (%r, %r)', filename, options, kwargs)
         t0 = time.time()
         self.sync_pending_changes(flush=True)
-        thumbnail = _save_layers_to_new_orazip(
-            self.layer_stack,
+        previous = None
+        if self.incremental_ora_saves:
+            previous = self._get_reusable_ora_save(filename, kwargs)
+        self._ora_save_record = None
+        members = {}
+        thumbnail = self._save_ora_via_tempfile(
             filename,
-            bbox=tuple(self.get_user_bbox()),
-            xres=self._xres if self._xres else None,
-            yres=self._yres if self._yres else None,
-            frame_active = self.frame_enabled,
-            settings=dict(self._settings),
+            previous=previous,
+            members=members,
             **kwargs
         )
+        path = os.path.realpath(filename)
+        self._ora_save_record = _ORASaveRecord(
+            path=path,
+            stat=_ORASaveRecord.stat_key(path),
+            options=_ORASaveRecord.options_key(kwargs),
+            members=members,
+        )
         logger.info('%.3fs save_ora total', time.time() - t0)
         return thumbnail
 
+    @fileutils.via_tempfile
+    def _save_ora_via_tempfile(self, filename, previous=None, members=None,
+                               **kwargs):
+        """Internal: write a new .ora file, maybe reusing a previous one"""
+        previous_orazip = None
+        previous_members = None
+        if previous is not None:
+            try:
+                previous_orazip = zipfile.ZipFile(previous.path)
+                previous_members = previous.members
+            except (IOError, OSError, zipfile.BadZipfile):
+                logger.exception(
+                    "Cannot reuse layers from %r",
+                    previous.path,
+                )
+        try:
+            return _save_layers_to_new_orazip(
+                self.layer_stack,
+                filename,
+                bbox=tuple(self.get_user_bbox()),
+                xres=self._xres if self._xres else None,
+                yres=self._yres if self._yres else None,
+                frame_active = self.frame_enabled,
+                settings=dict(self._settings),
+                previous_orazip=previous_orazip,
+                previous_members=previous_members,
+                members=members,
+                native_tiles=self.ora_native_tiles,
+                **kwargs
+            )
+        finally:
+            # Must be closed before the file is replaced.
+            if previous_orazip is not None:
+                previous_orazip.close()
+
+    def _get_reusable_ora_save(self, filename, kwargs):
+        """Internal: record of the last save, if it can be reused"""
+        record = self._ora_save_record
+        if record is None:
+            return None
+        if record.path != os.path.realpath(filename):
+            return None
+        if record.options != _ORASaveRecord.options_key(kwargs):
+            return None
+        try:
+            if record.stat != _ORASaveRecord.stat_key(record.path):
+                logger.info("%r was changed since it was saved", filename)
+                return None
+        except OSError:
+            return None
+        return record
+
     def load_ora(self, filename, progress=None, **kwargs):
-        """Loads from an OpenRaster file"""
+        """Loads from an OpenRaster file
+
+        The painting layers' PNGs are decoded in parallel. If
+        `lazy_ora_loading` is true, they're decoded in the background,
+        or when first needed, instead of before this method returns.
+
+        """
         logger.info('load_ora: %r', filename)
         t0 = time.time()
         self.clear()
         cache_dir = self._cache_dir
+        if not progress:
+            progress = lib.feedback.Progress()
+        progress.items = 100
+        decoder = None
+        if self.lazy_ora_loading:
+            if self._lazy_layer_loader is None:
+                self._lazy_layer_loader = _LazyLayerLoader(
+                    self._lazy_load_failed_cb,
+                )
+            kwargs["lazy_loader"] = self._lazy_layer_loader
+            self._lazy_load_source = os.path.abspath(filename)
+        else:
+            decoder = _LayerDecoder()
+            kwargs["lazy_loader"] = decoder
         orazip = zipfile.ZipFile(filename)
         logger.debug('mimetype: %r', orazip.read('mimetype').strip())
         xml = orazip.read('stack.xml')
@@ -1757,15 +2134,24 @@ class Document (object):
         image_xres = max(0, int(image_elem.attrib.get('xres', 0)))
         image_yres = max(0, int(image_elem.attrib.get('yres', 0)))
 
-        # Delegate loading of image data to the layers tree itself
-        self.layer_stack.load_from_openraster(
-            orazip,
-            root_stack_elem,
-            cache_dir,
-            progress,
-            x=0, y=0,
-            **kwargs
-        )
+        # Delegate loading of image data to the layers tree itself.
+        # Painting layers' PNGs are decoded concurrently: wait for them
+        # here unless the layers are to be loaded lazily.
+        try:
+            self.layer_stack.load_from_openraster(
+                orazip,
+                root_stack_elem,
+                cache_dir,
+                progress.open(10 if decoder else 100),
+                x=0, y=0,
+                **kwargs
+            )
+            if decoder:
+                decoder.finish(progress=progress.open(90))
+        finally:
+            if decoder:
+                decoder.cancel()
+                decoder.close()
         assert len(self.layer_stack) > 0
 
         # Resolution information if specified
@@ -1943,6 +2329,10 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None,
                                frame_active=False,
                                progress=None,
                                settings=None,
+                               previous_orazip=None,
+                               previous_members=None,
+                               members=None,
+                               native_tiles=False,
                                **kwargs):
     """Save a root layer stack to a new OpenRaster zipfile
 
@@ -1954,10 +2344,20 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None,
     :param frame_active: True if the frame is enabled
     :param progress: Unsized UI feedback object
     :type progress: lib.feedback.Progress or None
+    :param zipfile.ZipFile previous_orazip: Earlier save to copy from
+    :param dict previous_members: Keyed entries of previous_orazip
+    :param dict members: Output: keyed entries written, for next time
+    :param bool native_tiles: Also save layers as MyPaint tile archives
     :param \*\*kwargs: Passed through to root_stack.save_to_openraster()
     :rtype: GdkPixbuf
     :returns: Thumbnail preview image (256x256 max) of what was saved
 
+    The layer PNGs and the merged image are encoded into memory in
+    parallel by a pool of worker threads, and are added to the zipfile
+    in stack order without going through tempfiles. Layer PNGs which
+    are recorded in previous_members with the same content are copied
+    from previous_orazip instead. See lib.workers.OrderedZipWriter.
+
     >>> from gi.repository import GdkPixbuf
     >>> from lib.layer.test import make_test_stack
     >>> root, leaves = make_test_stack()
@@ -1992,6 +2392,14 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None,
     # The mimetype entry must be first
     helpers.zipfile_writestr(orazip, 'mimetype', lib.xml.OPENRASTER_MEDIA_TYPE)
 
+    # Layers queue their PNGs for encoding by the pool.
+    pool = lib.workers.WorkerPool()
+    writer = lib.workers.OrderedZipWriter(
+        orazip, pool,
+        previous=previous_orazip,
+        previous_members=previous_members,
+    )
+
     # Update the initially-selected flag on all layers
     # Also get the data bounding box as we go
     data_bbox = helpers.Rect()
@@ -2001,7 +2409,7 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None,
         data_bbox.expandToIncludeRect(s_layer.get_bbox())
     data_bbox = tuple(data_bbox)
 
-    # First 90%: save the layer stack
+    # First 10%: queue the layer stack
     image = ET.Element('image')
     if bbox is None:
         bbox = data_bbox
@@ -2010,9 +2418,10 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None,
     image.attrib['h'] = str(h0)
     root_stack_path = ()
     root_stack_elem = root_stack.save_to_openraster(
-        orazip, tempdir, root_stack_path,
+        writer, tempdir, root_stack_path,
         data_bbox, bbox,
-        progress=progress.open(90),
+        progress=progress.open(10),
+        native_tiles=native_tiles,
         **kwargs
     )
     image.append(root_stack_elem)
@@ -2031,7 +2440,7 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None,
         assert isinstance(json_data, bytes)
 
         zip_path = _ORA_JSON_SETTINGS_ZIP_PATH
-        helpers.zipfile_writestr(orazip, zip_path, json_data)
+        helpers.zipfile_writestr(writer, zip_path, json_data)
         image.attrib[_ORA_JSON_SETTINGS_ATTR] = zip_path
 
     # Resolution info
@@ -2042,36 +2451,41 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None,
     # OpenRaster version declaration
     image.attrib["version"] = lib.xml.OPENRASTER_VERSION
 
-    # Last 10%: previews.
+    # Previews.
     # Thumbnail preview (256x256)
     thumbnail = root_stack.render_thumbnail(
         bbox,
         progress=progress.open(1),
     )
-    tmpfile = join(tempdir, 'tmp.png')
-    lib.pixbuf.save(thumbnail, tmpfile, 'png')
-    orazip.write(tmpfile, 'Thumbnails/thumbnail.png')
-    os.remove(tmpfile)
+    writer.writestr_from_job(
+        lambda fp: lib.pixbuf.save(thumbnail, fp, 'png'),
+        helpers.zipfile_info('Thumbnails/thumbnail.png'),
+    )
 
     # Save fully rendered image too
-    tmpfile = os.path.join(tempdir, "mergedimage.png")
-    root_stack.save_as_png(
-        tmpfile, *bbox,
-        alpha=False, background=True,
-        progress=progress.open(9),
-        **kwargs
+    writer.writestr_from_job(
+        lambda fp: root_stack.render_layer_to_png_file(
+            root_stack, fp, bbox=bbox,
+            alpha=False, background=True,
+            **kwargs
+        ),
+        helpers.zipfile_info('mergedimage.png'),
     )
-    orazip.write(tmpfile, 'mergedimage.png')
-    os.remove(tmpfile)
 
     # Prettification
     lib.xml.indent_etree(image)
     xml = ET.tostring(image, encoding='UTF-8')
 
-    # Finalize
-    helpers.zipfile_writestr(orazip, 'stack.xml', xml)
-    orazip.close()
+    # Last 89%: wait for the encoders, writing entries as they finish.
+    helpers.zipfile_writestr(writer, 'stack.xml', xml)
+    try:
+        writer.close(progress=progress.open(89))
+    finally:
+        pool.close()
+        orazip.close()
     os.rmdir(tempdir)
+    if members is not None:
+        members.update(writer.members)
 
     progress.close()
     return thumbnail
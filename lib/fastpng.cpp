@@ -30,6 +30,7 @@
 #include "lcms2.h"
 #include <math.h>
 #include <stdint.h>
+#include <errno.h>
 
 #include "common.hpp"
 #define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
@@ -41,6 +42,16 @@ static void
 png_write_error_callback (png_structp png_save_ptr,
                           png_const_charp error_msg)
 {
+    // libpng may call this while the writer has released the GIL.
+    // The error pointer is the writer's saved thread state.
+    PyThreadState **thread_save
+        = (PyThreadState **)png_get_error_ptr(png_save_ptr);
+    if (thread_save && *thread_save) {
+        int saved_errno = errno;
+        PyEval_RestoreThread(*thread_save);
+        *thread_save = NULL;
+        errno = saved_errno;
+    }
     // we don't trust libpng to call the error callback only once, so
     // check for already-set error
     if (!PyErr_Occurred()) {
@@ -55,6 +66,48 @@ png_write_error_callback (png_structp png_save_ptr,
 }
 
 
+// Output to Python file-like objects without a FILE*, e.g. BytesIO.
+// libpng buffers its output, so this is called once per IDAT chunk.
+
+static void
+png_write_pyfile_callback (png_structp png_save_ptr,
+                           png_bytep data,
+                           png_size_t length)
+{
+    PyObject *file = (PyObject *)png_get_io_ptr(png_save_ptr);
+    PyThreadState **thread_save
+        = (PyThreadState **)png_get_error_ptr(png_save_ptr);
+    PyThreadState *saved = NULL;
+    if (thread_save && *thread_save) {
+        saved = *thread_save;
+        *thread_save = NULL;
+        PyEval_RestoreThread(saved);
+    }
+    bool ok = false;
+    PyObject *buf = PyBytes_FromStringAndSize((const char *)data, length);
+    if (buf) {
+        PyObject *result = PyObject_CallMethod(file, (char *)"write",
+                                               (char *)"O", buf);
+        ok = (result != NULL);
+        Py_XDECREF(result);
+        Py_DECREF(buf);
+    }
+    if (saved) {
+        *thread_save = PyEval_SaveThread();
+    }
+    if (! ok) {
+        // The Python exception is kept by the error callback
+        png_error(png_save_ptr, "Write Error");
+    }
+}
+
+
+static void
+png_flush_pyfile_callback (png_structp png_save_ptr)
+{
+}
+
+
 struct ProgressivePNGWriter::State
 {
     int width;
@@ -64,13 +117,15 @@ struct ProgressivePNGWriter::State
     int y;
     PyObject *file;
     FILE *fp;
+    PyThreadState *thread_save;
 
     State()
         : width(0), height(0),
           png_ptr(NULL), info_ptr(NULL),
           y(0),
           file(NULL),
-          fp(NULL)
+          fp(NULL),
+          thread_save(NULL)
     { }
 
     ~State() {
@@ -79,6 +134,21 @@ struct ProgressivePNGWriter::State
 
     bool check_valid();
 
+    // Encoding and file writes run without the GIL, so that several
+    // PNGs can be written in parallel by worker threads.
+
+    void release_gil() {
+        assert(thread_save == NULL);
+        thread_save = PyEval_SaveThread();
+    }
+
+    void acquire_gil() {
+        if (thread_save) {
+            PyEval_RestoreThread(thread_save);
+            thread_save = NULL;
+        }
+    }
+
     void cleanup() {
         if (png_ptr || info_ptr) {
             png_destroy_write_struct(&png_ptr, &info_ptr);
@@ -131,7 +201,9 @@ ProgressivePNGWriter::State::check_valid()
 ProgressivePNGWriter::ProgressivePNGWriter(PyObject *file,
                                            const int w, const int h,
                                            const bool has_alpha,
-                                           const bool save_srgb_chunks)
+                                           const bool save_srgb_chunks,
+                                           const int compression_level,
+                                           const int filters)
     : state(new ProgressivePNGWriter::State())
 {
     state->width = w;
@@ -144,31 +216,39 @@ ProgressivePNGWriter::ProgressivePNGWriter(PyObject *file,
     state->file = file;
     Py_INCREF(file);
 
+    // Real files are written through their FILE*. Other objects with
+    // a write() method, like io.BytesIO or streams from
+    // ZipFile.open(), are written through Python calls.
+    FILE *fp = NULL;
+    bool use_write_method = false;
 #if PY_MAJOR_VERSION >= 3
     // See https://docs.python.org/3.5/c-api/file.html
     // Also https://stackoverflow.com/a/40598787
     int fd = PyObject_AsFileDescriptor(file);
     if (fd == -1) {
-        PyErr_SetString(
-            PyExc_TypeError,
-            "file arg is not an int, or it has no fileno() method"
-        );
-        state->cleanup();
-        return;
+        PyErr_Clear();
+        use_write_method = true;
+    }
+    else {
+        fp = fdopen(fd, "w");
     }
-    FILE *fp = fdopen(fd, "w");
 #else
-    if (! PyFile_Check(file)) {
+    if (PyFile_Check(file)) {
+        fp = PyFile_AsFile(file);
+    }
+    else {
+        use_write_method = true;
+    }
+#endif
+    if (use_write_method && ! PyObject_HasAttrString(file, "write")) {
         PyErr_SetString(
             PyExc_TypeError,
-            "file arg must be a builtin file object"
+            "file arg has no fileno() or write() method"
         );
         state->cleanup();
         return;
     }
-    FILE *fp = PyFile_AsFile(file);
-#endif
-    if (!fp) {
+    if (!fp && !use_write_method) {
         PyErr_SetString(
             PyExc_TypeError,
             "file arg has no file descriptor or FILE* associated with it"
@@ -179,7 +259,7 @@ ProgressivePNGWriter::ProgressivePNGWriter(PyObject *file,
     state->fp = fp;
 
     png_ptr = png_create_write_struct (PNG_LIBPNG_VER_STRING,
-                                       (png_voidp)NULL,
+                                       (png_voidp)&state->thread_save,
                                        png_write_error_callback,
                                        NULL);
     if (!png_ptr) {
@@ -208,7 +288,14 @@ ProgressivePNGWriter::ProgressivePNGWriter(PyObject *file,
         return;
     }
 
-    png_init_io(png_ptr, fp);
+    if (fp) {
+        png_init_io(png_ptr, fp);
+    }
+    else {
+        png_set_write_fn(png_ptr, (png_voidp)file,
+                         png_write_pyfile_callback,
+                         png_flush_pyfile_callback);
+    }
 
     png_set_IHDR (png_ptr, info_ptr,
                   w, h, bpc,
@@ -224,15 +311,19 @@ ProgressivePNGWriter::ProgressivePNGWriter(PyObject *file,
                                     PNG_sRGB_INTENT_PERCEPTUAL);
     }
 
-    // default (all filters enabled):                 1350ms, 3.4MB
-    //png_set_filter(png_ptr, 0, PNG_FILTER_NONE);  // 790ms, 3.8MB
-    //png_set_filter(png_ptr, 0, PNG_FILTER_PAETH); // 980ms, 3.5MB
-    png_set_filter(png_ptr, 0, PNG_FILTER_SUB);     // 760ms, 3.4MB
+    // Filters, with typical timings and sizes:
+    //   PNG_FILTER_ALL (libpng's default):    1350ms, 3.4MB
+    //   PNG_FILTER_NONE:                       790ms, 3.8MB
+    //   PNG_FILTER_PAETH:                      980ms, 3.5MB
+    //   PNG_FILTER_SUB (our default):          760ms, 3.4MB
+    png_set_filter(png_ptr, 0, filters & PNG_ALL_FILTERS);
 
-    //png_set_compression_level(png_ptr, 0); // 0.49s, 32MB
-    //png_set_compression_level(png_ptr, 1); // 0.98s, 9.6MB
-    png_set_compression_level(png_ptr, 2);   // 1.08s, 9.4MB
-    //png_set_compression_level(png_ptr, 9); // 18.6s, 9.3MB
+    // Compression levels:
+    //   0: 0.49s, 32MB
+    //   1: 0.98s, 9.6MB
+    //   2: 1.08s, 9.4MB (our default)
+    //   9: 18.6s, 9.3MB
+    png_set_compression_level(png_ptr, compression_level);
 
     png_write_info(png_ptr, info_ptr);
 
@@ -294,6 +385,7 @@ ProgressivePNGWriter::write(PyObject *arr_obj)
     assert(PyArray_STRIDE(arr, 2) == 1);
 
     if (setjmp(png_jmpbuf(state->png_ptr))) {
+        state->acquire_gil();
         if (PyErr_Occurred()) {
             state->cleanup();
             return NULL;
@@ -306,19 +398,19 @@ ProgressivePNGWriter::write(PyObject *arr_obj)
     rowstride = PyArray_STRIDE(arr, 0);
     rowdata = (png_bytep)PyArray_DATA(arr);
     row_p = (png_bytep)rowdata;
+    if (state->y + rowcount > state->height) {
+        err_type = PyExc_RuntimeError;
+        err_text = "too many pixel rows written";
+        goto errexit;
+    }
+    // The caller's array reference keeps the strip alive meanwhile.
+    state->release_gil();
     for (row=0; row<rowcount; row++) {
         png_write_row(state->png_ptr, row_p);
-        if (! state->check_valid()) {
-            state->cleanup();
-            return NULL;
-        }
         row_p += rowstride;
-        if (++(state->y) > state->height) {
-            err_type = PyExc_RuntimeError;
-            err_text = "too many pixel rows written";
-            goto errexit;
-        }
+        state->y++;
     }
+    state->acquire_gil();
     Py_RETURN_NONE;
 
   errexit:
@@ -348,11 +440,16 @@ ProgressivePNGWriter::close()
         return NULL;
     }
     if (setjmp(png_jmpbuf(state->png_ptr))) {
+        state->acquire_gil();
         state->cleanup();
-        PyErr_SetString(PyExc_RuntimeError, "libpng error during close()");
+        if (! PyErr_Occurred()) {
+            PyErr_SetString(PyExc_RuntimeError, "libpng error during close()");
+        }
         return NULL;
     }
+    state->release_gil();
     png_write_end (state->png_ptr, NULL);
+    state->acquire_gil();
     if (state->y != state->height) {
         state->cleanup();
         PyErr_SetString(
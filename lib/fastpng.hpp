@@ -21,7 +21,10 @@
 #include <Python.h>
 
 
-// Writes a PNG file progressively in strips
+// Writes a PNG file progressively in strips.
+// The file may be a real file, or any object with a write() method.
+// The zlib compression level and the row filters (a mask of libpng's
+// PNG_FILTER_* flags, default PNG_FILTER_SUB) can be chosen.
 
 class ProgressivePNGWriter
 {
@@ -29,7 +32,9 @@ public:
     ProgressivePNGWriter(PyObject *file,
                          const int w, const int h,
                          const bool has_alpha,
-                         const bool save_srgb_chunks);
+                         const bool save_srgb_chunks,
+                         const int compression_level = 2,
+                         const int filters = 0x10);
     PyObject *write(PyObject *arr);  // write a h*w*4 uint8 numpy array
     PyObject *close();   // finalize write
     ~ProgressivePNGWriter();
@@ -438,6 +438,22 @@ def hsv_to_rgb(h, s, v):
     return colorsys.hsv_to_rgb(h, s, v)
 
 
+def zipfile_info(arcname):
+    """Make a zipfile entry's info, with standard permissions
+
+    :param unicode arcname: Name of the file entry.
+    :rtype: zipfile.ZipInfo
+
+    >>> oct(zipfile_info("a.png").external_attr >> 16)[-6:]
+    '100644'
+
+    """
+    zi = zipfile.ZipInfo(arcname)
+    zi.external_attr = 0o644 << 16  # wider perms, should match z.write()
+    zi.external_attr |= 0o100000 << 16  # regular file
+    return zi
+
+
 def zipfile_writestr(z, arcname, data):
     """Write a string into a zipfile entry, with standard permissions
 
@@ -451,10 +467,7 @@ def zipfile_writestr(z, arcname, data):
     more public permissions than the fix's 0600?
 
     """
-    zi = zipfile.ZipInfo(arcname)
-    zi.external_attr = 0o644 << 16  # wider perms, should match z.write()
-    zi.external_attr |= 0o100000 << 16  # regular file
-    z.writestr(zi, data)
+    z.writestr(zipfile_info(arcname), data)
 
 
 def run_garbage_collector():
@@ -709,6 +709,22 @@ class LayerBase (Renderable):
         """
         return []
 
+    def has_tile_data(self, tx, ty, mipmap_level=0):
+        """Cheap test for whether a tile of this layer may contain data
+
+        :param int tx: Tile X coordinate
+        :param int ty: Tile Y coordinate
+        :param int mipmap_level: Mipmap level to test
+        :rtype: bool
+
+        Renderers use this to skip work for empty areas of the layer,
+        so it must never return False if there is data to render.
+        False positives are allowed, and it should be very fast.
+
+        The base implementation always returns True.
+        """
+        return True
+
     ## Translation
 
     def get_move(self, x, y):
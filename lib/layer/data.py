@@ -15,6 +15,7 @@
 from __future__ import division, print_function
 
 import zlib
+import io
 import logging
 import os
 import time
@@ -75,6 +76,17 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
     #: Substitute content if the layer cannot be loaded.
     FALLBACK_CONTENT = None
 
+    #: The surface can be decoded lazily by a load_from_openraster()
+    #: "lazy_loader". See lib.document.Document.lazy_ora_loading.
+    LAZY_LOADABLE = False
+
+    #: The surface can be saved as a tile archive, which loads far
+    #: faster than a PNG. See lib.tiledsurface.TileArchiveWriter.
+    NATIVE_TILES = False
+
+    #: Extension attribute naming a layer's tile archive.
+    ORA_TILES_ATTR = "{%s}tiles" % (lib.xml.OPENRASTER_MYPAINT_NS,)
+
     ## Initialization
 
     def __init__(self, surface=None, **kwargs):
@@ -97,6 +109,10 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         else:
             self._surface = surface
 
+        # Record of the last autosaved tile archive, for updating it
+        # with just the changed tiles. Set from the autosave thread.
+        self._autosave_tiles = None
+
     @classmethod
     def new_from_surface_backed_layer(cls, src):
         """Clone from another SurfaceBackedLayer
@@ -165,6 +181,19 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
             x, y,
             self.__class__.__name__,
         )
+        # Prefer the tile archive, if there is one
+        tiles_src = attrs.get(self.ORA_TILES_ATTR, None)
+        if tiles_src and self.NATIVE_TILES:
+            loaded = self._load_surface_from_tile_archive(
+                tiles_src,
+                lambda surf: surf.load_from_tile_archive(
+                    orazip.read(tiles_src), x, y,
+                ),
+            )
+            if loaded:
+                if progress:
+                    progress.close()
+                return
         suffixes = self.ALLOWED_SUFFIXES
         if ("" not in suffixes) and (src_ext not in suffixes):
             logger.debug(
@@ -177,6 +206,19 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
             raise lib.layer.error.LoadingFailed(
                 "Only %r are supported" % (suffixes,),
             )
+        # Decode the PNG later, if possible
+        lazy_loader = kwargs.get("lazy_loader")
+        if lazy_loader is not None and self.LAZY_LOADABLE:
+            try:
+                data = orazip.read(src)
+            except KeyError:
+                # Bad zip files written by old GIMP ORA plugins.
+                # See lib.pixbuf.load_from_zipfile().
+                data = orazip.read(src.encode("utf-8"))
+            lazy_loader.queue(self._surface, data, x, y)
+            if progress:
+                progress.close()
+            return
         # Delegate the actual loading part
         self._load_surface_from_orazip_member(
             orazip,
@@ -227,6 +269,19 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
             x, y,
             self.__class__.__name__,
         )
+        # Prefer the tile archive, if there is one
+        tiles_src = attrs.get(self.ORA_TILES_ATTR, None)
+        if tiles_src and self.NATIVE_TILES:
+            loaded = self._load_surface_from_tile_archive(
+                tiles_src,
+                lambda surf: surf.load_from_tile_archive_file(
+                    os.path.join(oradir, tiles_src), x, y,
+                ),
+            )
+            if loaded:
+                if progress:
+                    progress.close()
+                return
         suffixes = self.ALLOWED_SUFFIXES
         if ("" not in suffixes) and (src_ext not in suffixes):
             logger.debug(
@@ -262,6 +317,27 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
             progress,
         )
 
+    def _load_surface_from_tile_archive(self, src, load_func):
+        """Internal: try to load the surface from a tile archive
+
+        :param unicode src: Name of the archive, for messages.
+        :param callable load_func: Called as load_func(surface) to
+            load the archive into a new tiled surface.
+        :returns: True if the surface was loaded.
+
+        The caller should fall back to loading the layer's PNG if this
+        fails.
+
+        """
+        surface = tiledsurface.Surface()
+        try:
+            load_func(surface)
+        except (EnvironmentError, KeyError, ValueError):
+            logger.exception("Failed to load tile archive %r", src)
+            return False
+        self.load_from_surface(surface)
+        return True
+
     def load_surface_from_pixbuf_file(self, filename, x=0, y=0,
                                       progress=None):
         """Loads the layer's surface from any file which GdkPixbuf can open"""
@@ -337,6 +413,9 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
     def get_tile_coords(self):
         return self._surface.get_tiles().keys()
 
+    def has_tile_data(self, tx, ty, mipmap_level=0):
+        return self._surface.has_tile_data(tx, ty, mipmap_level)
+
     def get_render_ops(self, spec):
         """Get rendering instructions."""
 
@@ -368,7 +447,7 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
                 rendering.Opcode.COMPOSITE, self._surface, mode_default, 1.0,
             ))
             ops.extend(spec.current_overlay.get_render_ops(spec))
-            ops.append(rendering.Opcode.POP, None, mode, opacity)
+            ops.append((rendering.Opcode.POP, None, mode, opacity))
         else:
             # The 99%+ case☺
             ops.append((
@@ -411,6 +490,34 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
     def queue_autosave(self, oradir, taskproc, manifest, bbox, **kwargs):
         """Queues the layer for auto-saving"""
 
+        # If allowed, write a tile archive instead of a PNG, since only
+        # MyPaint reads autosaves. Its stored origin is always (0, 0),
+        # so the offset for the bbox goes in the <layer/> element.
+        # Archives are updated in place with just the tiles which have
+        # changed since the last autosave.
+        native_tiles = kwargs.pop("native_tiles", False)
+        if native_tiles and self.NATIVE_TILES:
+            tiles_basename = (self.autosave_uuid
+                              + tiledsurface.TILE_ARCHIVE_SUFFIX)
+            tiles_relpath = os.path.join("data", tiles_basename)
+            tiles_path = os.path.join(oradir, tiles_relpath)
+            if self.autosave_dirty or not os.path.exists(tiles_path):
+                task = tiledsurface.TileArchiveUpdateTask(
+                    surface = self._surface,
+                    filename = tiles_path,
+                    origin = (0, 0),
+                    previous = self._autosave_tiles,
+                    on_written = self._autosave_tiles_written_cb,
+                )
+                taskproc.add_work(task)
+                self.autosave_dirty = False
+            ref_x, ref_y = bbox[0:2]
+            manifest.add(tiles_relpath)
+            elem = self._get_stackxml_element("layer", -ref_x, -ref_y)
+            elem.attrib["src"] = tiles_relpath
+            elem.attrib[self.ORA_TILES_ATTR] = tiles_relpath
+            return elem
+
         # Queue up a task which writes the surface as a PNG. This will
         # be the file that's indexed by the <layer/>'s @src attribute.
         #
@@ -450,6 +557,10 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         elem.attrib["src"] = png_relpath
         return elem
 
+    def _autosave_tiles_written_cb(self, record):
+        """Internal: record the autosaved tile archive's new layout"""
+        self._autosave_tiles = record
+
     @staticmethod
     def _make_refname(prefix, path, suffix, sep='-'):
         """Internal: standardized filename for something with a path"""
@@ -461,18 +572,21 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
 
     def _save_rect_to_ora(self, orazip, tmpdir, prefix, path,
                           frame_bbox, rect, progress=None, **kwargs):
-        """Internal: saves a rectangle of the surface to an ORA zip"""
-        # Write PNG data via a tempfile
+        """Internal: saves a rectangle of the surface to an ORA zip
+
+        If the "native_tiles" keyword arg is true, the surface is also
+        saved as a tile archive, for faster loading by MyPaint.
+
+        """
+        native_tiles = kwargs.pop("native_tiles", False)
         pngname = self._make_refname(prefix, path, ".png")
         pngpath = os.path.join(tmpdir, pngname)
-        t0 = time.time()
-        self._surface.save_as_png(pngpath, *rect, progress=progress, **kwargs)
-        t1 = time.time()
-        logger.debug('%.3fs surface saving %r', t1 - t0, pngname)
-        # Archive and remove
         storepath = "data/%s" % (pngname,)
-        orazip.write(pngpath, storepath)
-        os.remove(pngpath)
+        self._write_png_to_ora(
+            orazip, pngpath, storepath, rect,
+            progress=progress,
+            **kwargs
+        )
         # Return details
         png_bbox = tuple(rect)
         png_x, png_y = png_bbox[0:2]
@@ -482,8 +596,86 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         assert (x == y == 0) or not self._surface.looped
         elem = self._get_stackxml_element("layer", x, y)
         elem.attrib["src"] = storepath
+        # Tile archive, as an extension
+        if native_tiles and self.NATIVE_TILES:
+            tilesname = self._make_refname(
+                prefix, path,
+                tiledsurface.TILE_ARCHIVE_SUFFIX,
+            )
+            tiles_storepath = "data/%s" % (tilesname,)
+            self._write_tiles_to_ora(orazip, tiles_storepath, png_bbox)
+            elem.attrib[self.ORA_TILES_ATTR] = tiles_storepath
         return elem
 
+    def _write_tiles_to_ora(self, orazip, storepath, rect):
+        """Internal: writes the surface as a tile archive, & archives it
+
+        The archive's origin is the top left of rect. Like the PNGs,
+        archives are written in worker threads by OrderedZipWriters,
+        and can be copied from the previous save.
+
+        """
+        origin = tuple(rect[0:2])
+        zinfo = helpers.zipfile_info(storepath)
+        if not hasattr(orazip, "writestr_from_job"):
+            fp = io.BytesIO()
+            self._surface.save_as_tile_archive(fp, origin)
+            orazip.writestr(zinfo, fp.getvalue())
+            return
+        stamp = self._surface.get_content_stamp()
+        key = ("tiles", origin, stamp)
+        if orazip.reuse_member(key, zinfo):
+            return
+        tiledict = self._surface.save_snapshot().tiledict
+        orazip.writestr_from_job(
+            tiledsurface.write_tile_archive,
+            zinfo,
+            tiledict,
+            origin,
+        )
+        orazip.record_member(key, zinfo)
+
+    def _write_png_to_ora(self, orazip, pngpath, storepath, rect,
+                          progress=None, **kwargs):
+        """Internal: writes a rectangle as PNG, & archives it
+
+        If orazip is a lib.workers.OrderedZipWriter, the PNG is encoded
+        straight into memory in one of its worker threads, and the
+        progress object is just closed: it mustn't be updated from
+        outside the main thread. Otherwise, the PNG is written via the
+        tempfile at pngpath.
+
+        The writer can also copy the PNG from the previous save of the
+        same document if the surface hasn't changed since then.
+
+        """
+        def _write_png(fp, progress=None):
+            t0 = time.time()
+            self._surface.save_as_png(
+                fp, *rect,
+                progress=progress,
+                **kwargs
+            )
+            t1 = time.time()
+            logger.debug('%.3fs surface saving %r', t1 - t0, storepath)
+
+        if hasattr(orazip, "writestr_from_job"):
+            zinfo = helpers.zipfile_info(storepath)
+            key = None
+            if hasattr(self._surface, "get_content_stamp"):
+                stamp = self._surface.get_content_stamp()
+                key = ("png", tuple(rect), stamp)
+            if key is None or not orazip.reuse_member(key, zinfo):
+                orazip.writestr_from_job(_write_png, zinfo)
+                if key is not None:
+                    orazip.record_member(key, zinfo)
+            if progress:
+                progress.close()
+            return
+        _write_png(pngpath, progress=progress)
+        orazip.write(pngpath, storepath)
+        os.remove(pngpath)
+
     ## Painting symmetry axis
 
     def set_symmetry_state(self, active, center_x, center_y,
@@ -1061,21 +1253,13 @@ class BackgroundLayer (SurfaceBackedLayer):
 
         pngname = self._make_refname("background", path, "tile.png")
         tmppath = os.path.join(tmpdir, pngname)
-        t0 = time.time()
-        self._surface.save_as_png(
-            tmppath,
-            x=x + x0,
-            y=y + y0,
-            w=w,
-            h=h,
+        storename = 'data/%s' % (pngname,)
+        self._write_png_to_ora(
+            orazip, tmppath, storename,
+            (x + x0, y + y0, w, h),
             progress=progress.open(),
             **kwargs
         )
-        t1 = time.time()
-        storename = 'data/%s' % (pngname,)
-        logger.debug('%.3fs surface saving %s', t1 - t0, storename)
-        orazip.write(tmppath, storename)
-        os.remove(tmppath)
         elem.attrib[self.ORA_BGTILE_LEGACY_ATTR] = storename
         elem.attrib[self.ORA_BGTILE_ATTR] = storename
 
@@ -1272,6 +1456,10 @@ class SimplePaintingLayer (SurfaceBackedLayer):
 
     ALLOWED_SUFFIXES = [".png"]
 
+    LAZY_LOADABLE = True
+
+    NATIVE_TILES = True
+
     # TRANSLATORS: Default name for new normal, paintable layers
     DEFAULT_NAME = C_(
         "layer default names",
@@ -1422,11 +1610,13 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
         #: List of strokemap.StrokeShape instances (not stroke.Stroke),
         #: ordered by depth.
         self.strokes = []
+        self._stroke_index = None  # see _get_stroke_index()
 
     def clear(self):
         """Clear both the surface and the strokemap"""
         super(StrokemappedPaintingLayer, self).clear()
         self.strokes = []
+        self._stroke_index = None
 
     def load_from_surface(self, surface):
         """Load the surface image's tiles from another surface"""
@@ -1445,7 +1635,11 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
             x=x, y=y,
             **kwargs
         )
-        self._load_strokemap_from_ora(elem, x, y, orazip=orazip)
+        self._load_strokemap_from_ora(
+            elem, x, y,
+            orazip=orazip,
+            brush_table=kwargs.get("brush_table"),
+        )
 
     def load_from_openraster_dir(self, oradir, elem, cache_dir, progress,
                                  x=0, y=0, **kwargs):
@@ -1459,9 +1653,14 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
             x=x, y=y,
             **kwargs
         )
-        self._load_strokemap_from_ora(elem, x, y, oradir=oradir)
+        self._load_strokemap_from_ora(
+            elem, x, y,
+            oradir=oradir,
+            brush_table=kwargs.get("brush_table"),
+        )
 
-    def _load_strokemap_from_ora(self, elem, x, y, orazip=None, oradir=None):
+    def _load_strokemap_from_ora(self, elem, x, y, orazip=None, oradir=None,
+                                 brush_table=None):
         """Load the strokemap from a layer elem & an ora{zip|dir}."""
         attrs = elem.attrib
         x += int(attrs.get('x', 0))
@@ -1488,11 +1687,11 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
             else:
                 ioclass = StringIO
             sio = ioclass(orazip.read(strokemap_name))
-            self._load_strokemap_from_file(sio, x, y)
+            self._load_strokemap_from_file(sio, x, y, brush_table)
             sio.close()
         elif oradir:
             with open(os.path.join(oradir, strokemap_name), "rb") as sfp:
-                self._load_strokemap_from_file(sfp, x, y)
+                self._load_strokemap_from_file(sfp, x, y, brush_table)
         else:
             raise ValueError("either orazip or oradir must be specified")
 
@@ -1523,13 +1722,33 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
 
         """
         after_sshot = self._surface.save_snapshot()
+        pool = None
+        if self.root is not None:
+            pool = self.root.render_workers
         shape = lib.strokemap.StrokeShape.new_from_snapshots(
             before.surface_sshot,
             after_sshot,
+            brush_table=self._get_brush_table(),
+            pool=pool,
         )
         if shape is not None:
             shape.brush_string = stroke.brush_settings
+            index = self._get_stroke_index(build=False)
             self.strokes.append(shape)
+            if index is not None:
+                _add_to_stroke_index(index, shape)
+                self._stroke_index = self._stroke_index_key() + (index,)
+
+    def _get_brush_table(self):
+        """Internal: the document's table of stroke brush settings.
+
+        :returns: The root's BrushTable, or None if the layer has no root.
+
+        """
+        root = self.root
+        if root is None:
+            return None
+        return root.brush_table
 
     ## Snapshots
 
@@ -1555,12 +1774,18 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
         for stroke in empty_strokes:
             logger.debug("Removing emptied stroke %r", stroke)
             self.strokes.remove(stroke)
+        self._stroke_index = None
 
     ## Strokemap load and save
 
-    def _load_strokemap_from_file(self, f, translate_x, translate_y):
+    def _load_strokemap_from_file(self, f, translate_x, translate_y,
+                                  brush_table=None):
         assert not self.strokes
-        brushes = []
+        if brush_table is None:
+            brush_table = self._get_brush_table()
+        if brush_table is None:
+            brush_table = lib.strokemap.BrushTable()
+        brush_ids = []
         x = int(translate_x // N) * N
         y = int(translate_y // N) * N
         dx = translate_x % N
@@ -1570,13 +1795,14 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
             if t == b"b":
                 length, = struct.unpack('>I', f.read(4))
                 tmp = f.read(length)
-                brushes.append(zlib.decompress(tmp))
+                brush = zlib.decompress(tmp)
+                brush_ids.append(brush_table.intern(brush))
             elif t == b"s":
                 brush_id, length = struct.unpack('>II', f.read(2 * 4))
-                stroke = lib.strokemap.StrokeShape()
+                stroke = lib.strokemap.StrokeShape(brush_table=brush_table)
                 tmp = f.read(length)
                 stroke.init_from_string(tmp, x, y)
-                stroke.brush_string = brushes[brush_id]
+                stroke.brush_id = brush_ids[brush_id]
                 # Translate non-aligned strokes
                 if (dx, dy) != (0, 0):
                     stroke.translate(dx, dy)
@@ -1586,13 +1812,20 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
             else:
                 errmsg = "Invalid strokemap (initial char=%r)" % (t,)
                 raise ValueError(errmsg)
+        self._stroke_index = None
 
     ## Strokemap querying
 
     def get_stroke_info_at(self, x, y):
-        """Get the stroke at the given point"""
+        """Get the stroke at the given point
+
+        Only the strokes which may touch the point's tile are tested,
+        newest first.
+
+        """
         x, y = int(x), int(y)
-        for s in reversed(self.strokes):
+        index = self._get_stroke_index()
+        for s in reversed(index.get((x // N, y // N), ())):
             if s.touches_pixel(x, y):
                 return s
 
@@ -1601,6 +1834,38 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
             return None
         return self.strokes[-1]
 
+    def _stroke_index_key(self):
+        """Internal: what the stroke index was built from."""
+        strokes = self.strokes
+        return (strokes, len(strokes), strokes and strokes[-1] or None)
+
+    def _get_stroke_index(self, build=True):
+        """Internal: get the strokemap's tile index
+
+        :param bool build: Build the index if it isn't current.
+        :returns: {(tx, ty): [StrokeShape, ...]}, or None.
+
+        Each list holds the strokes which may touch the tile, in
+        painting order. The index is updated when strokes are added.
+        It's rebuilt when first needed after the strokes list is
+        replaced or changed in other ways, or after the strokes are
+        trimmed or moved.
+
+        """
+        cached = self._stroke_index
+        if cached is not None:
+            strokes, n, last, index = cached
+            key = self._stroke_index_key()
+            if strokes is key[0] and n == key[1] and last is key[2]:
+                return index
+        if not build:
+            return None
+        index = {}
+        for shape in self.strokes:
+            _add_to_stroke_index(index, shape)
+        self._stroke_index = self._stroke_index_key() + (index,)
+        return index
+
     ## Saving
 
     def save_to_openraster(self, orazip, tmpdir, path,
@@ -1708,6 +1973,16 @@ class PaintingLayer (StrokemappedPaintingLayer, core.ExternallyEditable):
 
 ## Stroke-mapped layer implementation details and helpers
 
+def _add_to_stroke_index(index, shape):
+    """Add a StrokeShape to a layer's strokemap tile index."""
+    for ti in shape.tile_indices:
+        strokes = index.get(ti)
+        if strokes is None:
+            index[ti] = [shape]
+        else:
+            strokes.append(shape)
+
+
 def _write_strokemap(f, strokes, dx, dy):
     brush2id = {}
     for stroke in strokes:
@@ -1718,12 +1993,15 @@ def _write_strokemap(f, strokes, dx, dy):
 def _write_strokemap_stroke(f, stroke, brush2id, dx, dy):
 
     # save brush (if not already recorderd)
-    b = stroke.brush_string
-    if b not in brush2id:
-        brush2id[b] = len(brush2id)
+    # Keyed by table entry: the strings are interned, so this is the
+    # same as keying by content, without hashing them.
+    key = (stroke.brush_table, stroke.brush_id)
+    if key not in brush2id:
+        brush2id[key] = len(brush2id)
+        b = stroke.brush_string
         if isinstance(b, unicode):
             b = b.encode("utf-8")
-        b = zlib.compress(b)
+        b = zlib.compress(b, 9)
         f.write(b'b')
         f.write(struct.pack('>I', len(b)))
         f.write(b)
@@ -1731,7 +2009,7 @@ def _write_strokemap_stroke(f, stroke, brush2id, dx, dy):
     # save stroke
     s = stroke.save_to_string(dx, dy)
     f.write(b's')
-    f.write(struct.pack('>II', brush2id[stroke.brush_string], len(s)))
+    f.write(struct.pack('>II', brush2id[key], len(s)))
     f.write(s)
 
 
@@ -1816,6 +2094,7 @@ class StrokemappedPaintingLayerMove (SurfaceBackedLayerMove):
             # further layer moves. This can cause apparent hangs for no
             # reason later on. Perhaps it would be better to process them
             # fully in this hourglass-cursor phase after all?
+        self._layer._stroke_index = None
         # The tile memory is the canonical source of a painting layer,
         # so we'll need to autosave it.
         self._layer.autosave_dirty = True
@@ -390,6 +390,13 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
     def is_empty(self):
         return len(self._layers) == 0
 
+    def has_tile_data(self, tx, ty, mipmap_level=0):
+        """True if any child layer may have data at a tile"""
+        for layer in self._layers:
+            if layer.has_tile_data(tx, ty, mipmap_level):
+                return True
+        return False
+
     @property
     def effective_opacity(self):
         """The opacity used when compositing a layer: zero if invisible"""
@@ -448,7 +455,7 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
 
         ops = []
         if isolate_child_layers:
-            ops.append((Opcode.PUSH, None, None, None))
+            ops.append((Opcode.PUSH, self, None, None))
         for child_layer in reversed(self._layers):
             ops.extend(child_layer.get_render_ops(spec))
         if isolate_child_layers:
@@ -15,7 +15,15 @@ and its "render_*()" methods.
 
 # Imports:
 
+from __future__ import division, print_function
+
 import abc
+import threading
+
+import numpy as np
+
+import lib.mypaintlib
+import lib.modes
 
 
 # Public constants:
@@ -33,7 +41,9 @@ class Opcode:
 
     #: Push an empty tile onto the isolation stack.
     #: This creates a new isolated backdrop for later ops.
-    #: Format: (PUSH, None, None, opacity)
+    #: Format: (PUSH, <Renderable or None>, None, None)
+    #: If the data supports has_tile_data(), the renderer may use it
+    #: to skip the whole group down to its POP where it has no data.
     PUSH = 3
 
     #: Pop the isolation stack & composite the removed tile.
@@ -138,3 +148,202 @@ class Renderable:
         See lib.layer.rendering.Opcode for details.
 
         """
+
+
+class Program (object):
+    """A flat ops list, lowered once for fast per-tile execution.
+
+    Programs are built from the output of Renderable.get_render_ops().
+    Construction validates the op sequence, and packs its opcodes,
+    modes and opacities into arrays. Executing the program for a tile
+    then needs only a quick gather of the source tiles, and a single
+    native call which runs the whole op sequence with the GIL released.
+    The tiles used for the isolation stack (PUSH/POP) are preallocated,
+    once per program per rendering thread.
+
+    Native execution requires every COMPOSITE and BLIT source to support
+    get_render_src_tile(), as lib.tiledsurface.MyPaintSurface does.
+    Programs containing other kinds of sources are interpreted in
+    Python instead, with the same results.
+
+    Sparse documents are cheap to render: sources without data at a
+    tile are skipped without touching pixels, and so are entire
+    isolated groups whose PUSH data reports no data there via
+    has_tile_data(), provided the group's mode leaves its backdrop
+    alone when the group is fully transparent.
+
+    """
+
+    _TILE_SHAPE = (lib.mypaintlib.TILE_SIZE, lib.mypaintlib.TILE_SIZE, 4)
+
+    def __init__(self, ops):
+        """Compile a program from a flat sequence of ops.
+
+        :param iterable ops: ops list from get_render_ops().
+        :raises ValueError: if the ops list is malformed.
+
+        """
+        super(Program, self).__init__()
+        self.ops = list(ops)
+        nops = len(self.ops)
+        self._opcodes = np.zeros((nops,), dtype='int32')
+        self._modes = np.zeros((nops,), dtype='int32')
+        self._opacities = np.zeros((nops,), dtype='float32')
+        self._fetchers = [None] * nops
+        self._native = True
+        self._prunable_groups = []  # [(push_i, pop_i, has_tile_data)]
+        pushes = []
+        max_depth = 0
+        for i, (opcode, opdata, mode, opacity) in enumerate(self.ops):
+            if opcode == Opcode.PUSH:
+                has_data = getattr(opdata, "has_tile_data", None)
+                if has_data is None:
+                    # Anonymous isolated content, e.g. an overlay:
+                    # enclosing groups can't vouch for it.
+                    for push in pushes:
+                        push[1] = None
+                pushes.append([i, has_data])
+                max_depth = max(len(pushes), max_depth)
+            elif opcode == Opcode.POP:
+                if not pushes:
+                    raise ValueError(
+                        "Ops list contains more POP operations "
+                        "than PUSHes."
+                    )
+                push_i, has_data = pushes.pop(-1)
+                if has_data is not None and self._mode_skippable(mode):
+                    self._prunable_groups.append((push_i, i, has_data))
+            elif opcode in (Opcode.COMPOSITE, Opcode.BLIT):
+                fetcher = getattr(opdata, "get_render_src_tile", None)
+                if fetcher is None:
+                    self._native = False
+                elif opcode == Opcode.BLIT or opacity != 0:
+                    self._fetchers[i] = fetcher
+            else:
+                raise ValueError(
+                    "Unknown lib.layer.rendering.Opcode: %r"
+                    % (opcode,),
+                )
+            self._opcodes[i] = opcode
+            if mode is not None:
+                self._modes[i] = mode
+            if opacity is not None:
+                self._opacities[i] = opacity
+        if pushes:
+            raise ValueError(
+                "Ops list contains more PUSH operations "
+                "than POPs. Rendering is incomplete."
+            )
+        self._prunable_groups.sort()
+        self._stack_depth = max(1, max_depth)
+        self._per_thread = threading.local()
+
+    def __repr__(self):
+        return "<Program ops=%d depth=%d native=%r>" % (
+            len(self.ops),
+            self._stack_depth,
+            self._native,
+        )
+
+    def __len__(self):
+        return len(self.ops)
+
+    @staticmethod
+    def _mode_skippable(mode):
+        """True if compositing all-transparent data in a mode is a no-op."""
+        if mode in lib.modes.MODES_EFFECTIVE_AT_ZERO_ALPHA:
+            return False
+        if mode in lib.modes.MODES_CLEARING_BACKDROP_AT_ZERO_ALPHA:
+            return False
+        return True
+
+    def _get_skips(self, tx, ty, mipmap_level):
+        """Get the (push_i, pop_i) ranges of groups empty at a tile."""
+        skips = []
+        skip_end = -1
+        for (push_i, pop_i, has_data) in self._prunable_groups:
+            if push_i < skip_end:
+                continue  # inside a group which is already skipped
+            if not has_data(tx, ty, mipmap_level):
+                skips.append((push_i, pop_i))
+                skip_end = pop_i
+        return skips
+
+    def _get_stack(self):
+        """Per-thread preallocated isolation stack tiles."""
+        try:
+            return self._per_thread.stack
+        except AttributeError:
+            shape = (self._stack_depth,) + self._TILE_SHAPE
+            stack = np.empty(shape, dtype='uint16')
+            self._per_thread.stack = stack
+            return stack
+
+    def execute(self, dst, dst_has_alpha, tx, ty, mipmap_level=0):
+        """Run the program to render one tile. fix15 data only!
+
+        :param numpy.ndarray dst: Target fix15 tile (uint16, NxNx4).
+        :param bool dst_has_alpha: Target tile's alpha is significant.
+        :param int tx: Tile X coordinate.
+        :param int ty: Tile Y coordinate.
+        :param int mipmap_level: Mipmap level to render.
+
+        This method may be called from several threads at once.
+
+        """
+        skips = self._get_skips(tx, ty, mipmap_level)
+        if not self._native:
+            self._interpret(dst, dst_has_alpha, tx, ty, mipmap_level, skips)
+            return
+        fetchers = self._fetchers
+        if skips:
+            fetchers = list(fetchers)
+            for (push_i, pop_i) in skips:
+                fetchers[push_i:pop_i+1] = [None] * (pop_i + 1 - push_i)
+        srcs = [
+            f(tx, ty, mipmap_level) if (f is not None) else None
+            for f in fetchers
+        ]
+        lib.mypaintlib.tile_render_program(
+            self._opcodes, self._modes, self._opacities,
+            srcs, dst, dst_has_alpha,
+            self._get_stack(),
+            [push_i for (push_i, pop_i) in skips],
+        )
+
+    def _interpret(self, dst, dst_has_alpha, tx, ty, mipmap_level, skips):
+        """Fallback: run the ops one by one through their Python APIs."""
+        stack_tiles = self._get_stack()
+        stack = []
+        skip_ends = dict(skips)
+        i = 0
+        while i < len(self.ops):
+            (opcode, opdata, mode, opacity) = self.ops[i]
+            if i in skip_ends:
+                i = skip_ends[i] + 1
+                continue
+            i += 1
+            if opcode == Opcode.COMPOSITE:
+                opdata.composite_tile(
+                    dst, dst_has_alpha, tx, ty,
+                    mipmap_level=mipmap_level,
+                    mode=mode, opacity=opacity,
+                )
+            elif opcode == Opcode.BLIT:
+                opdata.blit_tile_into(
+                    dst, dst_has_alpha, tx, ty,
+                    mipmap_level,
+                )
+            elif opcode == Opcode.PUSH:
+                stack.append((dst, dst_has_alpha))
+                dst = stack_tiles[len(stack) - 1]
+                lib.mypaintlib.tile_clear_rgba16(dst)
+                dst_has_alpha = True
+            elif opcode == Opcode.POP:
+                src = dst
+                (dst, dst_has_alpha) = stack.pop(-1)
+                lib.mypaintlib.tile_combine(
+                    mode,
+                    src, dst, dst_has_alpha,
+                    opacity,
+                )
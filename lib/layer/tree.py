@@ -22,6 +22,7 @@ from copy import deepcopy
 import os.path
 from warnings import warn
 import contextlib
+import threading
 
 from gi.repository import GdkPixbuf
 from gi.repository import GLib
@@ -36,6 +37,8 @@ import lib.helpers as helpers
 from lib.observable import event
 import lib.pixbuf
 import lib.cache
+import lib.workers
+import lib.strokemap
 from lib.modes import DEFAULT_MODE
 from lib.modes import PASS_THROUGH_MODE
 from lib.modes import MODES_DECREASING_BACKDROP_ALPHA
@@ -111,13 +114,22 @@ class RootLayerStack (group.LayerStack):
     INITIAL_MODE = lib.mypaintlib.CombineNormal
     PERMITTED_MODES = {INITIAL_MODE}
 
+    #: Smallest render() batch worth splitting across worker threads.
+    _RENDER_PARALLEL_MIN_TILES = 8
+
+    #: Chunks per worker when splitting, to even out uneven tile costs.
+    _RENDER_CHUNKS_PER_WORKER = 4
+
     ## Initialization
 
-    def __init__(self, doc=None, **kwargs):
+    def __init__(self, doc=None, render_workers=None, **kwargs):
         """Construct, as part of a model
 
         :param doc: The model document. May be None for testing.
         :type doc: lib.document.Document
+        :param lib.workers.WorkerPool render_workers: Pool to share.
+            By default, the stack gets a pool of its own, which is
+            stopped by close().
         """
         super(RootLayerStack, self).__init__(**kwargs)
         self.doc = doc
@@ -131,7 +143,45 @@ class RootLayerStack (group.LayerStack):
             self.EOTF = self.app.preferences['display.colorspace_EOTF']
         except: 
             self.EOTF = 2.2
-        self._render_cache = lib.cache.LRUCache(capacity=cachesize)
+        try:
+            cache_mib = self.app.preferences['ui.rendered_tile_cache_mib']
+        except:
+            cache_mib = 256
+        self._render_cache = lib.cache.LRUCache(
+            capacity=cachesize,
+            capacity_bytes=_mib_to_bytes(cache_mib),
+            sizeof=_render_cache_item_size,
+            stats_key=_render_cache_item_level,
+            on_evict=self._render_cache_evicted_cb,
+        )
+        # Spatial index of the cache: per mipmap level, the set of
+        # cached (tx, ty) positions. Allows quick area invalidation.
+        self._render_cache_index = [
+            set() for level in range(lib.mypaintlib.MAX_MIPMAP_LEVEL + 1)
+        ]
+        self._render_cache_lock = threading.RLock()
+        self._owns_render_workers = (render_workers is None)
+        if render_workers is None:
+            try:
+                nworkers = self.app.preferences['ui.render_worker_threads']
+            except:
+                nworkers = 0
+            render_workers = lib.workers.WorkerPool(nworkers)
+        self._render_workers = render_workers
+        # Flattened backdrops below and above the current layer
+        try:
+            backdrop_mib = self.app.preferences['ui.render_backdrop_cache_mib']
+        except:
+            backdrop_mib = 128
+        self._backdrop_cache = lib.cache.LRUCache(
+            capacity=cachesize,
+            capacity_bytes=_mib_to_bytes(backdrop_mib),
+            sizeof=_backdrop_cache_item_size,
+        )
+        self._backdrop_cache_enabled = bool(backdrop_mib)
+        self._backdrop_cache_layer = None
+        #: Brush settings of the strokes in the document's strokemaps.
+        self.brush_table = lib.strokemap.BrushTable()
         # Background
         default_bg = (255, 255, 255)
         self._default_background = default_bg
@@ -150,11 +200,14 @@ class RootLayerStack (group.LayerStack):
         self._current_path = ()
         # Temporary overlay for the current layer
         self._current_layer_overlay = None
-        # Self-observation
+        # Self-observation.
+        # Changes to the rendering-related properties of a layer,
+        # and insertions and deletions, are always accompanied by
+        # content change notifications limited to the area the layer
+        # covers (see LayerBase.get_full_redraw_bbox()). So only those
+        # need to invalidate the render cache.
         self.layer_content_changed += self._render_cache_clear_area
-        self.layer_properties_changed += self._render_cache_clear
-        self.layer_deleted += self._render_cache_clear
-        self.layer_inserted += self._render_cache_clear
+        self.layer_content_changed += self._backdrop_cache_clear_area
         # Layer thumbnail updates
         self.layer_content_changed += self._mark_layer_for_rethumb
         self._rethumb_layers = []
@@ -163,20 +216,28 @@ class RootLayerStack (group.LayerStack):
     # Render cache management:
 
     def _render_cache_get(self, key1, key2):
-        try:
-            cache2 = self._render_cache[key1]
-            return cache2[key2]
-        except KeyError:
-            pass
-        return None
+        with self._render_cache_lock:
+            cache2 = self._render_cache.peek(key1)
+            data = None
+            if cache2 is not None:
+                data = cache2.get(key2)
+            self._render_cache.record_access(key1, data is not None)
+        return data
 
     def _render_cache_set(self, key1, key2, data):
-        try:
-            cache2 = self._render_cache[key1]
-        except KeyError:
-            cache2 = dict()  # it'll have ~MAX_MIPMAP_LEVEL items
+        with self._render_cache_lock:
+            cache2 = self._render_cache.peek(key1)
+            if cache2 is None:
+                cache2 = dict()  # it'll have ~MAX_MIPMAP_LEVEL items
+            cache2[key2] = data
+            # Store it again so that the size gets re-accounted.
             self._render_cache[key1] = cache2
-        cache2[key2] = data
+            tx, ty, level = key1
+            self._render_cache_index[level].add((tx, ty))
+
+    def _render_cache_evicted_cb(self, key1, cache2):
+        tx, ty, level = key1
+        self._render_cache_index[level].discard((tx, ty))
 
     def _render_cache_clear_area(self, root, layer, x, y, w, h):
         """Clears rendered tiles from the cache in a specific area."""
@@ -190,18 +251,209 @@ class RootLayerStack (group.LayerStack):
         tx_max = ((x + w) // n)
         ty_min = y // n
         ty_max = ((y + h) // n)
-        mipmap_level_max = lib.mypaintlib.MAX_MIPMAP_LEVEL
 
-        for tx in range(tx_min, tx_max + 1):
-            for ty in range(ty_min, ty_max + 1):
-                for level in range(0, mipmap_level_max + 1):
-                    fac = 2 ** level
-                    key = ((tx // fac), (ty // fac), level)
-                    self._render_cache.pop(key, None)
+        # Visit either the cached tiles, or the tiles in the area,
+        # whichever is fewer.
+        with self._render_cache_lock:
+            for level, cached in enumerate(self._render_cache_index):
+                if not cached:
+                    continue
+                fac = 2 ** level
+                ltx_min = tx_min // fac
+                ltx_max = tx_max // fac
+                lty_min = ty_min // fac
+                lty_max = ty_max // fac
+                area = (ltx_max - ltx_min + 1) * (lty_max - lty_min + 1)
+                if area <= len(cached):
+                    hits = [
+                        (tx, ty)
+                        for tx in range(ltx_min, ltx_max + 1)
+                        for ty in range(lty_min, lty_max + 1)
+                        if (tx, ty) in cached
+                    ]
+                else:
+                    hits = [
+                        (tx, ty) for (tx, ty) in cached
+                        if (ltx_min <= tx <= ltx_max
+                            and lty_min <= ty <= lty_max)
+                    ]
+                for (tx, ty) in hits:
+                    cached.discard((tx, ty))
+                    self._render_cache.discard((tx, ty, level))
 
     def _render_cache_clear(self, *_ignored):
         """Clears all rendered tiles from the cache."""
-        self._render_cache.clear()
+        with self._render_cache_lock:
+            self._render_cache.clear(reset_stats=False)
+            for cached in self._render_cache_index:
+                cached.clear()
+
+    def get_render_cache_stats(self):
+        """Get usage statistics for the rendered tile cache.
+
+        :rtype: dict
+
+        See lib.cache.LRUCache.get_stats() for the format.
+        Hit and miss counts are grouped by mipmap level.
+
+        """
+        with self._render_cache_lock:
+            return self._render_cache.get_stats()
+
+    @property
+    def render_cache_size_mib(self):
+        """Memory budget for the rendered tile cache, in MiB.
+
+        Zero means that the cache is limited only by its item count.
+        Shrinking the budget evicts tiles immediately.
+
+        """
+        nbytes = self._render_cache.capacity_bytes
+        if nbytes is None:
+            return 0
+        return nbytes / (1024 * 1024)
+
+    @render_cache_size_mib.setter
+    def render_cache_size_mib(self, mib):
+        with self._render_cache_lock:
+            self._render_cache.capacity_bytes = _mib_to_bytes(mib)
+
+    @property
+    def render_workers(self):
+        """The worker pool for rendering, and other per-tile work.
+
+        :rtype: lib.workers.WorkerPool
+
+        """
+        return self._render_workers
+
+    def close(self):
+        """Stop the stack's own worker threads.
+
+        Shared pools are left running for their owner to close. The
+        stack can still be used afterwards: the threads are restarted
+        when needed.
+
+        """
+        if self._owns_render_workers:
+            self._render_workers.close()
+
+    # Backdrop cache management:
+
+    def _backdrop_cache_get(self, key):
+        with self._render_cache_lock:
+            return self._backdrop_cache.get(key)
+
+    def _backdrop_cache_set(self, key, tile):
+        with self._render_cache_lock:
+            self._backdrop_cache[key] = tile
+
+    def _backdrop_cache_clear_area(self, root, layer, x, y, w, h):
+        """Clears flattened backdrop tiles in a specific area.
+
+        Changes to the current layer, or to anything inside it,
+        don't affect what's below or above it, so they are ignored.
+
+        """
+        with self._render_cache_lock:
+            if not len(self._backdrop_cache):
+                return
+            current = self._backdrop_cache_layer
+            if layer is current:
+                return
+            if isinstance(current, group.LayerStack):
+                if any(l is layer for l in current.deepiter()):
+                    return
+            if (w <= 0) or (h <= 0):  # update all notifications
+                self._backdrop_cache.clear(reset_stats=False)
+                return
+            n = lib.mypaintlib.TILE_SIZE
+            tx_min = x // n
+            tx_max = ((x + w) // n)
+            ty_min = y // n
+            ty_max = ((y + h) // n)
+            for key in list(self._backdrop_cache.keys()):
+                tx, ty, level = key[0:3]
+                fac = 2 ** level
+                if not (tx_min // fac <= tx <= tx_max // fac):
+                    continue
+                if not (ty_min // fac <= ty <= ty_max // fac):
+                    continue
+                self._backdrop_cache.discard(key)
+
+    def _get_backdrop_render_program(self, spec):
+        """Get a program rendering via cached backdrops, if possible.
+
+        :param lib.layer.rendering.Spec spec: What to render.
+        :returns: A program, or None if the spec isn't suitable.
+        :rtype: _BackdropRenderProgram
+
+        This is used for the display while painting, so only plain
+        renderings of a current layer are supported.
+
+        """
+        if not self._backdrop_cache_enabled:
+            return None
+        if spec.solo or spec.previewing:
+            return None
+        if (spec.layers is not None) or (spec.background is not None):
+            return None
+        if spec.global_overlay is not None:
+            return None
+        current = spec.current
+        if current is None:
+            return None
+        path = self.deepindex(current)
+        if not path:
+            return None
+        split = self._get_split_render_ops(spec, path)
+        if split is None:
+            return None
+        with self._render_cache_lock:
+            if self._backdrop_cache_layer is not current:
+                self._backdrop_cache.clear(reset_stats=False)
+                self._backdrop_cache_layer = current
+        below_ops, current_ops, above_ops = split
+        return _BackdropRenderProgram(self, below_ops, current_ops, above_ops)
+
+    def _get_split_render_ops(self, spec, path):
+        """Split the render ops around a layer.
+
+        :param lib.layer.rendering.Spec spec: What to render.
+        :param tuple path: Path of the layer to split around.
+        :returns: (below_ops, layer_ops, above_ops), or None
+
+        Concatenating the three lists gives the same result as
+        get_render_ops(). The split is only possible when all the
+        layer's parents are visible pass-through groups: a group
+        which isolates its children can't be flattened this way.
+
+        """
+        below_ops = []
+        above_ops = []
+        if self._get_render_background(spec):
+            bg_surf = self._background_layer._surface
+            below_ops.append((rendering.Opcode.BLIT, bg_surf, None, None))
+        stack = self
+        for i, idx in enumerate(path):
+            if not (0 <= idx < len(stack)):
+                return None
+            children = list(stack)
+            for child in reversed(children[idx+1:]):
+                below_ops.extend(child.get_render_ops(spec))
+            level_above_ops = []
+            for child in reversed(children[:idx]):
+                level_above_ops.extend(child.get_render_ops(spec))
+            above_ops = level_above_ops + above_ops
+            layer = children[idx]
+            if i == len(path) - 1:
+                return (below_ops, layer.get_render_ops(spec), above_ops)
+            if not isinstance(layer, group.LayerStack):
+                return None
+            if not layer.visible or layer.mode != PASS_THROUGH_MODE:
+                return None
+            stack = layer
+        return None
 
     # Global ops:
 
@@ -211,6 +463,10 @@ class RootLayerStack (group.LayerStack):
         self.set_background(self._default_background)
         self.current_path = ()
         self._render_cache_clear()
+        with self._render_cache_lock:
+            self._backdrop_cache.clear(reset_stats=False)
+            self._backdrop_cache_layer = None
+        self.brush_table = lib.strokemap.BrushTable()
 
     def ensure_populated(self, layer_class=None):
         """Ensures that the stack is non-empty by making a new layer if needed
@@ -445,7 +701,6 @@ class RootLayerStack (group.LayerStack):
             spec.background = bool(background)
 
         dst_has_alpha = not self.get_render_is_opaque(spec=spec)
-        ops = self.get_render_ops(spec)
 
         target_surface_is_8bpc = False
         use_cache = False
@@ -456,91 +711,122 @@ class RootLayerStack (group.LayerStack):
                 use_cache = spec.cacheable()
         key2 = (id(opaque_base_tile), dst_has_alpha)
 
+        # Screen updates can reuse flattened backdrops of the layers
+        # below and above the current one.
+        program = None
+        if target_surface_is_8bpc:
+            program = self._get_backdrop_render_program(spec)
+        if program is None:
+            program = rendering.Program(self.get_render_ops(spec))
+
+        def render_tile(pos):
+            self._render_tile(
+                surface, pos, mipmap_level, program,
+                dst_has_alpha, opaque_base_tile,
+                target_surface_is_8bpc, use_cache, key2, filter,
+            )
+
         # Rendering loop.
-        # Keep this as tight as possible, and consider C++ parallelization.
+        # Tiles are independent, so big batches can be split across
+        # the worker pool. The C++ compositing and conversion funcs
+        # release the GIL while they work.
+        pool = self._render_workers
+        if pool.parallel and len(tiles) >= self._RENDER_PARALLEL_MIN_TILES:
+            nchunks = pool.workers * self._RENDER_CHUNKS_PER_WORKER
+            chunks = lib.workers.split_into_chunks(tiles, nchunks)
+
+            def render_chunk(chunk):
+                for pos in chunk:
+                    render_tile(pos)
+                return len(chunk)
+
+            for n in pool.imap_unordered(render_chunk, chunks):
+                progress += n
+        else:
+            for pos in tiles:
+                render_tile(pos)
+                progress += 1
+        progress.close()
+
+    def _render_tile(self, surface, pos, mipmap_level, program,
+                     dst_has_alpha, opaque_base_tile,
+                     target_surface_is_8bpc, use_cache, key2, filter):
+        """Render one tile for render(). May run in a worker thread."""
+        tx, ty = pos
         tiledims = (tiledsurface.N, tiledsurface.N, 4)
-        dst_has_alpha_orig = dst_has_alpha
-        for tx, ty in tiles:
-            dst_8bpc_orig = None
-            dst_has_alpha = dst_has_alpha_orig
-            key1 = (tx, ty, mipmap_level)
-            cache_hit = False
-
-            with surface.tile_request(tx, ty, readonly=False) as dst:
-
-                # Twirl out any 8bpc target here,
-                # if the render cache is empty for this tile.
-                if target_surface_is_8bpc:
-                    dst_8bpc_orig = dst
-                    dst = None
-                    if use_cache:
-                        dst = self._render_cache_get(key1, key2)
-
-                    if dst is None:
-                        dst = np.zeros(tiledims, dtype='uint16')
-                    else:
-                        cache_hit = True  # note: dtype is now uint8
-
-                if not cache_hit:
-                    # Render to dst.
-                    # dst is a fix15 rgba tile
-
-                    dst_over_opaque_base = None
-                    if dst_has_alpha and opaque_base_tile is not None:
-                        dst_over_opaque_base = dst
-                        lib.mypaintlib.tile_copy_rgba16_into_rgba16(
-                            opaque_base_tile,
-                            dst_over_opaque_base,
-                        )
-                        dst = np.zeros(tiledims, dtype='uint16')
-
-                    # Process the ops list.
-                    self._process_ops_list(
-                        ops,
-                        dst, dst_has_alpha,
-                        tx, ty, mipmap_level,
+        dst_8bpc_orig = None
+        key1 = (tx, ty, mipmap_level)
+        cache_hit = False
+
+        with surface.tile_request(tx, ty, readonly=False) as dst:
+
+            # Twirl out any 8bpc target here,
+            # if the render cache is empty for this tile.
+            if target_surface_is_8bpc:
+                dst_8bpc_orig = dst
+                dst = None
+                if use_cache:
+                    dst = self._render_cache_get(key1, key2)
+
+                if dst is None:
+                    dst = np.zeros(tiledims, dtype='uint16')
+                else:
+                    cache_hit = True  # note: dtype is now uint8
+
+            if not cache_hit:
+                # Render to dst.
+                # dst is a fix15 rgba tile
+
+                dst_over_opaque_base = None
+                if dst_has_alpha and opaque_base_tile is not None:
+                    dst_over_opaque_base = dst
+                    lib.mypaintlib.tile_copy_rgba16_into_rgba16(
+                        opaque_base_tile,
+                        dst_over_opaque_base,
                     )
+                    dst = np.zeros(tiledims, dtype='uint16')
 
-                    if dst_over_opaque_base is not None:
-                        dst_has_alpha = False
-                        lib.mypaintlib.tile_combine(
-                            lib.mypaintlib.CombineNormal,
-                            dst, dst_over_opaque_base,
-                            False, 1.0,
-                        )
-                        dst = dst_over_opaque_base
-
-                # If the target tile is fix15 already, we're done.
-                if dst_8bpc_orig is None:
-                    continue
+                # Run the compiled ops list.
+                program.execute(dst, dst_has_alpha, tx, ty, mipmap_level)
+
+                if dst_over_opaque_base is not None:
+                    dst_has_alpha = False
+                    lib.mypaintlib.tile_combine(
+                        lib.mypaintlib.CombineNormal,
+                        dst, dst_over_opaque_base,
+                        False, 1.0,
+                    )
+                    dst = dst_over_opaque_base
+
+            # If the target tile is fix15 already, we're done.
+            if dst_8bpc_orig is None:
+                return
 
-                # Untwirl into the target 8bpc tile.
-                if not cache_hit:
-                    # Rendering just happened.
-                    # Convert to 8bpc, and maybe store.
-                    if dst_has_alpha:
-                        conv = lib.mypaintlib.tile_convert_rgba16_to_rgba8
-                    else:
-                        conv = lib.mypaintlib.tile_convert_rgbu16_to_rgbu8
-                    conv(dst, dst_8bpc_orig, self.EOTF)
-
-                    if use_cache:
-                        self._render_cache_set(key1, key2, dst_8bpc_orig)
+            # Untwirl into the target 8bpc tile.
+            if not cache_hit:
+                # Rendering just happened.
+                # Convert to 8bpc, and maybe store.
+                if dst_has_alpha:
+                    conv = lib.mypaintlib.tile_convert_rgba16_to_rgba8
                 else:
-                    # An already 8pbc dst was loaded from the cache.
-                    # It will match dst_has_alpha already.
-                    dst_8bpc_orig[:] = dst
+                    conv = lib.mypaintlib.tile_convert_rgbu16_to_rgbu8
+                conv(dst, dst_8bpc_orig, self.EOTF)
 
-                dst = dst_8bpc_orig
+                if use_cache:
+                    # Cache a copy: the target is usually a view into a
+                    # big pixbuf, which the cache must not keep alive.
+                    self._render_cache_set(key1, key2, dst_8bpc_orig.copy())
+            else:
+                # An already 8pbc dst was loaded from the cache.
+                # It will match dst_has_alpha already.
+                dst_8bpc_orig[:] = dst
 
-                # Display filtering only happens when rendering
-                # 8bpc for the screen.
-                if filter is not None:
-                    filter(dst)
+            dst = dst_8bpc_orig
 
-            # end tile_request
-            progress += 1
-        progress.close()
+            # Display filtering only happens when rendering
+            # 8bpc for the screen.
+            if filter is not None:
+                filter(dst)
 
     def render_layer_preview(self, layer, size=256, bbox=None, **options):
         """Render a standardized thumbnail/preview of a specific layer.
@@ -609,13 +895,19 @@ class RootLayerStack (group.LayerStack):
         return pixbuf
 
     def render_layer_to_png_file(self, layer, filename, bbox=None, **options):
-        """Render out to a PNG file. Used by LayerGroup.save_as_png()."""
+        """Render out to a PNG file. Used by LayerGroup.save_as_png().
+
+        Tile rows are rendered and compressed by the render worker pool
+        unless the "pool" option says otherwise.
+
+        """
         bbox = self._validate_layer_bbox_arg(layer, bbox)
         spec = self._get_render_spec_for_layer(layer)
         spec.background = options.get("render_background")
         rendering = _TileRenderWrapper(self, spec, use_cache=False)
         if "alpha" not in options:
             options["alpha"] = True
+        options.setdefault("pool", self._render_workers)
         lib.surface.save_as_png(rendering, filename, *bbox, **options)
 
     def get_tile_accessible_layer_rendering(self, layer):
@@ -674,7 +966,7 @@ class RootLayerStack (group.LayerStack):
                 if layer is None:
                     layer = self.current
                 spec = self._get_render_spec_for_layer(layer)
-            ops = self.get_render_ops(spec)
+            ops = rendering.Program(self.get_render_ops(spec))
 
         dst_is_8bpc = (dst.dtype == 'uint8')
         if dst_is_8bpc:
@@ -711,48 +1003,17 @@ class RootLayerStack (group.LayerStack):
 
     @staticmethod
     def _process_ops_list(ops, dst, dst_has_alpha, tx, ty, mipmap_level):
-        """Process a list of ops to render a tile. fix15 data only!"""
-        # FIXME: should this be expanded to cover caching and 8bpc
-        # targets? It would save on some code duplication elsewhere.
-        # On the other hand, this is sort of what a parallelized,
-        # GIL-holding C++ loop body might look like.
+        """Process a list of ops to render a tile. fix15 data only!
 
-        stack = []
-        for (opcode, opdata, mode, opacity) in ops:
-            if opcode == rendering.Opcode.COMPOSITE:
-                opdata.composite_tile(
-                    dst, dst_has_alpha, tx, ty,
-                    mipmap_level=mipmap_level,
-                    mode=mode, opacity=opacity,
-                )
-            elif opcode == rendering.Opcode.BLIT:
-                opdata.blit_tile_into(
-                    dst, dst_has_alpha, tx, ty,
-                    mipmap_level,
-                )
-            elif opcode == rendering.Opcode.PUSH:
-                stack.append((dst, dst_has_alpha))
-                tiledims = (tiledsurface.N, tiledsurface.N, 4)
-                dst = np.zeros(tiledims, dtype='uint16')
-                dst_has_alpha = True
-            elif opcode == rendering.Opcode.POP:
-                src = dst
-                (dst, dst_has_alpha) = stack.pop(-1)
-                lib.mypaintlib.tile_combine(
-                    mode,
-                    src, dst, dst_has_alpha,
-                    opacity,
-                )
-            else:
-                raise RuntimeError(
-                    "Unknown lib.layer.rendering.Opcode: %r",
-                    opcode,
-                )
-        if len(stack) > 0:
-            raise ValueError(
-                "Ops list contains more PUSH operations "
-                "than POPs. Rendering is incomplete."
-            )
+        :param ops: A rendering.Program, or a raw ops list.
+
+        Raw ops lists are compiled on every call, so callers rendering
+        more than one tile should compile a rendering.Program up front.
+
+        """
+        if not isinstance(ops, rendering.Program):
+            ops = rendering.Program(ops)
+        ops.execute(dst, dst_has_alpha, tx, ty, mipmap_level)
 
     ## Renderable implementation
 
@@ -1990,10 +2251,10 @@ class RootLayerStack (group.LayerStack):
                 dstlayer.strokes[:0] = layer.strokes
 
         # Might need to render the backdrop, in order to subtract it.
-        bd_ops = []
+        bd_ops = rendering.Program([])
         if needs_backdrop_removal:
             bd_spec = self._get_backdrop_render_spec_for_layer(path)
-            bd_ops = self.get_render_ops(bd_spec)
+            bd_ops = rendering.Program(self.get_render_ops(bd_spec))
 
         # Need to render the layer to be normalized too.
         # The ops are processed on top of the tiles bd_ops will render.
@@ -2002,7 +2263,7 @@ class RootLayerStack (group.LayerStack):
             solo=True,
             layers=set(self.layers_along_or_under_path(path))
         )
-        src_ops = self.get_render_ops(src_spec)
+        src_ops = rendering.Program(self.get_render_ops(src_spec))
 
         # Process by tile.
         # This is like taking before/after pics from a normal render(),
@@ -2226,14 +2487,16 @@ class RootLayerStack (group.LayerStack):
 
         # Extract ops lists for the target and its backdrop
         bd_spec = self._get_backdrop_render_spec_for_layer(targ_path)
-        bd_ops = self.get_render_ops(bd_spec)
+        bd_ops = rendering.Program(self.get_render_ops(bd_spec))
 
         targ_only_spec = rendering.Spec(
             current=targ_layer,
             solo=True,
             layers=set(self.layers_along_or_under_path(targ_path))
         )
-        targ_only_ops = self.get_render_ops(targ_only_spec)
+        targ_only_ops = rendering.Program(
+            self.get_render_ops(targ_only_spec),
+        )
 
         # Process by tile, like Normalize's backdrop removal.
         logger.debug("uniq: bd_ops = %r", bd_ops)
@@ -2294,7 +2557,7 @@ class RootLayerStack (group.LayerStack):
                 solo=True,
                 layers=set(self.layers_along_or_under_path(child_path))
             )
-            ops = self.get_render_ops(spec)
+            ops = rendering.Program(self.get_render_ops(spec))
             child_ops[child] = ops
             union_tiles.update(child.get_tile_coords())
 
@@ -2454,6 +2717,7 @@ class RootLayerStack (group.LayerStack):
                 return
             except tiledsurface.BackgroundError as e:
                 logger.warning('ORA background tile not usable: %r', e)
+        kwargs["brush_table"] = self.brush_table
         super(RootLayerStack, self)._load_child_layer_from_orazip(
             orazip,
             elem,
@@ -2510,6 +2774,7 @@ class RootLayerStack (group.LayerStack):
                 return
             except tiledsurface.BackgroundError as e:
                 logger.warning('ORA background tile not usable: %r', e)
+        kwargs["brush_table"] = self.brush_table
         super(RootLayerStack, self)._load_child_layer_from_oradir(
             oradir,
             elem,
@@ -2695,6 +2960,104 @@ class RootLayerStackSnapshot (group.LayerStackSnapshot):
         layer.current_path = self.current_path
 
 
+class _BackdropRenderProgram (object):
+    """Renders tiles using flattened backdrops for the current layer.
+
+    The layers below the current layer are flattened into a cached
+    backdrop tile, and the current layer is composited over a copy of
+    it. If all the layers above it use normal mode, they are flattened
+    into a second cached tile which is composited over the result.
+    This makes each tile cost about three composite operations while
+    painting, however many layers there are.
+
+    Rounding may differ very slightly from that of a normal render,
+    so these programs are only used for drawing to the screen.
+
+    """
+
+    def __init__(self, root, below_ops, current_ops, above_ops):
+        """Initialize from split ops lists.
+
+        :param RootLayerStack root: Owner of the backdrop cache.
+        :param list below_ops: Ops for the layers below.
+        :param list current_ops: Ops for the current layer.
+        :param list above_ops: Ops for the layers above.
+
+        """
+        super(_BackdropRenderProgram, self).__init__()
+        self._root = root
+        self._below = rendering.Program(below_ops)
+        self._current = rendering.Program(current_ops)
+        self._above = None
+        self._above_flattened = False
+        if above_ops:
+            self._above = rendering.Program(above_ops)
+            self._above_flattened = self._ops_are_flattenable(above_ops)
+
+    @staticmethod
+    def _ops_are_flattenable(ops):
+        """True if ops can be rendered separately, then composited.
+
+        Normal mode is associative, so a run of normal-mode ops
+        can be flattened before compositing it onto a backdrop.
+
+        """
+        normal = lib.mypaintlib.CombineNormal
+        depth = 0
+        for (opcode, opdata, mode, opacity) in ops:
+            if opcode == rendering.Opcode.PUSH:
+                depth += 1
+            elif opcode == rendering.Opcode.POP:
+                depth -= 1
+                if depth == 0 and mode != normal:
+                    return False
+            elif depth == 0:
+                if opcode != rendering.Opcode.COMPOSITE or mode != normal:
+                    return False
+        return True
+
+    def __repr__(self):
+        return "<_BackdropRenderProgram below=%d current=%d above=%d>" % (
+            len(self._below),
+            len(self._current),
+            len(self._above or ()),
+        )
+
+    def _get_flattened(self, program, part, dst_has_alpha,
+                       tx, ty, mipmap_level):
+        key = (tx, ty, mipmap_level, dst_has_alpha, part)
+        tile = self._root._backdrop_cache_get(key)
+        if tile is None:
+            tiledims = (tiledsurface.N, tiledsurface.N, 4)
+            tile = np.zeros(tiledims, dtype='uint16')
+            program.execute(tile, dst_has_alpha, tx, ty, mipmap_level)
+            self._root._backdrop_cache_set(key, tile)
+        return tile
+
+    def execute(self, dst, dst_has_alpha, tx, ty, mipmap_level=0):
+        """Render one tile, like rendering.Program.execute()."""
+        below = self._get_flattened(
+            self._below, "below", dst_has_alpha,
+            tx, ty, mipmap_level,
+        )
+        lib.mypaintlib.tile_copy_rgba16_into_rgba16(below, dst)
+        self._current.execute(dst, dst_has_alpha, tx, ty, mipmap_level)
+        if self._above is None:
+            return
+        if not self._above_flattened:
+            self._above.execute(dst, dst_has_alpha, tx, ty, mipmap_level)
+            return
+        above = self._get_flattened(
+            self._above, "above", True,
+            tx, ty, mipmap_level,
+        )
+        lib.mypaintlib.tile_combine(
+            lib.mypaintlib.CombineNormal,
+            above, dst,
+            dst_has_alpha, 1.0,
+        )
+
+
 class _TileRenderWrapper (TileAccessible, TileBlittable):
     """Adapts a RootLayerStack to support RO tile_request()s.
 
@@ -2715,7 +3078,7 @@ class _TileRenderWrapper (TileAccessible, TileBlittable):
         """
         super(_TileRenderWrapper, self).__init__()
         self._root = root
-        self._ops = root.get_render_ops(spec)
+        self._ops = rendering.Program(root.get_render_ops(spec))
         self._use_cache = bool(use_cache)
         self._cache = {}
 
@@ -2768,6 +3131,31 @@ class _TileRenderWrapper (TileAccessible, TileBlittable):
         return getattr(self._root, attr)
 
 
+## Render cache helpers
+
+
+def _mib_to_bytes(mib):
+    """Convert a MiB budget to bytes. Zero or None means no limit."""
+    if not mib:
+        return None
+    return int(mib * 1024 * 1024)
+
+
+def _render_cache_item_size(cache2):
+    """Bytes used by an item in the render cache."""
+    return sum(a.nbytes for a in cache2.values())
+
+
+def _render_cache_item_level(key1):
+    """Stats grouping for render cache keys: their mipmap level."""
+    return key1[2]
+
+
+def _backdrop_cache_item_size(tile):
+    """Bytes used by a flattened backdrop tile."""
+    return tile.nbytes
+
+
 ## Layer path tuple functions
 
 
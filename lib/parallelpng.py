@@ -0,0 +1,340 @@
+# This file is part of MyPaint.
+# Copyright (C) 2026 by the MyPaint Development Team.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+
+"""PNG writer which compresses strips of pixel rows in parallel.
+
+PNG image data is a single zlib stream, but the deflate format allows
+independently compressed runs of rows to be joined together as long as
+each run but the last ends on a byte boundary. Each strip written is
+filtered and deflated by its own job in a worker pool, and the results
+are written out in order. By default, rows are filtered with the "Sub"
+filter and compressed at a low level, like the defaults of
+mypaintlib.ProgressivePNGWriter.
+
+"""
+
+## Imports
+
+from __future__ import division, print_function
+
+import collections
+import logging
+import struct
+import zlib
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+## Constants
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# zlib stream header: deflate with a 32K window, no preset dictionary.
+_ZLIB_HEADER = b"\x78\x01"
+
+_ADLER32_BASE = 65521
+
+# Fallback chunks stored with sRGB, as libpng writes them.
+_GAMA_SRGB = struct.pack(">I", 45455)
+_CHRM_SRGB = struct.pack(
+    ">8I",
+    31270, 32900,  # white point
+    64000, 33000,  # red
+    30000, 60000,  # green
+    15000, 6000,   # blue
+)
+_SRGB_PERCEPTUAL = b"\x00"
+
+# PNG filter types, and libpng's PNG_FILTER_* flags for them.
+_FILTER_FLAGS = [
+    (0, 0x08),  # None
+    (1, 0x10),  # Sub
+    (2, 0x20),  # Up
+    (3, 0x40),  # Average
+    (4, 0x80),  # Paeth
+]
+FILTER_SUB = 0x10
+
+
+## Helper funcs
+
+def adler32_combine(adler1, adler2, len2):
+    """Combine the Adler-32 checksums of two runs of data.
+
+    :param int adler1: Checksum of the first run.
+    :param int adler2: Checksum of the second run.
+    :param int len2: Length of the second run, in bytes.
+    :returns: The checksum of both runs together.
+    :rtype: int
+
+    >>> a, b = b"Hello, ", b"world!" * 20000
+    >>> c = adler32_combine(zlib.adler32(a), zlib.adler32(b), len(b))
+    >>> c == zlib.adler32(a + b) & 0xffffffff
+    True
+
+    """
+    base = _ADLER32_BASE
+    adler1 &= 0xffffffff
+    adler2 &= 0xffffffff
+    s1a, s2a = adler1 & 0xffff, adler1 >> 16
+    s1b, s2b = adler2 & 0xffff, adler2 >> 16
+    s1 = (s1a + s1b - 1) % base
+    s2 = (s2a + s2b + (len2 % base) * (s1a - 1)) % base
+    return (s2 << 16) | s1
+
+
+def _chunk(tag, data):
+    """Internal: encode one PNG chunk."""
+    crc = zlib.crc32(data, zlib.crc32(tag)) & 0xffffffff
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", crc)
+
+
+def _filter_rows(rows, prev, bpp, filter_type):
+    """Internal: apply one PNG filter type to rows of pixel bytes.
+
+    :param numpy.ndarray rows: HxN uint8 raw rows.
+    :param numpy.ndarray prev: N uint8 raw row above the first one.
+    :param int bpp: Bytes per pixel.
+    :param int filter_type: PNG filter type, 0 to 4.
+    :returns: HxN uint8 filtered rows.
+
+    >>> rows = np.array([[10, 20, 30, 40]], 'uint8')
+    >>> prev = np.array([5, 5, 50, 50], 'uint8')
+    >>> [_filter_rows(rows, prev, 2, t)[0].tolist() for t in range(5)]
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [[10, 20, 30, 40], [10, 20, 20, 20], [5, 15, 236, 246],
+     [8, 18, 0, 5], [5, 15, 236, 246]]
+
+    """
+    if filter_type == 0:
+        return rows
+    left = np.zeros_like(rows)
+    left[:, bpp:] = rows[:, :-bpp]
+    if filter_type == 1:
+        return rows - left
+    up = np.empty_like(rows)
+    up[0] = prev
+    up[1:] = rows[:-1]
+    if filter_type == 2:
+        return rows - up
+    if filter_type == 3:
+        mean = (left.astype('uint16') + up) >> 1
+        return rows - mean.astype('uint8')
+    upleft = np.zeros_like(rows)
+    upleft[:, bpp:] = up[:, :-bpp]
+    a = left.astype('int16')
+    b = up.astype('int16')
+    c = upleft.astype('int16')
+    pa = np.abs(b - c)
+    pb = np.abs(a - c)
+    pc = np.abs(a + b - 2*c)
+    pred = np.where((pa <= pb) & (pa <= pc), left,
+                    np.where(pb <= pc, up, upleft))
+    return rows - pred
+
+
+def _encode_strip(strip, prev, alpha, level, filters, last):
+    """Internal: filter and deflate a strip, in a worker thread.
+
+    :returns: (adler32, length, deflated) for the filtered rows.
+
+    When several filters are allowed, each row uses the one which
+    gives the smallest sum of absolute differences, like libpng.
+
+    """
+    if not alpha:
+        strip = strip[:, :, :3]
+        prev = prev[:, :3]
+    h, w, bpp = strip.shape
+    rows = np.ascontiguousarray(strip).reshape(h, -1)
+    prev = np.ascontiguousarray(prev).reshape(-1)
+    types = [t for (t, flag) in _FILTER_FLAGS if filters & flag] or [0]
+    filtered = np.empty((h, rows.shape[1] + 1), 'uint8')
+    if len(types) == 1:
+        filtered[:, 0] = types[0]
+        filtered[:, 1:] = _filter_rows(rows, prev, bpp, types[0])
+    else:
+        candidates = [_filter_rows(rows, prev, bpp, t) for t in types]
+        scores = []
+        for f in candidates:
+            f = f.astype('int32')
+            scores.append(np.minimum(f, 256 - f).sum(axis=1))
+        best = np.argmin(np.stack(scores), axis=0)
+        filtered[:, 0] = np.array(types, 'uint8')[best]
+        for i, f in enumerate(candidates):
+            use = (best == i)
+            filtered[use, 1:] = f[use]
+    data = filtered.tobytes()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data)
+    if last:
+        deflated += compressor.flush(zlib.Z_FINISH)
+    else:
+        deflated += compressor.flush(zlib.Z_SYNC_FLUSH)
+    return (zlib.adler32(data) & 0xffffffff, len(data), deflated)
+
+
+## Class defs
+
+class ParallelPNGWriter (object):
+    """Writes a PNG progressively, compressing strips in a WorkerPool.
+
+    This has the same interface as mypaintlib.ProgressivePNGWriter.
+    Strips are HxWx4 uint8 arrays, and they are copied when written, so
+    callers can reuse their buffers.
+
+    >>> import io, lib.workers
+    >>> fp = io.BytesIO()
+    >>> writer = ParallelPNGWriter(fp, 3, 4, True, False,
+    ...                            lib.workers.WorkerPool(workers=2))
+    >>> strip = np.arange(3 * 2 * 4, dtype='uint8').reshape(2, 3, 4)
+    >>> writer.write(strip)
+    >>> writer.write(strip)
+    >>> writer.close()
+    >>> png = fp.getvalue()
+    >>> png.startswith(_PNG_SIGNATURE)
+    True
+    >>> idat, pos = b"", len(_PNG_SIGNATURE)
+    >>> while pos < len(png):
+    ...     size, tag = struct.unpack(">I4s", png[pos:pos+8])
+    ...     if tag == b"IDAT":
+    ...         idat += png[pos+8:pos+8+size]
+    ...     pos += 12 + size
+    >>> raw = zlib.decompress(idat)
+    >>> raw[:5] == b"\\x01\\x00\\x01\\x02\\x03"
+    True
+    >>> len(raw) == 4 * (1 + 3 * 4)
+    True
+
+    """
+
+    #: Strip jobs per pool worker which may be queued at once.
+    JOBS_PER_WORKER = 2
+
+    def __init__(self, fp, width, height, alpha, save_srgb_chunks, pool,
+                 compression_level=2, filters=FILTER_SUB):
+        """Initialize, writing the PNG header chunks.
+
+        :param fp: Writable file object.
+        :param int width: Image width, in pixels.
+        :param int height: Image height, in pixels.
+        :param bool alpha: Write an RGBA PNG, not RGB.
+        :param bool save_srgb_chunks: Write sRGB, gAMA and cHRM chunks.
+        :param lib.workers.WorkerPool pool: Where to compress strips.
+        :param int compression_level: zlib compression level.
+        :param int filters: Row filters to use, as a mask of libpng's
+            PNG_FILTER_* flags, like mypaintlib.ProgressivePNGWriter.
+
+        """
+        super(ParallelPNGWriter, self).__init__()
+        self._fp = fp
+        self._width = int(width)
+        self._height = int(height)
+        self._alpha = bool(alpha)
+        self._pool = pool
+        self._level = int(compression_level)
+        self._filters = int(filters)
+        self._prev = None  # last row of the previous strip
+        self._jobs = collections.deque()  # [(result, is_last)]
+        self._y = 0
+        self._adler32 = 1
+        self._started = False
+        ihdr = struct.pack(
+            ">IIBBBBB",
+            self._width, self._height,
+            8,  # bit depth
+            6 if self._alpha else 2,  # RGBA or RGB
+            0, 0, 0,  # compression, filter, interlace
+        )
+        fp.write(_PNG_SIGNATURE)
+        fp.write(_chunk(b"IHDR", ihdr))
+        if save_srgb_chunks:
+            fp.write(_chunk(b"gAMA", _GAMA_SRGB))
+            fp.write(_chunk(b"cHRM", _CHRM_SRGB))
+            fp.write(_chunk(b"sRGB", _SRGB_PERCEPTUAL))
+
+    def __repr__(self):
+        return "<ParallelPNGWriter %dx%d y=%d jobs=%d>" % (
+            self._width,
+            self._height,
+            self._y,
+            len(self._jobs),
+        )
+
+    def write(self, strip):
+        """Queue a strip of pixel rows for writing.
+
+        :param numpy.ndarray strip: HxWx4 uint8 RGBA or RGBU data.
+
+        """
+        if strip.ndim != 3 or strip.shape[2] != 4:
+            raise ValueError("strip must be an HxWx4 array")
+        if strip.shape[1] != self._width:
+            raise ValueError("strip width must match writer width")
+        if strip.dtype != np.uint8:
+            raise ValueError("strip must contain uint8 RGBA only")
+        rows = strip.shape[0]
+        if self._y + rows > self._height:
+            raise RuntimeError("too many pixel rows written")
+        self._y += rows
+        last = (self._y == self._height)
+        max_jobs = max(1, self._pool.workers * self.JOBS_PER_WORKER)
+        while len(self._jobs) >= max_jobs:
+            self._write_result(self._jobs.popleft())
+        strip = np.array(strip)
+        prev = self._prev
+        if prev is None:
+            prev = np.zeros(strip.shape[1:], 'uint8')
+        self._prev = strip[-1]
+        result = self._pool.submit(
+            _encode_strip,
+            strip, prev,
+            self._alpha,
+            self._level,
+            self._filters,
+            last,
+        )
+        self._jobs.append((result, last))
+        while self._jobs and self._jobs[0][0].ready():
+            self._write_result(self._jobs.popleft())
+
+    def _write_result(self, job):
+        """Write out a finished strip's IDAT chunk."""
+        result, last = job
+        adler, length, deflated = result.get()
+        self._adler32 = adler32_combine(self._adler32, adler, length)
+        if not self._started:
+            deflated = _ZLIB_HEADER + deflated
+            self._started = True
+        if last:
+            deflated += struct.pack(">I", self._adler32)
+        if deflated:
+            self._fp.write(_chunk(b"IDAT", deflated))
+
+    def close(self):
+        """Finish writing: waits for all strips, then ends the PNG."""
+        try:
+            while self._jobs:
+                self._write_result(self._jobs.popleft())
+        except Exception:
+            for result, last in self._jobs:
+                result.wait()
+            self._jobs.clear()
+            raise
+        if self._y != self._height:
+            raise RuntimeError("too few pixel rows written")
+        self._fp.write(_chunk(b"IEND", b""))
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
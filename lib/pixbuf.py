@@ -45,7 +45,7 @@ def save(pixbuf, filename, type='png', **kwargs):
     """Save pixbuf to a named file (compatibility wrapper)
 
     :param GdkPixbuf.Pixbuf pixbuf: the pixbuf to save
-    :param unicode filename: file path to save as
+    :param unicode filename: file path to save as, or a file object
     :param str type: type to save as: 'jpeg'/'png'/...
     :param \*\*kwargs: passed through to GdkPixbuf
     :rtype: bool
@@ -60,33 +60,40 @@ def save(pixbuf, filename, type='png', **kwargs):
     >>> shutil.rmtree(d, ignore_errors=True)
 
     """
+    if hasattr(filename, "write"):
+        return _save_to_fileobj(pixbuf, filename, type, kwargs)
     with open(filename, 'wb') as fp:
-        try:
-            save_to_callbackv = pixbuf.save_to_callbackv
-        except AttributeError:
-            # save_to_callbackv disappeared in GdkPixbuf 2.31.2
-            # and returned as of GdkPixbuf 2.31.5
-            # https://bugzilla.gnome.org/show_bug.cgi?id=670372#c12
-            save_to_callbackv = pixbuf.save_to_callback
-        # Keyword args are not compatible with 2.26 (Ubuntu 12.04,
-        # a.k.a. precise, a.k.a. "what Travis-CI runs")
-        option_keys = []
-        option_values = []
-        for k, v in kwargs.items():
-            if isinstance(k, bytes):
-                k = k.decode("utf-8")
-            option_keys.append(k)
-            if isinstance(v, bytes):
-                v = v.decode("utf-8")
-            option_values.append(v)
-        result = save_to_callbackv(
-            lambda buf, size, data: fp.write(buf) or True,  # save_func
-            fp,  # user_data
-            type,
-            option_keys,
-            option_values,
-        )
-        return result
+        return _save_to_fileobj(pixbuf, fp, type, kwargs)
+
+
+def _save_to_fileobj(pixbuf, fp, type, kwargs):
+    """Internal: save pixbuf to a writable file object"""
+    try:
+        save_to_callbackv = pixbuf.save_to_callbackv
+    except AttributeError:
+        # save_to_callbackv disappeared in GdkPixbuf 2.31.2
+        # and returned as of GdkPixbuf 2.31.5
+        # https://bugzilla.gnome.org/show_bug.cgi?id=670372#c12
+        save_to_callbackv = pixbuf.save_to_callback
+    # Keyword args are not compatible with 2.26 (Ubuntu 12.04,
+    # a.k.a. precise, a.k.a. "what Travis-CI runs")
+    option_keys = []
+    option_values = []
+    for k, v in kwargs.items():
+        if isinstance(k, bytes):
+            k = k.decode("utf-8")
+        option_keys.append(k)
+        if isinstance(v, bytes):
+            v = v.decode("utf-8")
+        option_values.append(v)
+    result = save_to_callbackv(
+        lambda buf, size, data: fp.write(buf) or True,  # save_func
+        fp,  # user_data
+        type,
+        option_keys,
+        option_values,
+    )
+    return result
 
 
 def load_from_file(filename, progress=None):
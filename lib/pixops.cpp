@@ -24,7 +24,9 @@
 #include <numpy/arrayobject.h>
 
 #include <stdlib.h>
+#include <string.h>
 #include <math.h>
+#include <vector>
 
 
 void
@@ -302,11 +304,16 @@ tile_convert_rgba16_to_rgba8 (PyObject *src,
   assert(PyArray_STRIDE(src_arr, 2) ==   sizeof(uint16_t));
 #endif
 
+  // The noise table must be ready before other threads can get in.
+  precalculate_dithering_noise_if_required();
+
+  Py_BEGIN_ALLOW_THREADS
   tile_convert_rgba16_to_rgba8_c((uint16_t*)PyArray_DATA(src_arr),
                                  PyArray_STRIDES(src_arr)[0],
                                  (uint8_t*)PyArray_DATA(dst_arr),
                                  PyArray_STRIDES(dst_arr)[0],
                                  EOTF);
+  Py_END_ALLOW_THREADS
 }
 
 static inline void
@@ -379,9 +386,13 @@ void tile_convert_rgbu16_to_rgbu8(PyObject * src, PyObject * dst, const float EO
   assert(PyArray_STRIDE(src_arr, 2) ==   sizeof(uint16_t));
 #endif
 
+  precalculate_dithering_noise_if_required();
+
+  Py_BEGIN_ALLOW_THREADS
   tile_convert_rgbu16_to_rgbu8_c((uint16_t*)PyArray_DATA(src_arr), PyArray_STRIDES(src_arr)[0],
                                  (uint8_t*)PyArray_DATA(dst_arr), PyArray_STRIDES(dst_arr)[0],
                                   EOTF);
+  Py_END_ALLOW_THREADS
 }
 
 
@@ -558,6 +569,9 @@ void tile_perceptual_change_strokemap(PyObject * a_obj, PyObject * b_obj, PyObje
   uint16_t * b_p  = (uint16_t*)PyArray_DATA(b);
   uint8_t * res_p = (uint8_t*)PyArray_DATA(res);
 
+  // Only the arrays' memory is used below, so strokemap tiles can be
+  // diffed by several threads at once.
+  Py_BEGIN_ALLOW_THREADS
   for (int y=0; y<MYPAINT_TILE_SIZE; y++) {
     for (int x=0; x<MYPAINT_TILE_SIZE; x++) {
 
@@ -602,6 +616,7 @@ void tile_perceptual_change_strokemap(PyObject * a_obj, PyObject * b_obj, PyObje
       res_p += 1;
     }
   }
+  Py_END_ALLOW_THREADS
 }
 
 
@@ -756,6 +771,163 @@ tile_combine (enum CombineMode mode,
         return;
     }
     const TileDataCombineOp *op = combine_mode_info[mode];
+
+    // Pure pixel work: let other rendering threads run meanwhile.
+    Py_BEGIN_ALLOW_THREADS
     op->combine_data(src_p, dst_p, dst_has_alpha, src_opacity);
+    Py_END_ALLOW_THREADS
 }
 
+
+
+/* tile_render_program(): run a whole compiled ops list for one tile */
+
+
+static const size_t tile_render_program_tile_elems
+    = MYPAINT_TILE_SIZE * MYPAINT_TILE_SIZE * 4;
+
+static const fix15_short_t *
+tile_render_program_zero_tile()
+{
+    static fix15_short_t zeros[MYPAINT_TILE_SIZE * MYPAINT_TILE_SIZE * 4];
+    return zeros;
+}
+
+void
+tile_render_program (PyObject *opcodes_obj,
+                     PyObject *modes_obj,
+                     PyObject *opacities_obj,
+                     PyObject *srcs_obj,
+                     PyObject *dst_obj,
+                     const bool dst_has_alpha,
+                     PyObject *stack_obj,
+                     PyObject *skips_obj)
+{
+    PyArrayObject* opcodes_arr = ((PyArrayObject*)opcodes_obj);
+    PyArrayObject* modes_arr = ((PyArrayObject*)modes_obj);
+    PyArrayObject* opacities_arr = ((PyArrayObject*)opacities_obj);
+    PyArrayObject* dst_arr = ((PyArrayObject*)dst_obj);
+    PyArrayObject* stack_arr = ((PyArrayObject*)stack_obj);
+#ifdef HEAVY_DEBUG
+    assert(PyArray_TYPE(opcodes_arr) == NPY_INT32);
+    assert(PyArray_TYPE(modes_arr) == NPY_INT32);
+    assert(PyArray_TYPE(opacities_arr) == NPY_FLOAT32);
+    assert(PyList_Check(srcs_obj));
+    assert(PyArray_TYPE(dst_arr) == NPY_UINT16);
+    assert(PyArray_ISCARRAY(dst_arr));
+    assert(PyArray_TYPE(stack_arr) == NPY_UINT16);
+    assert(PyArray_ISCARRAY(stack_arr));
+#endif
+
+    const int nops = PyArray_DIM(opcodes_arr, 0);
+    const int stack_depth = PyArray_DIM(stack_arr, 0);
+    const int32_t *opcodes = (const int32_t *)PyArray_DATA(opcodes_arr);
+    const int32_t *modes = (const int32_t *)PyArray_DATA(modes_arr);
+    const float *opacities = (const float *)PyArray_DATA(opacities_arr);
+    fix15_short_t *stack_p = (fix15_short_t *)PyArray_DATA(stack_arr);
+
+    // Collect source pointers while we still hold the GIL.
+    std::vector<const fix15_short_t *> srcs(nops, (const fix15_short_t *)NULL);
+    for (int i=0; i<nops && i<PyList_GET_SIZE(srcs_obj); i++) {
+        PyObject *src_obj = PyList_GET_ITEM(srcs_obj, i);
+        if (src_obj != Py_None) {
+            srcs[i] = (const fix15_short_t *)
+                PyArray_DATA((PyArrayObject *)src_obj);
+        }
+    }
+    std::vector<bool> skips(nops, false);
+    for (int i=0; i<PyList_GET_SIZE(skips_obj); i++) {
+        const long push_i = PyLong_AsLong(PyList_GET_ITEM(skips_obj, i));
+        if (push_i >= 0 && push_i < nops) {
+            skips[push_i] = true;
+        }
+    }
+    const size_t tile_bytes = tile_render_program_tile_elems
+                            * sizeof(fix15_short_t);
+
+    Py_BEGIN_ALLOW_THREADS
+
+    std::vector<fix15_short_t *> dst_stack;
+    std::vector<bool> alpha_stack;
+    fix15_short_t *dst = (fix15_short_t *)PyArray_DATA(dst_arr);
+    bool has_alpha = dst_has_alpha;
+
+    for (int i=0; i<nops; i++) {
+        const int mode = modes[i];
+        const float opacity = opacities[i];
+        const fix15_short_t *src = srcs[i];
+        switch (opcodes[i]) {
+        case RenderOpComposite: {
+            if (mode < 0 || mode >= NumCombineModes) {
+                break;
+            }
+            const TileDataCombineOp *op = combine_mode_info[mode];
+            // Same zero-alpha-source optimizations as composite_tile()
+            if (src == NULL || opacity == 0) {
+                if (has_alpha && op->zero_alpha_clears_backdrop()) {
+                    memset(dst, 0, tile_bytes);
+                    break;
+                }
+                if (! op->zero_alpha_has_effect()) {
+                    break;
+                }
+                if (src == NULL) {
+                    src = tile_render_program_zero_tile();
+                }
+            }
+            op->combine_data(src, dst, has_alpha, opacity);
+            break;
+        }
+        case RenderOpBlit:
+            if (src == NULL) {
+                memset(dst, 0, tile_bytes);
+            }
+            else {
+                memcpy(dst, src, tile_bytes);
+            }
+            break;
+        case RenderOpPush: {
+            if (skips[i]) {
+                // Empty group: jump over it, including its POP.
+                int skip_depth = 1;
+                while (skip_depth > 0 && i+1 < nops) {
+                    i++;
+                    if (opcodes[i] == RenderOpPush) skip_depth++;
+                    else if (opcodes[i] == RenderOpPop) skip_depth--;
+                }
+                break;
+            }
+            const int depth = dst_stack.size();
+            if (depth >= stack_depth) {
+                break;  // caller's fault: program was not validated
+            }
+            dst_stack.push_back(dst);
+            alpha_stack.push_back(has_alpha);
+            dst = stack_p + depth * tile_render_program_tile_elems;
+            memset(dst, 0, tile_bytes);
+            has_alpha = true;
+            break;
+        }
+        case RenderOpPop: {
+            if (dst_stack.empty()) {
+                break;
+            }
+            const fix15_short_t *popped = dst;
+            dst = dst_stack.back();
+            has_alpha = alpha_stack.back();
+            dst_stack.pop_back();
+            alpha_stack.pop_back();
+            if (mode < 0 || mode >= NumCombineModes) {
+                break;
+            }
+            combine_mode_info[mode]->combine_data(popped, dst, has_alpha,
+                                                  opacity);
+            break;
+        }
+        default:
+            break;
+        }
+    }
+
+    Py_END_ALLOW_THREADS
+}
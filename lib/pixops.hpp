@@ -40,11 +40,13 @@ void tile_clear_rgba8(PyObject *dst);
 
 // Converts a 15ish-bit tile array to 8bpp RGBA.
 // Used mainly for saving layers when alpha must be preserved.
+// Releases the GIL during the conversion.
 
 void tile_convert_rgba16_to_rgba8(PyObject *src, PyObject *dst, const float EOTF);
 
 
 // Converts a 15ish-bit tile array to 8bpp RGB ("ignoring" alpha).
+// Releases the GIL during the conversion.
 
 void tile_convert_rgbu16_to_rgbu8(PyObject *src, PyObject *dst, const float EOTF);
 
@@ -124,6 +126,8 @@ combine_mode_get_info(enum CombineMode mode);
 
 
 // Blend and composite one tile, writing into the destination.
+// The GIL is released while pixels are combined, so multiple
+// rendering threads can run this concurrently on different tiles.
 
 void
 tile_combine (enum CombineMode mode,
@@ -133,4 +137,39 @@ tile_combine (enum CombineMode mode,
               const float src_opacity);
 
 
+// Opcodes for tile_render_program().
+// Keep these in sync with lib.layer.rendering.Opcode.
+
+enum RenderOpcode {
+    RenderOpComposite = 1,
+    RenderOpBlit = 2,
+    RenderOpPush = 3,
+    RenderOpPop = 4
+};
+
+
+// Runs a compiled render program (see lib.layer.rendering.Program)
+// for one tile, writing into dst.
+//
+// opcodes, modes and opacities are 1-D arrays with one entry per op:
+// int32, int32, and float32 respectively. srcs is a list holding one
+// fix15 source tile per op, or None where the source has no data.
+// stack is a preallocated (depth, N, N, 4) uint16 array used for
+// isolated groups, with depth >= the maximum PUSH nesting.
+// skips is a list of the indices of PUSH ops whose groups are to be
+// skipped entirely, down to and including their matching POP.
+//
+// The GIL is released while the program runs.
+
+void
+tile_render_program (PyObject *opcodes_obj,
+                     PyObject *modes_obj,
+                     PyObject *opacities_obj,
+                     PyObject *srcs_obj,
+                     PyObject *dst_obj,
+                     const bool dst_has_alpha,
+                     PyObject *stack_obj,
+                     PyObject *skips_obj);
+
+
 #endif // PIXOPS_HPP
@@ -9,11 +9,85 @@
 
 from __future__ import division, print_function
 
+import zlib
+
 import numpy as np
 
 from . import brush
 
 
+## Stroke data encoding
+
+#: Fields recorded for each event: dtime, x, y, pressure, xtilt, ytilt,
+#: viewzoom, viewrotation, and barrel_rotation.
+EVENT_FIELDS = 9
+
+# Format versions of Stroke.stroke_data.
+_DATA_FLOAT64 = b'2'  # raw float64 events
+_DATA_FLOAT32 = b'3'  # raw float32 events
+_DATA_FLOAT32_ZDELTA = b'4'  # float32, XOR-delta encoded, zlib compressed
+
+
+def encode_events(events, compress=True):
+    """Encode an array of recorded events compactly, as bytes
+
+    :param numpy.ndarray events: Nx9 float32 array of events.
+    :param bool compress: Delta-encode and compress the data.
+    :rtype: bytes
+
+    Compression is lossless. The bit patterns of each event's values
+    are XORed with those of the previous event, which leaves mostly
+    zero bits for smoothly changing inputs.
+
+    >>> events = np.zeros((100, EVENT_FIELDS), 'float32')
+    >>> events[:, 1] = np.linspace(0.0, 1000.0, 100)
+    >>> data = encode_events(events)
+    >>> len(data) < events.nbytes // 4
+    True
+    >>> bool((decode_events(data) == events).all())
+    True
+    >>> bool((decode_events(encode_events(events, False)) == events).all())
+    True
+
+    """
+    events = np.ascontiguousarray(events, dtype='float32')
+    assert events.ndim == 2 and events.shape[1] == EVENT_FIELDS
+    if not compress:
+        return _DATA_FLOAT32 + events.tobytes()
+    bits = events.view('uint32')
+    deltas = bits.copy()
+    deltas[1:] ^= bits[:-1]
+    # Column-major order keeps each field's runs of zeros together.
+    data = zlib.compress(deltas.T.tobytes(), 1)
+    return _DATA_FLOAT32_ZDELTA + data
+
+
+def decode_events(data):
+    """Decode events encoded by encode_events()
+
+    :param bytes data: Encoded events, as stored in Stroke.stroke_data.
+    :returns: Nx9 float64 array of events.
+    :rtype: numpy.ndarray
+
+    """
+    version, data = data[0:1], data[1:]
+    if version == _DATA_FLOAT64:
+        events = np.frombuffer(data, dtype='float64')
+    elif version == _DATA_FLOAT32:
+        events = np.frombuffer(data, dtype='float32')
+    elif version == _DATA_FLOAT32_ZDELTA:
+        deltas = np.frombuffer(zlib.decompress(data), dtype='uint32')
+        deltas = deltas.reshape(EVENT_FIELDS, -1).T
+        bits = np.bitwise_xor.accumulate(deltas, axis=0)
+        events = bits.view('float32')
+    else:
+        raise ValueError("Unknown stroke data version %r" % (version,))
+    return events.reshape(-1, EVENT_FIELDS).astype('float64')
+
+
+## Class defs
+
+
 class Stroke (object):
     """Replayable record of a stroke's data
 
@@ -27,6 +101,13 @@ class Stroke (object):
 
     _SERIAL_NUMBER = 0
 
+    #: Events to allocate space for when recording starts.
+    #: The space is doubled whenever it fills up.
+    INITIAL_EVENT_CAPACITY = 256
+
+    #: Compress finished strokes' data. See encode_events().
+    COMPRESS_EVENTS = True
+
     def __init__(self):
         """Initialize"""
         super(Stroke, self).__init__()
@@ -48,27 +129,33 @@ class Stroke (object):
         self.brush = brush
         self.brush.new_stroke()  # resets the stroke_* members of the brush
 
-        self.tmp_event_list = []
+        self._events = np.empty(
+            (self.INITIAL_EVENT_CAPACITY, EVENT_FIELDS),
+            dtype='float32',
+        )
+        self._num_events = 0
 
     def record_event(self, dtime, x, y, pressure, xtilt, ytilt,
                      viewzoom, viewrotation, barrel_rotation):
         assert not self.finished
-        self.tmp_event_list.append((dtime, x, y, pressure, xtilt, ytilt,
-                                    viewzoom, viewrotation, barrel_rotation))
+        n = self._num_events
+        events = self._events
+        if n >= len(events):
+            grown = np.empty((2 * len(events), EVENT_FIELDS), 'float32')
+            grown[:n] = events
+            self._events = events = grown
+        events[n] = (dtime, x, y, pressure, xtilt, ytilt,
+                     viewzoom, viewrotation, barrel_rotation)
+        self._num_events = n + 1
 
     def stop_recording(self):
         if self.finished:
             return
-        # OPTIMIZE
-        # - for space: just gzip? use integer datatypes?
-        # - for time: maybe already use array storage while recording?
-        data = np.array(self.tmp_event_list, dtype='float64')
-        data = data.tostring()
-        version = b'2'
-        self.stroke_data = version + data
+        events = self._events[:self._num_events]
+        self.stroke_data = encode_events(events, self.COMPRESS_EVENTS)
 
         self.total_painting_time = self.brush.get_total_stroke_painting_time()
-        del self.brush, self.tmp_event_list
+        del self.brush, self._events, self._num_events
         self.finished = True
 
     def is_empty(self):
@@ -79,16 +166,14 @@ class Stroke (object):
     def render(self, surface):
         assert self.finished
 
-        # OPTIMIZE: check if parsing of settings is a performance bottleneck
-        b = brush.Brush(brush.BrushInfo(self.brush_settings))
+        # Each distinct brush is parsed only once, see lib.brush.
+        brushinfo = brush.get_parsed_brushinfo(self.brush_settings)
+        b = brush.Brush(brushinfo, observe=False)
 
         states = np.fromstring(self.brush_state, dtype='float32')
         b.set_states_from_array(states)
 
-        version, data = self.stroke_data[0], self.stroke_data[1:]
-        assert version == b'2'
-        data = np.fromstring(data, dtype='float64')
-        data.shape = (len(data) // 9, 9)
+        data = decode_events(self.stroke_data)
 
         surface.begin_atomic()
         for (dtime, x, y, pressure, xtilt, ytilt, viewzoom,
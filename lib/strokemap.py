@@ -29,6 +29,80 @@ TILE_SIZE = N = mypaintlib.TILE_SIZE
 
 ## Class defs
 
+class BrushTable (object):
+    """Interned brush settings strings, referred to by integer id.
+
+    Strokes painted with the same brush share one copy of its settings
+    string. Tables only ever grow, so ids stay valid for as long as the
+    table exists. Byte strings are stored decoded, so strings loaded
+    from files match the ones recorded while painting.
+
+    >>> table = BrushTable()
+    >>> table.intern(u'{"x": 1}')
+    0
+    >>> table.intern(b'{"x": 1}')
+    0
+    >>> table.intern(u'{"y": 2}')
+    1
+    >>> table[1] == u'{"y": 2}'
+    True
+    >>> len(table)
+    2
+
+    Copying a table shares it.
+
+    >>> import copy
+    >>> copy.deepcopy(table) is table
+    True
+
+    """
+
+    def __init__(self):
+        super(BrushTable, self).__init__()
+        self._strings = []
+        self._ids = {}
+
+    def __repr__(self):
+        return "<BrushTable len=%d>" % (len(self._strings),)
+
+    def __len__(self):
+        return len(self._strings)
+
+    def __getitem__(self, brush_id):
+        return self._strings[brush_id]
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def intern(self, brush_string):
+        """Get the id of a brush settings string, adding it if needed.
+
+        :param brush_string: Brush settings, as bytes or unicode.
+        :returns: The string's id in this table.
+        :rtype: int
+
+        """
+        if isinstance(brush_string, bytes):
+            try:
+                brush_string = brush_string.decode("utf-8")
+            except UnicodeDecodeError:
+                pass
+        brush_id = self._ids.get(brush_string)
+        if brush_id is None:
+            brush_id = len(self._strings)
+            self._strings.append(brush_string)
+            self._ids[brush_string] = brush_id
+        return brush_id
+
+
+#: Table for shapes which aren't given one, e.g. in layers outside a
+#: document.
+_default_brush_table = BrushTable()
+
+
 class StrokeShape (object):
     """The shape of a single brushstroke.
 
@@ -37,12 +111,52 @@ class StrokeShape (object):
     tile (for fast lookup).
 
     """
-    def __init__(self):
-        """Construct a new, blank StrokeShape."""
+    def __init__(self, brush_table=None):
+        """Construct a new, blank StrokeShape.
+
+        :param BrushTable brush_table: Where to keep brush settings.
+
+        """
         object.__init__(self)
         self.tasks = idletask.Processor()
         self.strokemap = {}
-        self.brush_string = None
+        if brush_table is None:
+            brush_table = _default_brush_table
+        #: The table holding the shape's brush settings string.
+        self.brush_table = brush_table
+        #: Index of the shape's brush settings in brush_table, or None.
+        self.brush_id = None
+        #: Positions (tx, ty) of all the tiles the shape may touch.
+        #: This is kept up to date without waiting for queued tasks,
+        #: but it may include positions where the bitmap is empty.
+        self.tile_indices = set()
+
+    @property
+    def brush_string(self):
+        """The brush settings used for the stroke, or None.
+
+        Setting this interns the string in the shape's brush_table.
+
+        >>> shape = StrokeShape(BrushTable())
+        >>> shape.brush_string is None
+        True
+        >>> shape.brush_string = u'{"x": 1}'
+        >>> shape.brush_id
+        0
+        >>> shape.brush_string == u'{"x": 1}'
+        True
+
+        """
+        if self.brush_id is None:
+            return None
+        return self.brush_table[self.brush_id]
+
+    @brush_string.setter
+    def brush_string(self, brush_string):
+        if brush_string is None:
+            self.brush_id = None
+        else:
+            self.brush_id = self.brush_table.intern(brush_string)
 
     @classmethod
     def _mock(cls):
@@ -53,36 +167,37 @@ class StrokeShape (object):
         return StrokeShape.new_from_snapshots(snap1, snap2)
 
     @classmethod
-    def new_from_snapshots(cls, before, after):
+    def new_from_snapshots(cls, before, after, brush_table=None, pool=None):
         """Build a new StrokeShape from before+after pair of snapshots.
 
         :param before: snapshot of the layer before the stroke
         :type before: lib.tiledsurface._TiledSurfaceSnapshot
         :param after: snapshot of the layer after the stroke
         :type after: lib.tiledsurface._TiledSurfaceSnapshot
+        :param BrushTable brush_table: Where to keep brush settings.
+        :param lib.workers.WorkerPool pool: Where to diff tiles.
         :returns: A new StrokeShape, or None.
 
         If the snapshots haven't changed, None is returned. In this
         case, no StrokeShape should be recorded.
 
+        Only the tiles written between the snapshots are diffed, if the
+        surface logged them (see tiledsurface.changed_tile_indices()).
+        The pixel diffs are made later, in batches, by queued tasks.
+
         """
-        before_dict = before.tiledict
-        after_dict = after.tiledict
-        before_tiles = set(before_dict.items())
-        after_tiles = set(after_dict.items())
-        changed_idxs = set(
-            pos for pos, data
-            in before_tiles.symmetric_difference(after_tiles)
-        )
+        changed_idxs = tiledsurface.changed_tile_indices(before, after)
         if not changed_idxs:
             return None
-        shape = cls()
+        shape = cls(brush_table=brush_table)
         assert not shape.strokemap
+        shape.tile_indices = set(changed_idxs)
         shape.tasks.add_work(_TileDiffUpdateTask(
             before.tiledict,
             after.tiledict,
             changed_idxs,
             shape.strokemap,
+            pool=pool,
         ))
         return shape
 
@@ -106,6 +221,7 @@ class StrokeShape (object):
             tile = _Tile.new_from_compressed_bitmap(compressed_bitmap)
             self.strokemap[tx + translate_x, ty + translate_y] = tile
             data = data[size+3*4:]
+        self.tile_indices = set(self.strokemap)
 
     def save_to_string(self, translate_x, translate_y):
         """Return a compressed bytes string representing the stroke shape.
@@ -213,8 +329,27 @@ class StrokeShape (object):
                 diff_tile.write_to_surface_tile_array(surf_arr)
 
     def translate(self, dx, dy):
-        """Translate the shape by (dx, dy)"""
+        """Translate the shape by (dx, dy)
+
+        >>> shape = StrokeShape()
+        >>> shape.tile_indices = {(0, 0)}
+        >>> shape.translate(N, -N)
+        >>> sorted(shape.tile_indices)
+        [(1, -1)]
+        >>> shape.translate(1, 0)
+        >>> sorted(shape.tile_indices)
+        [(1, -1), (2, -1)]
+
+        """
         self.tasks.finish_all()
+        slices_x = tiledsurface.calc_translation_slices(int(dx))
+        slices_y = tiledsurface.calc_translation_slices(int(dy))
+        self.tile_indices = set(
+            (tx + tdx, ty + tdy)
+            for (tx, ty) in self.tile_indices
+            for (src_x, (tdx, targ_x0, targ_x1)) in slices_x
+            for (src_y, (tdy, targ_y0, targ_y1)) in slices_y
+        )
         tmp = {}
         self.tasks.add_work(_TileTranslateTask(self.strokemap, tmp, dx, dy))
         self.tasks.add_work(_TileRecompressTask(tmp, self.strokemap))
@@ -235,29 +370,37 @@ class StrokeShape (object):
         for tx, ty in list(self.strokemap.keys()):
             if tx*N+N < x or ty*N+N < y or tx*N > x+w or ty*N > y+h:
                 self.strokemap.pop((tx, ty))
+        self.tile_indices = set(self.strokemap)
         return bool(self.strokemap)
 
 
 class _TileDiffUpdateTask:
     """Idle task: update strokemap with tile & pixel diffs of snapshots.
 
-    This task is used during initialization of the StrokeShape.
+    This task is used during initialization of the StrokeShape. Tiles
+    are diffed and compressed in batches, which are spread over a
+    worker pool if there is one.
 
     """
 
-    def __init__(self, before, after, changed_idxs, targ):
+    #: Tiles to diff per call, for each worker in the pool.
+    TILES_PER_WORKER = 8
+
+    def __init__(self, before, after, changed_idxs, targ, pool=None):
         """Initialize, ready to update a target StrokeShape with diffs
 
         :param dict before: Complete pre-stroke tiledict (RO, {xy:Tile})
         :param dict after: Complete post-stroke tiledict (RO, {xy:Tile})
         :param set changed_idxs: RW set of (x,y) tile indexes to process
         :param dict targ: Target strokemap (WO, {xy: bytes})
+        :param lib.workers.WorkerPool pool: Where to diff tiles.
 
         """
         self._before_dict = before
         self._after_dict = after
         self._targ_dict = targ
         self._remaining = changed_idxs
+        self._pool = pool
 
     def __repr__(self):
         return "<{name} remaining={remaining}>".format(
@@ -266,30 +409,40 @@ class _TileDiffUpdateTask:
         )
 
     def __call__(self):
-        """Diff and update one queued tile."""
-        try:
-            ti = self._remaining.pop()
-        except KeyError:
+        """Diff and update a batch of queued tiles."""
+        remaining = self._remaining
+        if not remaining:
             return False
-        self._update_tile(ti)
-        return bool(self._remaining)
+        batch_size = self.TILES_PER_WORKER
+        if self._pool is not None:
+            batch_size *= self._pool.workers
+        batch = []
+        while remaining and len(batch) < batch_size:
+            batch.append(remaining.pop())
+        self._update_tiles(batch)
+        return bool(remaining)
 
     def process_tile_subset(self, pred):
         """Diff and update a subset of queued tiles now."""
-        processed = set()
-        for ti in self._remaining:
-            if not pred(ti):
-                continue
-            self._update_tile(ti)
-            processed.add(ti)
+        processed = set(ti for ti in self._remaining if pred(ti))
+        self._update_tiles(processed)
         self._remaining -= processed
 
-    def _update_tile(self, ti):
-        """Diff and update the tile at a specified position."""
+    def _update_tiles(self, tile_indices):
+        """Diff and update the tiles at the specified positions."""
         transparent = tiledsurface.transparent_tile
-        data_before = self._before_dict.get(ti, transparent).rgba
-        data_after = self._after_dict.get(ti, transparent).rgba
-        self._targ_dict[ti] = _Tile.new_from_diff(data_before, data_after)
+        jobs = []
+        for ti in tile_indices:
+            # Tile pixels are fetched here because it may page them in.
+            data_before = self._before_dict.get(ti, transparent).rgba
+            data_after = self._after_dict.get(ti, transparent).rgba
+            jobs.append((ti, data_before, data_after))
+        if self._pool is None or len(jobs) < 2:
+            results = (_diff_tile_job(job) for job in jobs)
+        else:
+            results = self._pool.imap_unordered(_diff_tile_job, jobs)
+        for ti, tile in results:
+            self._targ_dict[ti] = tile
 
 
 class _TileTranslateTask:
@@ -654,6 +807,12 @@ class _TileIndexPredicate (object):
         return True
 
 
+def _diff_tile_job(job):
+    """Diff and compress one tile: a _TileDiffUpdateTask worker job."""
+    ti, data_before, data_after = job
+    return (ti, _Tile.new_from_diff(data_before, data_after))
+
+
 def _pixel_bbox_to_tile_range(bbox):
     """Convert a pixel area to testable ranges of tiles.
 
@@ -13,6 +13,7 @@
 from __future__ import division, print_function
 
 import abc
+import collections
 import os
 import logging
 
@@ -23,6 +24,7 @@ import lib.helpers
 from lib.errors import FileHandlingError
 from lib.gettext import C_
 import lib.feedback
+import lib.parallelpng
 from lib.pycompat import xrange
 
 
@@ -33,6 +35,24 @@ N = mypaintlib.TILE_SIZE
 # throttle excesssive calls to the save/render progress monitor objects
 TILES_PER_CALLBACK = 256
 
+#: PNG row filter strategies, by name.
+#: The values are masks of libpng's PNG_FILTER_* flags.
+PNG_FILTERS = {
+    "none": 0x08,
+    "sub": 0x10,
+    "up": 0x20,
+    "average": 0x40,
+    "paeth": 0x80,
+    "adaptive": 0xf8,  # the best of all the above, row by row
+}
+
+#: Named PNG compression settings: {name: (zlib level, filter name)}.
+PNG_COMPRESSION_PROFILES = {
+    "fast": (1, "sub"),  # for autosaves
+    "default": (2, "sub"),
+    "small": (9, "adaptive"),  # for archival exports
+}
+
 
 class Bounded (object):
     """Interface for objects with an inherent size"""
@@ -131,6 +151,44 @@ class TileCompositable (Bounded):
         """
 
 
+def get_png_compression(compression=None):
+    """Look up the PNG writer settings for a compression setting
+
+    :param compression: A name from PNG_COMPRESSION_PROFILES, or a
+        (level, filter) tuple with a zlib level from 0 to 9 and a name
+        from PNG_FILTERS. None means "default".
+    :returns: (level, filters): args for the PNG writers.
+    :rtype: tuple
+    :raises ValueError: if the setting isn't recognized.
+
+    >>> get_png_compression()
+    (2, 16)
+    >>> get_png_compression("fast")
+    (1, 16)
+    >>> get_png_compression((9, "paeth"))
+    (9, 128)
+    >>> get_png_compression("tiny")
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown PNG compression setting 'tiny'
+
+    """
+    if compression is None:
+        compression = "default"
+    setting = PNG_COMPRESSION_PROFILES.get(compression, compression)
+    try:
+        level, filter_name = setting
+        level = int(level)
+        filters = PNG_FILTERS[filter_name]
+    except (TypeError, ValueError, KeyError):
+        level = None
+    if level is None or not (0 <= level <= 9):
+        raise ValueError(
+            "Unknown PNG compression setting %r" % (compression,)
+        )
+    return (level, filters)
+
+
 def get_tiles_bbox(tcoords):
     """Convert tile coords to a data bounding box
 
@@ -144,19 +202,26 @@ def get_tiles_bbox(tcoords):
 
 
 def scanline_strips_iter(surface, rect, alpha=False,
-                         single_tile_pattern=False, **kwargs):
+                         single_tile_pattern=False, pool=None, **kwargs):
     """Generate (render) scanline strips from a tile-blittable object
 
     :param lib.surface.TileBlittable surface: Surface to iterate over
     :param bool alpha: If true, write a PNG with alpha
     :param bool single_tile_pattern: True if surface is a one tile only.
+    :param lib.workers.WorkerPool pool: Render tile rows ahead in this.
     :param tuple \*\*kwargs: Passed to blit_tile_into.
 
     The `alpha` parameter is passed to the surface's `blit_tile_into()`.
     Rendering is skipped for all but the first line of single-tile patterns.
 
+    If a parallel `pool` is given, several tile rows are rendered ahead
+    at once by its workers while the caller consumes earlier strips.
+    The surface's `blit_tile_into()` must then be safe to call from
+    several threads at once.
+
     The scanline strips yielded by this generator are suitable for
-    feeding to a mypaintlib.ProgressivePNGWriter.
+    feeding to a mypaintlib.ProgressivePNGWriter. Unless a pool is
+    used, they share one buffer, which is overwritten by the next one.
 
     """
     # Sizes
@@ -170,14 +235,31 @@ def scanline_strips_iter(surface, rect, alpha=False,
     render_tw = (x + w - 1) // N - render_tx + 1
     render_th = (y + h - 1) // N - render_ty + 1
 
-    # buffer for rendering one tile row at a time
-    arr = np.empty((N, render_tw * N, 4), 'uint8')  # rgba or rgbu
-    # view into arr without the horizontal padding
-    arr_xcrop = arr[:, x-render_tx*N:x-render_tx*N+w, :]
-
     first_row = render_ty
     last_row = render_ty+render_th-1
 
+    def _crop(arr, ty):
+        # view into arr without the padding
+        res = arr[:, x-render_tx*N:x-render_tx*N+w, :]
+        if ty == last_row:
+            res = res[:y+h-ty*N, :, :]
+        if ty == first_row:
+            res = res[y-render_ty*N:, :, :]
+        return res
+
+    if pool is not None and pool.parallel and not single_tile_pattern:
+        strips = _pipelined_strips_iter(
+            surface, pool, alpha,
+            render_tx, render_tw, first_row, last_row,
+            kwargs,
+        )
+        for ty, arr in strips:
+            yield _crop(arr, ty)
+        return
+
+    # buffer for rendering one tile row at a time
+    arr = np.empty((N, render_tw * N, 4), 'uint8')  # rgba or rgbu
+
     for ty in range(render_ty, render_ty+render_th):
         skip_rendering = False
         if single_tile_pattern:
@@ -186,38 +268,70 @@ def scanline_strips_iter(surface, rect, alpha=False,
             if ty != first_row:
                 skip_rendering = True
 
-        for tx_rel in xrange(render_tw):
-            # render one tile
-            dst = arr[:, tx_rel*N:(tx_rel+1)*N, :]
-            if not skip_rendering:
-                tx = render_tx + tx_rel
-                try:
-                    surface.blit_tile_into(dst, alpha, tx, ty, **kwargs)
-                except Exception:
-                    logger.exception("Failed to blit tile %r of %r",
-                                     (tx, ty), surface)
-                    mypaintlib.tile_clear_rgba8(dst)
+        if not skip_rendering:
+            _render_tile_row(surface, arr, alpha, render_tx, ty, kwargs)
 
         # yield a numpy array of the scanline without padding
-        res = arr_xcrop
-        if ty == last_row:
-            res = res[:y+h-ty*N, :, :]
-        if ty == first_row:
-            res = res[y-render_ty*N:, :, :]
-        yield res
+        yield _crop(arr, ty)
+
+
+#: Tile rows per pool worker which may be rendered ahead at once.
+STRIPS_PER_WORKER = 2
+
+
+def _pipelined_strips_iter(surface, pool, alpha, render_tx, render_tw,
+                           first_row, last_row, kwargs):
+    """Internal: render tile rows ahead in a pool, yielding in order
+
+    Each row gets its own buffer. Only a few rows per worker are
+    rendered ahead, to bound the memory used.
+
+    """
+    def render_row(ty):
+        arr = np.empty((N, render_tw * N, 4), 'uint8')
+        _render_tile_row(surface, arr, alpha, render_tx, ty, kwargs)
+        return arr
+
+    lookahead = max(1, pool.workers * STRIPS_PER_WORKER)
+    jobs = collections.deque()  # [(ty, result)]
+    for ty in range(first_row, last_row+1):
+        jobs.append((ty, pool.submit(render_row, ty)))
+        if len(jobs) >= lookahead:
+            ty, result = jobs.popleft()
+            yield (ty, result.get())
+    while jobs:
+        ty, result = jobs.popleft()
+        yield (ty, result.get())
+
+
+def _render_tile_row(surface, arr, alpha, render_tx, ty, kwargs):
+    """Internal: render one row of tiles into a strip buffer"""
+    for tx_rel in xrange(arr.shape[1] // N):
+        # render one tile
+        dst = arr[:, tx_rel*N:(tx_rel+1)*N, :]
+        tx = render_tx + tx_rel
+        try:
+            surface.blit_tile_into(dst, alpha, tx, ty, **kwargs)
+        except Exception:
+            logger.exception("Failed to blit tile %r of %r",
+                             (tx, ty), surface)
+            mypaintlib.tile_clear_rgba8(dst)
 
 
 def save_as_png(surface, filename, *rect, **kwargs):
     """Saves a tile-blittable surface to a file in PNG format
 
     :param TileBlittable surface: Surface to save
-    :param unicode filename: The file to write
+    :param unicode filename: The file to write, or a writable file object
     :param tuple \*rect: Rectangle (x, y, w, h) to save
     :param bool alpha: If true, write a PNG with alpha
     :param progress: Updates a UI every scanline strip.
     :type progress: lib.feedback.Progress or None
     :param bool single_tile_pattern: True if surface is one tile only.
     :param bool save_srgb_chunks: Set to False to not save sRGB flags.
+    :param lib.workers.WorkerPool pool: Use for pipelined rendering.
+    :param compression: PNG compression profile name, or (level, filter)
+        tuple. See get_png_compression().
     :param tuple \*\*kwargs: Passed to blit_tile_into (minus the above)
 
     The `alpha` parameter is passed to the surface's `blit_tile_into()`
@@ -229,6 +343,11 @@ def save_as_png(surface, filename, *rect, **kwargs):
     cHRM and gAMA) will not be saved. MyPaint's default behaviour is
     currently to save these chunks.
 
+    If a parallel `pool` is given, its workers render tile rows ahead
+    while earlier strips are compressed, and the strips are compressed
+    in parallel too, by a lib.parallelpng.ParallelPNGWriter. Otherwise
+    rendering and compression alternate, in the calling thread.
+
     Raises `lib.errors.FileHandlingError` with a descriptive string if
     something went wrong.
 
@@ -238,6 +357,11 @@ def save_as_png(surface, filename, *rect, **kwargs):
     progress = kwargs.pop('progress', None)
     single_tile_pattern = kwargs.pop("single_tile_pattern", False)
     save_srgb_chunks = kwargs.pop("save_srgb_chunks", True)
+    pool = kwargs.pop("pool", None)
+    if pool is not None and not pool.parallel:
+        pool = None
+    compression = kwargs.pop("compression", None)
+    level, filters = get_png_compression(compression)
 
     # Sizes. Save at least one tile to allow empty docs to be written
     if not rect:
@@ -252,25 +376,47 @@ def save_as_png(surface, filename, *rect, **kwargs):
     num_strips = int((1 + ((y + h) // N)) - (y // N))
     progress.items = num_strips
 
+    path = filename
+    if hasattr(filename, "write"):
+        path = getattr(filename, "name", u"")
     try:
         logger.debug(
-            "Writing %r (%dx%d) alpha=%r srgb=%r",
+            "Writing %r (%dx%d) alpha=%r srgb=%r pool=%r "
+            "compression=%r",
             filename,
             w, h,
             alpha,
             save_srgb_chunks,
+            pool,
+            compression,
         )
-        with open(filename, "wb") as writer_fp:
-            pngsave = mypaintlib.ProgressivePNGWriter(
-                writer_fp,
-                w, h,
-                alpha,
-                save_srgb_chunks,
-            )
+        if hasattr(filename, "write"):
+            writer_fp = filename
+        else:
+            writer_fp = open(filename, "wb")
+        try:
+            if pool is not None:
+                pngsave = lib.parallelpng.ParallelPNGWriter(
+                    writer_fp,
+                    w, h,
+                    alpha,
+                    save_srgb_chunks,
+                    pool,
+                    level, filters,
+                )
+            else:
+                pngsave = mypaintlib.ProgressivePNGWriter(
+                    writer_fp,
+                    w, h,
+                    alpha,
+                    save_srgb_chunks,
+                    level, filters,
+                )
             scanline_strips = scanline_strips_iter(
                 surface, rect,
                 alpha=alpha,
                 single_tile_pattern=single_tile_pattern,
+                pool=pool,
                 **kwargs
             )
             for scanline_strip in scanline_strips:
@@ -286,6 +432,9 @@ def save_as_png(surface, filename, *rect, **kwargs):
                     )
                     progress = None
             pngsave.close()
+        finally:
+            if writer_fp is not filename:
+                writer_fp.close()
         logger.debug("Finished writing %r", filename)
         if progress:
             progress.close()
@@ -302,8 +451,8 @@ def save_as_png(surface, filename, *rect, **kwargs):
             u"Target folder: “{dirname}”."
         ).format(
             err = err,
-            basename = os.path.basename(filename),
-            dirname = os.path.dirname(filename),
+            basename = os.path.basename(path),
+            dirname = os.path.dirname(path),
         ))
         # Other possible exceptions include TypeError, ValueError, but
         # those indicate incorrect coding usually; just raise them
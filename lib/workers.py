@@ -0,0 +1,514 @@
+# This file is part of MyPaint.
+# Copyright (C) 2026 by the MyPaint Development Team.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+
+"""Worker thread pools for CPU-heavy, GIL-releasing work.
+
+The pixel-pushing parts of mypaintlib release the GIL while they run,
+so batches of independent tiles can be processed by several threads
+at once. Pools are started lazily, and a pool configured with only one
+worker runs everything serially in the calling thread. There's also a
+queue for running piecemeal tasks in a background thread.
+
+"""
+
+## Imports
+
+from __future__ import division, print_function
+
+import collections
+import io
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+## Helper funcs
+
+def default_worker_count():
+    """Number of workers to use when none is configured: one per CPU.
+
+    >>> default_worker_count() >= 1
+    True
+
+    """
+    try:
+        return max(1, multiprocessing.cpu_count())
+    except NotImplementedError:
+        return 1
+
+
+def split_into_chunks(items, nchunks):
+    """Split a sequence into at most nchunks contiguous runs.
+
+    >>> split_into_chunks(list(range(7)), 3)
+    [[0, 1, 2], [3, 4, 5], [6]]
+    >>> split_into_chunks([1, 2], 5)
+    [[1], [2]]
+    >>> split_into_chunks([], 4)
+    []
+
+    """
+    items = list(items)
+    nchunks = max(1, int(nchunks))
+    size = max(1, -(-len(items) // nchunks))
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+
+## Class defs
+
+class WorkerPool (object):
+    """A lazily started pool of worker threads.
+
+    >>> pool = WorkerPool(workers=3)
+    >>> pool.parallel
+    True
+    >>> list(pool.imap(lambda x: x * 2, range(5)))
+    [0, 2, 4, 6, 8]
+    >>> pool.close()
+
+    Pools with a single worker don't start any threads.
+
+    >>> serial = WorkerPool(workers=1)
+    >>> serial.parallel
+    False
+    >>> list(serial.imap(lambda x: x + 1, range(3)))
+    [1, 2, 3]
+
+    A worker count of zero or None means one worker per CPU.
+
+    """
+
+    def __init__(self, workers=None):
+        super(WorkerPool, self).__init__()
+        self._lock = threading.Lock()
+        self._pool = None
+        self._workers = 1
+        self.workers = workers
+
+    def __repr__(self):
+        return "<WorkerPool workers=%d running=%r>" % (
+            self._workers,
+            self._pool is not None,
+        )
+
+    @property
+    def workers(self):
+        """Number of worker threads used for parallel work."""
+        return self._workers
+
+    @workers.setter
+    def workers(self, n):
+        if not n:
+            n = default_worker_count()
+        n = max(1, int(n))
+        if n == self._workers:
+            return
+        self.close()
+        self._workers = n
+
+    @property
+    def parallel(self):
+        """True if work submitted to this pool can run in parallel."""
+        return self._workers > 1
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                logger.debug("Starting %d worker threads", self._workers)
+                self._pool = ThreadPool(self._workers)
+            return self._pool
+
+    def imap(self, func, iterable):
+        """Like itertools.imap(), results in order, maybe in parallel."""
+        if not self.parallel:
+            return (func(i) for i in iterable)
+        return self._get_pool().imap(func, iterable)
+
+    def imap_unordered(self, func, iterable):
+        """Like imap(), but results come back as they complete."""
+        if not self.parallel:
+            return (func(i) for i in iterable)
+        return self._get_pool().imap_unordered(func, iterable)
+
+    def submit(self, func, *args):
+        """Run func(*args), maybe in parallel.
+
+        :returns: An object with ready(), wait() and get() methods,
+            like multiprocessing.pool.AsyncResult.
+
+        Serial pools run the function immediately.
+
+        """
+        if not self.parallel:
+            return _FinishedResult(func, args)
+        return self._get_pool().apply_async(func, args)
+
+    def close(self):
+        """Stop any running worker threads after they finish."""
+        with self._lock:
+            pool = self._pool
+            self._pool = None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+class _FinishedResult (object):
+    """Result of a job which ran immediately, like an AsyncResult."""
+
+    def __init__(self, func, args):
+        super(_FinishedResult, self).__init__()
+        self._value = None
+        self._error = None
+        try:
+            self._value = func(*args)
+        except Exception as e:
+            self._error = e
+
+    def ready(self):
+        return True
+
+    def wait(self, timeout=None):
+        pass
+
+    def get(self, timeout=None):
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class OrderedZipWriter (object):
+    """Adds entries to a zipfile in order, encoding them in a pool.
+
+    This wraps a zipfile.ZipFile open for writing, and supports the
+    write() and writestr() methods used when saving OpenRaster files.
+    Slow-to-encode entries can be added with writestr_from_job(). The
+    jobs write into memory buffers in a WorkerPool, but the entries
+    are still added in the order of the calls, as soon as all the jobs
+    before them finish. Nothing goes through tempfiles.
+
+    >>> import zipfile, io
+    >>> buf = io.BytesIO()
+    >>> zf = zipfile.ZipFile(buf, "w")
+    >>> writer = OrderedZipWriter(zf, WorkerPool(workers=3))
+    >>> def write_text(fp, text):
+    ...     n = fp.write(text.encode("ascii"))
+    >>> for i in range(5):
+    ...     writer.writestr_from_job(write_text, "f%d.txt" % (i,), "x")
+    >>> writer.writestr("last.txt", b"y")
+    >>> writer.close()
+    >>> zf.namelist()
+    ['f0.txt', 'f1.txt', 'f2.txt', 'f3.txt', 'f4.txt', 'last.txt']
+    >>> zf.read("f4.txt") == b"x"
+    True
+    >>> zf.close()
+
+    To bound the memory used by encoded data waiting for its turn,
+    only a few jobs per worker can be queued at once. Queueing more
+    waits for the oldest ones.
+
+    Entries can be recorded with a key identifying their content. When
+    the next zipfile is written, entries with the same key can then be
+    copied over from this one instead of being encoded again.
+
+    >>> buf2 = io.BytesIO()
+    >>> zf2 = zipfile.ZipFile(buf2, "w")
+    >>> zf = zipfile.ZipFile(buf, "r")
+    >>> writer = OrderedZipWriter(zf2, WorkerPool(workers=1),
+    ...                           previous=zf,
+    ...                           previous_members={"k": "f4.txt"})
+    >>> writer.reuse_member("k", "copy.txt")
+    True
+    >>> writer.reuse_member("nope", "copy2.txt")
+    False
+    >>> writer.close()
+    >>> zf2.read("copy.txt") == b"x"
+    True
+    >>> writer.members
+    {'k': 'copy.txt'}
+
+    """
+
+    #: Jobs per pool worker which may be queued at once.
+    JOBS_PER_WORKER = 2
+
+    def __init__(self, zf, pool, previous=None, previous_members=None):
+        """Initialize, wrapping a zipfile.
+
+        :param zipfile.ZipFile zf: Zipfile open for writing.
+        :param WorkerPool pool: Where to run jobs.
+        :param zipfile.ZipFile previous: Earlier zipfile, open for reading.
+        :param dict previous_members: The previous zipfile's keyed
+            entries, as recorded in its writer's `members`.
+
+        """
+        super(OrderedZipWriter, self).__init__()
+        self._zf = zf
+        self._pool = pool
+        self._queue = collections.deque()  # [(result_or_None, add_func)]
+        self._jobs = 0
+        self._previous = previous
+        self._previous_members = previous_members or {}
+        #: Entries recorded with a key: {key: arcname}.
+        self.members = {}
+
+    def __repr__(self):
+        return "<OrderedZipWriter queued=%d jobs=%d>" % (
+            len(self._queue),
+            self._jobs,
+        )
+
+    def writestr_from_job(self, func, zinfo_or_arcname, *args):
+        """Run a job writing an entry's data, then add it to the zip.
+
+        :param callable func: Called as func(fp, *args) in a worker
+            thread. It must write the entry's data to the file object
+            fp, which is an in-memory buffer.
+        :param zinfo_or_arcname: Entry name, as for ZipFile.writestr().
+
+        """
+        max_jobs = max(1, self._pool.workers * self.JOBS_PER_WORKER)
+        if self._jobs >= max_jobs:
+            self._drain(wait_until=max_jobs - 1)
+        result = self._pool.submit(_write_to_buffer, func, args)
+        self._jobs += 1
+        self._queue.append((
+            result,
+            lambda data: self._zf.writestr(zinfo_or_arcname, data),
+        ))
+        self._drain()
+
+    def write(self, *args, **kwargs):
+        """Queue a call to the zipfile's write()."""
+        self._queue.append((
+            None,
+            lambda data: self._zf.write(*args, **kwargs),
+        ))
+        self._drain()
+
+    def writestr(self, *args, **kwargs):
+        """Queue a call to the zipfile's writestr()."""
+        self._queue.append((
+            None,
+            lambda data: self._zf.writestr(*args, **kwargs),
+        ))
+        self._drain()
+
+    def record_member(self, key, zinfo_or_arcname):
+        """Record that an entry holds the content identified by key."""
+        arcname = getattr(zinfo_or_arcname, "filename", zinfo_or_arcname)
+        self.members[key] = arcname
+
+    def reuse_member(self, key, zinfo_or_arcname):
+        """Copy an entry with the same key from the previous zipfile.
+
+        :param key: Hashable content key, see record_member().
+        :param zinfo_or_arcname: Entry name, as for ZipFile.writestr().
+        :returns: True if a copy was queued and recorded.
+
+        The entry's data is copied as-is, without being decoded.
+
+        """
+        previous = self._previous
+        if previous is None:
+            return False
+        name = self._previous_members.get(key)
+        if name is None:
+            return False
+        try:
+            previous.getinfo(name)
+        except KeyError:
+            return False
+        self._queue.append((
+            None,
+            lambda data: self._zf.writestr(
+                zinfo_or_arcname,
+                previous.read(name),
+            ),
+        ))
+        self.record_member(key, zinfo_or_arcname)
+        self._drain()
+        return True
+
+    def _drain(self, wait_until=None, progress=None):
+        """Add entries from the head of the queue to the zip.
+
+        Stops at the first unfinished job, unless wait_until is set.
+        In that case, it waits for jobs until no more than wait_until
+        of them remain queued.
+
+        """
+        queue = self._queue
+        while queue:
+            result, add = queue[0]
+            data = None
+            if result is not None:
+                waiting = (wait_until is not None
+                           and self._jobs > wait_until)
+                if not (waiting or result.ready()):
+                    break
+                queue.popleft()
+                self._jobs -= 1
+                data = result.get()
+            else:
+                queue.popleft()
+            add(data)
+            if result is not None and progress is not None:
+                progress += 1
+
+    def close(self, progress=None):
+        """Wait for all jobs, and add everything queued to the zipfile.
+
+        :param lib.feedback.Progress progress: Counts finished jobs.
+
+        The zipfile itself is left open. If a job fails, its exception
+        is raised once all the other jobs have finished.
+
+        """
+        if progress is not None:
+            progress.items = self._jobs
+        try:
+            self._drain(wait_until=0, progress=progress)
+        except Exception:
+            for result, add in self._queue:
+                if result is not None:
+                    result.wait()
+            self._queue.clear()
+            self._jobs = 0
+            raise
+        finally:
+            if progress is not None:
+                progress.close()
+
+
+class ThreadedProcessor (object):
+    """Queue of piecemeal tasks, processed in a background thread
+
+    This has the same interface as lib.idletask.Processor, but its
+    tasks run in a single worker thread instead of in idle callbacks,
+    so slow tasks don't hold up the main loop. Tasks are callables
+    which are called repeatedly, in the order they were added, until
+    they return false. They must only use data which nothing else
+    will modify while they run, such as snapshots.
+
+    >>> proc = ThreadedProcessor()
+    >>> out = []
+    >>> def count(n):
+    ...     out.append(n)
+    ...     return len(out) < n
+    >>> proc.add_work(count, 3)
+    >>> proc.add_work(out.append, "done")
+    >>> proc.finish_all()
+    >>> out
+    [3, 3, 3, 'done']
+    >>> proc.has_work()
+    False
+
+    A task which raises an exception is logged, and dropped.
+
+    """
+
+    def __init__(self):
+        super(ThreadedProcessor, self).__init__()
+        self._queue = collections.deque()  # [(func, args, kwargs)]
+        self._cond = threading.Condition()
+        self._thread = None
+        self._busy = False
+        self._generation = 0  # incremented by stop()
+
+    def __repr__(self):
+        return "<ThreadedProcessor queued=%d running=%r>" % (
+            len(self._queue),
+            self._thread is not None,
+        )
+
+    def has_work(self):
+        """True if there are tasks which haven't finished yet."""
+        with self._cond:
+            return bool(self._queue) or self._busy
+
+    def add_work(self, func, *args, **kwargs):
+        """Adds work
+
+        :param func: a task callable.
+        :param *args: passed to func
+        :param **kwargs: passed to func
+
+        This starts the worker thread if it isn't already running.
+
+        """
+        with self._cond:
+            self._queue.append((func, args, kwargs))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name="ThreadedProcessor",
+                )
+                self._thread.daemon = True
+                self._thread.start()
+
+    def finish_all(self):
+        """Wait for all queued tasks to finish."""
+        with self._cond:
+            while self._queue or self._busy:
+                self._cond.wait()
+
+    def iter_work(self):
+        """Iterate across (a copy of) the queued tasks."""
+        with self._cond:
+            return iter(list(self._queue))
+
+    def stop(self):
+        """Clear the queue, & wait for the current call to return.
+
+        The task being processed isn't called again.
+
+        """
+        with self._cond:
+            self._queue.clear()
+            self._generation += 1
+            while self._busy:
+                self._cond.wait()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._queue:
+                    self._thread = None
+                    self._cond.notify_all()
+                    return
+                func, args, kwargs = self._queue[0]
+                generation = self._generation
+                self._busy = True
+            try:
+                more = bool(func(*args, **kwargs))
+            except Exception:
+                logger.exception("Background task %r failed", func)
+                more = False
+            with self._cond:
+                self._busy = False
+                if generation == self._generation and not more:
+                    self._queue.popleft()
+                self._cond.notify_all()
+
+
+def _write_to_buffer(func, args):
+    """Internal: job returning what func(fp, *args) wrote to fp."""
+    fp = io.BytesIO()
+    func(fp, *args)
+    return fp.getvalue()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -11,6 +11,8 @@ import cairo
 from collections import namedtuple
 import unittest
 
+import numpy as np
+
 from . import paths
 import lib.gichecks
 from lib import mypaintlib
@@ -339,6 +341,112 @@ class Scroll (unittest.TestCase):
         print(msg, end=", ", file=sys.stderr)
 
 
+class Programs (unittest.TestCase):
+    """Native render programs must match the Python op interpreter."""
+
+    TILES = [(0, 0), (1, 0), (2, 0), (0, 1)]
+
+    def _fill(self, layer, tiles, rng):
+        """Random premultiplied fix15 data in some tiles of a layer"""
+        n = mypaintlib.TILE_SIZE
+        one = 1 << 15
+        for tx, ty in tiles:
+            with layer._surface.tile_request(tx, ty, readonly=False) as t:
+                alpha = rng.randint(0, one + 1, (n, n))
+                t[:, :, 3] = alpha
+                for c in range(3):
+                    t[:, :, c] = (alpha * rng.random_sample((n, n)))
+
+    def _make_stack(self):
+        import lib.layer.data
+        import lib.layer.group
+        import lib.layer.tree
+        from lib.modes import PASS_THROUGH_MODE
+        rng = np.random.RandomState(42)
+        root = lib.layer.tree.RootLayerStack(doc=None)
+
+        base = lib.layer.data.PaintingLayer(name="base")
+        self._fill(base, [(0, 0), (1, 0), (0, 1)], rng)
+        root.append(base)
+
+        # Isolated group, in a non-default mode, with skipped layers
+        multiply = lib.layer.group.LayerStack(name="multiply")
+        multiply.mode = mypaintlib.CombineMultiply
+        root.append(multiply)
+        screen = lib.layer.data.PaintingLayer(name="screen")
+        screen.mode = mypaintlib.CombineScreen
+        self._fill(screen, [(0, 0), (1, 0)], rng)
+        multiply.append(screen)
+        hidden = lib.layer.data.PaintingLayer(name="hidden")
+        hidden.visible = False
+        self._fill(hidden, [(0, 0)], rng)
+        multiply.append(hidden)
+        invisible = lib.layer.data.PaintingLayer(name="opacity 0")
+        invisible.opacity = 0.0
+        self._fill(invisible, [(1, 0)], rng)
+        multiply.append(invisible)
+
+        # Isolated group which is empty at most tiles: pruned there
+        sparse = lib.layer.group.LayerStack(name="sparse")
+        sparse.mode = mypaintlib.CombineOverlay
+        sparse.opacity = 0.5
+        root.append(sparse)
+        inner = lib.layer.group.LayerStack(name="inner")
+        inner.mode = mypaintlib.CombineNormal
+        inner.opacity = 0.75
+        sparse.append(inner)
+        spot = lib.layer.data.PaintingLayer(name="spot")
+        spot.mode = mypaintlib.CombineDifference
+        self._fill(spot, [(0, 1)], rng)
+        inner.append(spot)
+
+        # Groups which can't be pruned: an empty one whose mode clears
+        # the backdrop, and a pass-through one
+        clearing = lib.layer.group.LayerStack(name="clearing")
+        clearing.mode = mypaintlib.CombineDestinationIn
+        clearing.opacity = 0.5
+        root.append(clearing)
+        clearing.append(lib.layer.data.PaintingLayer(name="empty"))
+        passthru = lib.layer.group.LayerStack(name="pass-through")
+        passthru.mode = PASS_THROUGH_MODE
+        root.append(passthru)
+        burn = lib.layer.data.PaintingLayer(name="burn")
+        burn.mode = mypaintlib.CombineColorBurn
+        self._fill(burn, [(1, 0), (2, 0)], rng)
+        passthru.append(burn)
+        return root
+
+    def _check(self, dst_has_alpha):
+        from lib.layer import rendering
+        root = self._make_stack()
+        spec = rendering.Spec(background=False)
+        program = rendering.Program(root.get_render_ops(spec))
+        self.assertTrue(program._native, msg="program not native")
+        n = mypaintlib.TILE_SIZE
+        for tx, ty in self.TILES:
+            native = np.zeros((n, n, 4), 'uint16')
+            interpreted = np.zeros((n, n, 4), 'uint16')
+            if not dst_has_alpha:
+                native[:, :, :] = 1 << 15
+                interpreted[:, :, :] = 1 << 15
+            program.execute(native, dst_has_alpha, tx, ty)
+            # The interpreter runs every op, without pruning.
+            program._interpret(interpreted, dst_has_alpha, tx, ty, 0, [])
+            self.assertTrue(
+                (native == interpreted).all(),
+                msg="native and interpreted differ at %r" % ((tx, ty),),
+            )
+        root.close()
+
+    def test_native_matches_interpreted(self):
+        """Native programs render exactly like the op interpreter"""
+        self._check(dst_has_alpha=True)
+
+    def test_native_matches_interpreted_opaque(self):
+        """Native programs match the interpreter on opaque backdrops"""
+        self._check(dst_has_alpha=False)
+
+
 if __name__ == '__main__':
     assert(lib.gichecks)  # avoid a flake8 warning
     unittest.main()
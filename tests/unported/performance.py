@@ -17,6 +17,10 @@ stop_measurement = -2
 
 all_tests = {}
 
+# PNG compression setting used by the saving tests.
+# See lib.surface.get_png_compression().
+png_compression = "default"
+
 
 def run_test(testfunction, profile=None):
     """Run a single test
@@ -165,7 +169,7 @@ def save_ora():
     d = document.Document()
     d.load('bigimage.ora')
     yield start_measurement
-    d.save('test_save.ora')
+    d.save('test_save.ora', compression=png_compression)
     yield stop_measurement
 
 
@@ -174,9 +178,9 @@ def save_ora_again():
     from lib import document
     d = document.Document()
     d.load('bigimage.ora')
-    d.save('test_save.ora')
+    d.save('test_save.ora', compression=png_compression)
     yield start_measurement
-    d.save('test_save.ora')
+    d.save('test_save.ora', compression=png_compression)
     yield stop_measurement
 
 
@@ -186,7 +190,7 @@ def save_png():
     d = document.Document()
     d.load('bigimage.ora')
     yield start_measurement
-    d.save('test_save.png')
+    d.save('test_save.png', compression=png_compression)
     yield stop_measurement
 
 
@@ -196,7 +200,10 @@ def save_png_layer():
     d = document.Document()
     d.load('biglayer.png')
     yield start_measurement
-    d.layer_stack.current.save_as_png('test_save.png')
+    d.layer_stack.current.save_as_png(
+        'test_save.png',
+        compression=png_compression,
+    )
     yield stop_measurement
 
 
@@ -326,14 +333,15 @@ if __name__ == '__main__':
     sys.path.insert(0, '..')
     sys.path.insert(0, '.')
 
-    if len(sys.argv) == 4 and sys.argv[1] == 'SINGLE_TEST_RUN':
+    if len(sys.argv) == 5 and sys.argv[1] == 'SINGLE_TEST_RUN':
         func = all_tests[sys.argv[2]]
-        if sys.argv[3] == 'NONE':
+        png_compression = sys.argv[3]
+        if sys.argv[4] == 'NONE':
             run_test(func)
         else:
             profile = cProfile.Profile()
             run_test(func, profile)
-            profile.dump_stats(sys.argv[3])
+            profile.dump_stats(sys.argv[4])
         sys.exit(0)
 
     from optparse import OptionParser
@@ -373,6 +381,14 @@ if __name__ == '__main__':
         default=False,
         help='run cProfile, gprof2dot.py and show last result'
     )
+    parser.add_option(
+        '-z',
+        '--png-compression',
+        metavar='PROFILE',
+        default=png_compression,
+        help='PNG compression profile for the saving tests '
+             '(default: %default)'
+    )
     options, tests = parser.parse_args()
 
     if options.list:
@@ -402,13 +418,13 @@ if __name__ == '__main__':
             print('---')
             # spawn a new process for each test, to ensure proper cleanup
             args = [sys.executable, './test_performance.py',
-                    'SINGLE_TEST_RUN', t, 'NONE']
+                    'SINGLE_TEST_RUN', t, options.png_compression, 'NONE']
             if options.profile or options.show_profile:
                 if options.show_profile:
                     fname = 'tmp.pstats'
                 else:
                     fname = '%s_%s_%d.pstats' % (options.profile, t, i)
-                args[4] = fname
+                args[5] = fname
             child = subprocess.Popen(args, stdout=subprocess.PIPE)
             output, junk = child.communicate()
             if child.returncode != 0:
@@ -432,9 +448,11 @@ if __name__ == '__main__':
     print()
     print('=== DETAILS ===')
     print('tests =', repr(tests))
+    print('png_compression =', repr(options.png_compression))
     print('results =', repr(results))
     print()
     print('=== SUMMARY ===')
+    print('(PNG compression: %s)' % (options.png_compression,))
     fail = False
     for t, result in zip(tests, results):
         if not result: